@@ -1,15 +1,39 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
 from datetime import datetime, timedelta
 from io import BytesIO
-from msal import ConfidentialClientApplication
+from urllib.parse import quote
+from msal import ConfidentialClientApplication, SerializableTokenCache
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
 import unicodedata
 import logging
 import os
 import json
 import uuid
+import hashlib
+import hmac
+import importlib.util
+import zipfile
+import xml.etree.ElementTree as ET
 import time
+import tempfile
+import threading
+import shutil
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ===========================
 # CONFIGURAÇÕES DE VERSÃO - ATUALIZADO v2.4.0
@@ -279,16 +303,29 @@ logger = logging.getLogger(__name__)
 # ===========================
 # CREDENCIAIS VIA ST.SECRETS
 # ===========================
-try:
-    CLIENT_ID = st.secrets["CLIENT_ID"]
-    CLIENT_SECRET = st.secrets["CLIENT_SECRET"]
-    TENANT_ID = st.secrets["TENANT_ID"]
-    EMAIL_ONEDRIVE = st.secrets["EMAIL_ONEDRIVE"]
-    SITE_ID = st.secrets["SITE_ID"]
-    DRIVE_ID = st.secrets["DRIVE_ID"]
-except KeyError as e:
-    st.error(f"❌ Credencial não encontrada: {e}")
-    st.stop()
+def ler_credencial(nome):
+    """DSVIEW_<nome> do ambiente, se definida (ferramentas fora do Streamlit); senão st.secrets[nome]"""
+    valor = os.environ.get(f"DSVIEW_{nome}")
+    if valor is not None:
+        return valor
+    return st.secrets[nome]
+
+# "graph": drive do SharePoint via API Graph; "local": pasta em disco (sem autenticação nem drive remoto)
+BACKEND_ARMAZENAMENTO = os.environ.get("DSVIEW_BACKEND_ARMAZENAMENTO", "graph")
+
+if BACKEND_ARMAZENAMENTO == "local":
+    CLIENT_ID = CLIENT_SECRET = TENANT_ID = EMAIL_ONEDRIVE = SITE_ID = DRIVE_ID = None
+else:
+    try:
+        CLIENT_ID = ler_credencial("CLIENT_ID")
+        CLIENT_SECRET = ler_credencial("CLIENT_SECRET")
+        TENANT_ID = ler_credencial("TENANT_ID")
+        EMAIL_ONEDRIVE = ler_credencial("EMAIL_ONEDRIVE")
+        SITE_ID = ler_credencial("SITE_ID")
+        DRIVE_ID = ler_credencial("DRIVE_ID")
+    except KeyError as e:
+        st.error(f"❌ Credencial não encontrada: {e}")
+        st.stop()
 
 # ===========================
 # CONFIGURAÇÃO DE PASTAS
@@ -297,25 +334,224 @@ PASTA_CONSOLIDADO = "Documentos Compartilhados/LimparAuto/FontedeDados"
 PASTA_ENVIOS_BACKUPS = "Documentos Compartilhados/PlanilhasEnviadas_Backups/LimparAuto"
 PASTA = PASTA_CONSOLIDADO
 
+# ===========================
+# CONFIGURAÇÃO DA API GRAPH
+# ===========================
+# Pode apontar para um drive falso local (ferramentas/drive_falso.py) em testes
+GRAPH_BASE_URL = os.environ.get("DSVIEW_GRAPH_URL", "https://graph.microsoft.com/v1.0").rstrip("/")
+
+# Arquivos acima deste tamanho são enviados por sessão de upload em blocos
+LIMITE_UPLOAD_SIMPLES = 4 * 1024 * 1024
+TAMANHO_BLOCO_UPLOAD = 32 * 320 * 1024  # múltiplo de 320 KiB, exigido pela API
+TENTATIVAS_UPLOAD_SESSAO = 5
+
+# Timeouts (conexão, leitura) e política de novas tentativas do cliente Graph
+GRAPH_TIMEOUT = (10, 120)
+GRAPH_MAX_TENTATIVAS = 5
+GRAPH_ESPERA_MAXIMA_SEGUNDOS = 60
+GRAPH_TAMANHO_POOL = 10
+
+# Consultas/criações de pastas agrupadas em requisições JSON $batch
+USAR_BATCH_GRAPH = os.environ.get("DSVIEW_GRAPH_BATCH", "1") != "0"
+
+# Gravações independentes (backup do envio, auditoria, serialização do consolidado) rodam em paralelo
+MAX_THREADS_GRAVACAO = 3
+
 # ===========================
 # CONFIGURAÇÃO DO SISTEMA DE LOCK
 # ===========================
 ARQUIVO_LOCK = "sistema_lock.json"
 TIMEOUT_LOCK_MINUTOS = 10
 
+# Locks detidos por esta execução: session_id -> {"etag": ..., "dados": ...}
+LOCKS_DA_SESSAO = {}
+
+# ===========================
+# CONFIGURAÇÃO DO CACHE LOCAL
+# ===========================
+PASTA_CACHE_LOCAL = os.environ.get("DSVIEW_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dsview_upload_cache"))
+ARQUIVO_CACHE_CONSOLIDADO = "consolidado.parquet"
+ARQUIVO_CACHE_META = "consolidado_meta.json"
+
+# Cache de token MSAL compartilhado por sessões e processos do mesmo servidor
+ARQUIVO_CACHE_TOKEN = os.path.join(PASTA_CACHE_LOCAL, "msal_token_cache.json")
+INTERVALO_RENOVACAO_TOKEN_SEGUNDOS = 300
+
+# Leituras/validações de uploads reaproveitadas entre reruns (LRU limitado em memória)
+LIMITE_CACHE_LEITURAS_BYTES = 256 * 1024 * 1024
+
+# Engine de leitura mais rápida, usada quando instalada (pip install python-calamine)
+CALAMINE_DISPONIVEL = importlib.util.find_spec("python_calamine") is not None
+
+# Pré-validação em streaming: cabeçalho + amostra das primeiras linhas; rejeita o arquivo sem
+# leitura completa se a amostra já tiver este número de problemas de data
+LIMITE_PROBLEMAS_PRE_VALIDACAO = int(os.environ.get("DSVIEW_LIMITE_PRE_VALIDACAO", "50"))
+LINHAS_AMOSTRA_PRE_VALIDACAO = int(os.environ.get("DSVIEW_AMOSTRA_PRE_VALIDACAO", "2000"))
+
+# ===========================
+# CONFIGURAÇÃO DE ARMAZENAMENTO
+# ===========================
+# "arquivo_unico": um único Reports_Geral_Consolidado.xlsx reescrito a cada envio
+# "particionado": uma partição Parquet por mês em PASTA_PARTICOES; o arquivo único só é
+# materializado com DSVIEW_MATERIALIZAR_CONSOLIDADO=1 (custo proporcional a todo o histórico, com o lock detido)
+MODO_ARMAZENAMENTO = os.environ.get("DSVIEW_MODO_ARMAZENAMENTO", "arquivo_unico")
+
+# Raiz do drive quando BACKEND_ARMAZENAMENTO = "local" (as mesmas pastas do SharePoint são criadas abaixo dela)
+PASTA_ARMAZENAMENTO_LOCAL = os.environ.get("DSVIEW_PASTA_ARMAZENAMENTO_LOCAL", os.path.join(PASTA_CACHE_LOCAL, "drive_local"))
+PASTA_PARTICOES = "Particoes"
+MATERIALIZAR_CONSOLIDADO = os.environ.get("DSVIEW_MATERIALIZAR_CONSOLIDADO", "0") == "1"
+
+# XLSX gerados acima deste tamanho vão para disco em vez de ficar em memória
+LIMITE_XLSX_EM_MEMORIA = 16 * 1024 * 1024
+LINHAS_POR_BLOCO_XLSX = 10000
+
+# ===========================
+# CONFIGURAÇÃO DE MEMÓRIA
+# ===========================
+# Orçamento de memória por consolidação (MB). Se a estimativa de pico passar dele, o consolidado
+# é ordenado e serializado em blocos mensais em vez de inteiro. 0 = sem limite.
+# Só a ordenação final e a serialização ficam limitadas: download, plano e merge continuam com o
+# frame inteiro no modo "arquivo_unico" (no modo "particionado" eles só veem os meses do envio)
+ORCAMENTO_MEMORIA_MB = int(os.environ.get("DSVIEW_ORCAMENTO_MEMORIA_MB", "0"))
+# Pico estimado = RSS atual + FATOR_PICO_MEMORIA x tamanho dos frames (frame, cópia ordenada e bloco serializado)
+FATOR_PICO_MEMORIA = 3
+INTERVALO_AMOSTRAGEM_MEMORIA_SEGUNDOS = 0.05
+
+# ===========================
+# CONFIGURAÇÃO DE PERFILAMENTO
+# ===========================
+# Consolidação e validação sob cProfile + tracemalloc: DSVIEW_PERFILAR=1 no servidor ou, para uma
+# sessão, ?perfilar=<CHAVE_PERFILAMENTO> na URL (só se a chave estiver em DSVIEW_CHAVE_PERFILAMENTO
+# ou st.secrets; sem chave configurada o parâmetro é ignorado).
+# Desligado, as funções são chamadas diretamente, sem nenhuma instrumentação.
+PERFILAMENTO_HABILITADO = os.environ.get("DSVIEW_PERFILAR", "0") == "1"
+PARAMETRO_PERFILAMENTO = "perfilar"
+try:
+    CHAVE_PERFILAMENTO = ler_credencial("CHAVE_PERFILAMENTO") or None
+except Exception:
+    CHAVE_PERFILAMENTO = None
+PASTA_PERFIS = os.environ.get("DSVIEW_PASTA_PERFIS", os.path.join(PASTA_CACHE_LOCAL, "perfis"))
+TOP_PERFILAMENTO = 20
+LIMITE_PERFIS_SESSAO = 5
+
+# ===========================
+# CONFIGURAÇÃO DO SCHEMA (ABA VENDAS CTs)
+# ===========================
+# Tipo compacto de cada coluna conhecida (nomes já em strip + upper)
+# "data": datetime64 | "categoria": category | "numero": menor tipo numérico sem perda
+SCHEMA_VENDAS_CTS = {
+    "DATA": {"tipo": "data", "obrigatoria": True},
+    "RESPONSÁVEL": {"tipo": "categoria", "obrigatoria": True},
+    "TMO - DUTO": {"tipo": "numero", "obrigatoria": True},
+    "TMO - FREIO": {"tipo": "numero", "obrigatoria": True},
+    "TMO - SANIT": {"tipo": "numero", "obrigatoria": True},
+    "TMO - VERNIZ": {"tipo": "numero", "obrigatoria": True},
+    "CX EVAP": {"tipo": "numero", "obrigatoria": True},
+    "DATA_ULTIMO_ENVIO": {"tipo": "data", "obrigatoria": False},
+}
+
+# Log de auditoria (Parquet) gravado junto aos backups; "1" grava registro a registro em vez de por período
+PASTA_AUDITORIA = "Auditoria"
+AUDITORIA_POR_REGISTRO = os.environ.get("DSVIEW_AUDITORIA_POR_REGISTRO", "0") == "1"
+
+# Métricas por etapa de cada consolidação (JSON) gravadas junto aos backups
+PASTA_METRICAS = "Metricas"
+LIMITE_CHAMADAS_GRAPH_METRICAS = 500
+
+# Chave normalizada do responsável (strip + upper), calculada uma vez por frame; nunca é gravada
+COLUNA_CHAVE_RESPONSAVEL = "_CHAVE_RESPONSAVEL"
+
+# Demais colunas de texto em strings Arrow (menos memória que "object"; requer pyarrow)
+USAR_STRINGS_ARROW = os.environ.get("DSVIEW_STRINGS_ARROW", "0") == "1" and importlib.util.find_spec("pyarrow") is not None
+
 # ===========================
 # AUTENTICAÇÃO
 # ===========================
-@st.cache_data(ttl=3300)
-def obter_token():
-    """Obtém token de acesso para Microsoft Graph API"""
-    try:
-        app = ConfidentialClientApplication(
+class GerenciadorToken:
+    """App MSAL único por processo, com cache de token serializável persistido em disco"""
+    
+    def __init__(self):
+        self.trava = threading.Lock()
+        self.cache = SerializableTokenCache()
+        self.mtime_cache = None
+        self.carregar_cache_disco()
+        self.app = ConfidentialClientApplication(
             CLIENT_ID,
             authority=f"https://login.microsoftonline.com/{TENANT_ID}",
-            client_credential=CLIENT_SECRET
+            client_credential=CLIENT_SECRET,
+            token_cache=self.cache
         )
-        result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
+    
+    def carregar_cache_disco(self):
+        """Recarrega o cache se outro processo o atualizou"""
+        try:
+            mtime = os.path.getmtime(ARQUIVO_CACHE_TOKEN)
+        except OSError:
+            return
+        
+        if mtime != self.mtime_cache:
+            with open(ARQUIVO_CACHE_TOKEN, "r", encoding="utf-8") as f:
+                self.cache.deserialize(f.read())
+            self.mtime_cache = mtime
+    
+    def persistir_cache_disco(self):
+        """Grava o cache (somente leitura pelo dono) quando houve mudança"""
+        if not self.cache.has_state_changed:
+            return
+        
+        os.makedirs(os.path.dirname(ARQUIVO_CACHE_TOKEN), exist_ok=True)
+        caminho_tmp = f"{ARQUIVO_CACHE_TOKEN}.{os.getpid()}.tmp"
+        descritor = os.open(caminho_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descritor, "w", encoding="utf-8") as f:
+            f.write(self.cache.serialize())
+        os.replace(caminho_tmp, ARQUIVO_CACHE_TOKEN)
+        
+        self.cache.has_state_changed = False
+        self.mtime_cache = os.path.getmtime(ARQUIVO_CACHE_TOKEN)
+    
+    def obter(self):
+        """Token do cache; o MSAL renova sozinho quando o token se aproxima do vencimento"""
+        with self.trava:
+            try:
+                self.carregar_cache_disco()
+            except Exception as e:
+                logger.warning(f"Cache de token em disco ilegível, ignorado: {e}")
+            
+            result = self.app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
+            
+            try:
+                self.persistir_cache_disco()
+            except Exception as e:
+                logger.warning(f"Não foi possível persistir o cache de token: {e}")
+            
+            return result
+    
+    def renovar_periodicamente(self):
+        """Mantém o token renovado em segundo plano, antes do vencimento"""
+        while True:
+            time.sleep(INTERVALO_RENOVACAO_TOKEN_SEGUNDOS)
+            try:
+                result = self.obter()
+                if "access_token" not in result:
+                    logger.warning(f"Renovação de token falhou: {result.get('error_description', 'Token não obtido')}")
+            except Exception as e:
+                logger.warning(f"Renovação de token falhou: {e}")
+
+@st.cache_resource
+def obter_gerenciador_token():
+    """Gerenciador de token único por processo, com a thread de renovação iniciada"""
+    gerenciador = GerenciadorToken()
+    threading.Thread(target=gerenciador.renovar_periodicamente, name="renovacao-token", daemon=True).start()
+    return gerenciador
+
+def obter_token():
+    """Obtém token de acesso para Microsoft Graph API (falhas nunca ficam em cache)"""
+    if BACKEND_ARMAZENAMENTO == "local":
+        # A pasta local não exige autenticação; o valor só é repassado às funções de armazenamento
+        return "local"
+    
+    try:
+        result = obter_gerenciador_token().obter()
         
         if "access_token" not in result:
             error_desc = result.get("error_description", "Token não obtido")
@@ -329,30 +565,412 @@ def obter_token():
         logger.error(f"Erro de autenticação: {e}")
         return None
 
+# ===========================
+# CLIENTE HTTP DA API GRAPH
+# ===========================
+def tamanho_corpo(kwargs):
+    """Bytes do corpo de uma requisição (data em bytes/str/arquivo ou json)"""
+    corpo = kwargs.get("data")
+    if corpo is None:
+        return len(json.dumps(kwargs["json"]).encode("utf-8")) if kwargs.get("json") is not None else 0
+    if isinstance(corpo, str):
+        return len(corpo.encode("utf-8"))
+    if isinstance(corpo, (bytes, bytearray, memoryview)):
+        return len(corpo)
+    if hasattr(corpo, "seek"):
+        posicao = corpo.tell()
+        fim = corpo.seek(0, os.SEEK_END)
+        corpo.seek(posicao)
+        return fim - posicao
+    return 0
+
+class ClienteGraph:
+    """Sessão HTTP compartilhada (keep-alive) com timeout, Retry-After e backoff exponencial"""
+    
+    STATUS_REPETIVEIS = {429, 502, 503, 504}
+    
+    def __init__(self, timeout=GRAPH_TIMEOUT, max_tentativas=GRAPH_MAX_TENTATIVAS):
+        self.timeout = timeout
+        self.max_tentativas = max_tentativas
+        self.sessao = requests.Session()
+        adaptador = requests.adapters.HTTPAdapter(pool_connections=GRAPH_TAMANHO_POOL, pool_maxsize=GRAPH_TAMANHO_POOL)
+        self.sessao.mount("https://", adaptador)
+        self.sessao.mount("http://", adaptador)
+    
+    def tempo_espera(self, response, tentativa):
+        """Respeita Retry-After quando presente; senão, backoff exponencial"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(int(retry_after), GRAPH_ESPERA_MAXIMA_SEGUNDOS)
+        return min(2 ** tentativa, GRAPH_ESPERA_MAXIMA_SEGUNDOS)
+    
+    def requisitar(self, metodo, url, **kwargs):
+        """Requisição com novas tentativas; dentro de uma consolidação, soma tempo e bytes às métricas da etapa"""
+        metricas = metricas_ativas()
+        if metricas is None:
+            return self._requisitar(metodo, url, **kwargs)
+        
+        bytes_enviados = tamanho_corpo(kwargs)
+        inicio = time.perf_counter()
+        response = None
+        try:
+            response = self._requisitar(metodo, url, **kwargs)
+            return response
+        finally:
+            metricas.registrar_chamada_graph(
+                metodo, url,
+                response.status_code if response is not None else None,
+                time.perf_counter() - inicio,
+                bytes_enviados,
+                len(response.content or b"") if response is not None else 0,
+            )
+    
+    def _requisitar(self, metodo, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        
+        # Corpos em arquivo precisam voltar ao início a cada tentativa
+        corpo = kwargs.get("data")
+        posicao_corpo = corpo.tell() if hasattr(corpo, "seek") else None
+        
+        for tentativa in range(self.max_tentativas):
+            if posicao_corpo is not None:
+                corpo.seek(posicao_corpo)
+            
+            try:
+                response = self.sessao.request(metodo, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # POST não é idempotente (criação de pasta, sessão de upload): não repete às cegas
+                if metodo == "POST" or tentativa == self.max_tentativas - 1:
+                    raise
+                espera = self.tempo_espera(None, tentativa)
+                logger.warning(f"Graph {metodo} falhou ({e}); nova tentativa em {espera}s")
+                time.sleep(espera)
+                continue
+            
+            if response.status_code not in self.STATUS_REPETIVEIS or tentativa == self.max_tentativas - 1:
+                return response
+            
+            espera = self.tempo_espera(response, tentativa)
+            logger.warning(f"Graph {metodo} respondeu {response.status_code}; nova tentativa em {espera}s")
+            time.sleep(espera)
+    
+    def get(self, url, **kwargs):
+        return self.requisitar("GET", url, **kwargs)
+    
+    def put(self, url, **kwargs):
+        return self.requisitar("PUT", url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.requisitar("POST", url, **kwargs)
+    
+    def patch(self, url, **kwargs):
+        return self.requisitar("PATCH", url, **kwargs)
+    
+    def delete(self, url, **kwargs):
+        return self.requisitar("DELETE", url, **kwargs)
+
+@st.cache_resource
+def obter_cliente_graph():
+    """Cliente Graph único por processo, compartilhado entre sessões e reruns"""
+    return ClienteGraph()
+
+# ===========================
+# ARMAZENAMENTO (GRAPH OU PASTA LOCAL)
+# ===========================
+# Interface comum: metadados, ler, gravar, renomear, excluir, listar e criar_pasta, com caminhos
+# relativos à raiz do drive. As respostas expõem status_code, content, text e json() com os
+# códigos do Graph: 200/201, 304 (If-None-Match), 404, 409 (criação exclusiva) e 412 (If-Match).
+class ArmazenamentoGraph:
+    """Drive do SharePoint via API Graph (SITE_ID/DRIVE_ID)"""
+    
+    def __init__(self, token):
+        self.token = token
+    
+    def _url(self, caminho, sufixo=""):
+        return f"{GRAPH_BASE_URL}/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{caminho}{sufixo}"
+    
+    def _headers(self, **extras):
+        return {"Authorization": f"Bearer {self.token}", **extras}
+    
+    def metadados(self, caminho):
+        """Item (id, name, eTag, cTag, size) ou 404"""
+        return obter_cliente_graph().get(self._url(caminho, "?$select=id,name,eTag,cTag,size"), headers=self._headers())
+    
+    def ler(self, caminho, etag=None):
+        """Conteúdo do arquivo (eTag da versão lida no cabeçalho ETag); 304 se o eTag informado ainda for o atual"""
+        headers = self._headers()
+        if etag:
+            headers["If-None-Match"] = etag
+        return obter_cliente_graph().get(self._url(caminho, ":/content"), headers=headers)
+    
+    def gravar(self, caminho, conteudo, etag=None, exclusivo=False, tipo_conteudo="application/octet-stream"):
+        """
+        Grava bytes ou um arquivo aberto. `exclusivo` falha com 409 se o arquivo existir;
+        `etag` falha com 412 se o arquivo mudou. Arquivos grandes vão por sessão de upload.
+        """
+        if etag is None and not exclusivo and tamanho_conteudo(conteudo) > LIMITE_UPLOAD_SIMPLES:
+            _, status_code, texto = upload_em_sessao(caminho, conteudo, self.token)
+            return RespostaArmazenamento(status_code, texto.encode("utf-8"))
+        
+        headers = self._headers(**{"Content-Type": tipo_conteudo})
+        if etag:
+            headers["If-Match"] = etag
+        sufixo = ":/content?@microsoft.graph.conflictBehavior=fail" if exclusivo else ":/content"
+        return obter_cliente_graph().put(self._url(caminho, sufixo), headers=headers, data=conteudo)
+    
+    def renomear(self, caminho, novo_nome):
+        """Renomeia o item na mesma pasta"""
+        response = self.metadados(caminho)
+        if response.status_code != 200:
+            return response
+        
+        url = f"{GRAPH_BASE_URL}/sites/{SITE_ID}/drives/{DRIVE_ID}/items/{response.json().get('id')}"
+        return obter_cliente_graph().patch(url, headers=self._headers(**{"Content-Type": "application/json"}), json={"name": novo_nome})
+    
+    def excluir(self, caminho, etag=None):
+        """Exclui o item; com `etag`, só se ele não mudou (412)"""
+        headers = self._headers()
+        if etag:
+            headers["If-Match"] = etag
+        return obter_cliente_graph().delete(self._url(caminho), headers=headers)
+    
+    def listar(self, caminho):
+        """{nome: eTag} dos itens da pasta, ou None se ela não existir"""
+        url = self._url(caminho, ":/children?$select=name,eTag&$top=999")
+        itens = {}
+        
+        while url:
+            response = obter_cliente_graph().get(url, headers=self._headers())
+            if response.status_code == 404:
+                return None
+            if response.status_code != 200:
+                raise RuntimeError(f"Erro ao listar {caminho}: {response.status_code}")
+            
+            dados = response.json()
+            for item in dados.get("value", []):
+                itens[item.get("name", "")] = item.get("eTag")
+            url = dados.get("@odata.nextLink")
+        
+        return itens
+    
+    def criar_pasta(self, caminho):
+        """Cria a pasta e os ancestrais que faltarem"""
+        criar_pasta_se_nao_existir(caminho, self.token)
+
+class RespostaArmazenamento:
+    """Resposta de uma operação sem HTTP, com a mesma interface usada das respostas do requests"""
+    
+    def __init__(self, status_code, content=b""):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {}
+    
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+    
+    def json(self):
+        return json.loads(self.content)
+
+class ArmazenamentoLocal:
+    """
+    Drive numa pasta local com a mesma semântica: eTag novo a cada gravação, If-Match,
+    If-None-Match e criação exclusiva. Gravações vão para um temporário e entram com os.replace;
+    verificação de eTag e troca são serializadas entre threads e, onde houver fcntl, entre processos.
+    """
+    
+    def __init__(self, raiz):
+        self.raiz = os.path.abspath(raiz)
+        os.makedirs(self.raiz, exist_ok=True)
+        self._trava = threading.RLock()
+    
+    def _caminho(self, caminho):
+        completo = os.path.abspath(os.path.join(self.raiz, *[parte for parte in caminho.split("/") if parte]))
+        if os.path.commonpath([completo, self.raiz]) != self.raiz:
+            raise ValueError(f"Caminho fora do armazenamento local: {caminho}")
+        return completo
+    
+    @staticmethod
+    def _etag(info):
+        # os.replace cria um inode novo a cada gravação: inode + mtime + tamanho identificam a versão
+        return f'"{info.st_ino:x}-{info.st_mtime_ns:x}-{info.st_size:x}"'
+    
+    def _item(self, caminho, completo):
+        info = os.stat(completo)
+        etag = self._etag(info)
+        item = {"id": "/".join(parte for parte in caminho.split("/") if parte), "name": os.path.basename(completo), "eTag": etag, "cTag": etag}
+        if os.path.isdir(completo):
+            item["folder"] = {"childCount": len(os.listdir(completo))}
+        else:
+            item["size"] = info.st_size
+        return item
+    
+    def _resposta_item(self, status_code, caminho, completo):
+        return RespostaArmazenamento(status_code, json.dumps(self._item(caminho, completo)).encode("utf-8"))
+    
+    @contextlib.contextmanager
+    def _exclusivo(self):
+        with self._trava:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.raiz, ".trava"), "a") as arquivo_trava:
+                fcntl.flock(arquivo_trava, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(arquivo_trava, fcntl.LOCK_UN)
+    
+    def metadados(self, caminho):
+        completo = self._caminho(caminho)
+        if not os.path.exists(completo):
+            return RespostaArmazenamento(404)
+        return self._resposta_item(200, caminho, completo)
+    
+    def ler(self, caminho, etag=None):
+        completo = self._caminho(caminho)
+        try:
+            # Arquivo aberto antes do stat: conteúdo e eTag são da mesma versão
+            with open(completo, "rb") as arquivo:
+                etag_atual = self._etag(os.fstat(arquivo.fileno()))
+                if etag and etag == etag_atual:
+                    return RespostaArmazenamento(304)
+                resposta = RespostaArmazenamento(200, arquivo.read())
+                resposta.headers["ETag"] = etag_atual
+                return resposta
+        except (FileNotFoundError, IsADirectoryError):
+            return RespostaArmazenamento(404)
+    
+    def gravar(self, caminho, conteudo, etag=None, exclusivo=False, tipo_conteudo=None):
+        completo = self._caminho(caminho)
+        os.makedirs(os.path.dirname(completo), exist_ok=True)
+        temporario = os.path.join(os.path.dirname(completo), f".{os.path.basename(completo)}.{uuid.uuid4().hex}.tmp")
+        
+        # A cópia do conteúdo fica fora da seção exclusiva; só a verificação e a troca são serializadas
+        with open(temporario, "wb") as arquivo:
+            if isinstance(conteudo, str):
+                arquivo.write(conteudo.encode("utf-8"))
+            elif isinstance(conteudo, (bytes, bytearray, memoryview)):
+                arquivo.write(conteudo)
+            else:
+                shutil.copyfileobj(conteudo, arquivo)
+        
+        try:
+            with self._exclusivo():
+                existe = os.path.isfile(completo)
+                if exclusivo and existe:
+                    return RespostaArmazenamento(409)
+                if etag and (not existe or self._item(caminho, completo)["eTag"] != etag):
+                    return RespostaArmazenamento(412)
+                
+                os.replace(temporario, completo)
+                return self._resposta_item(200 if existe else 201, caminho, completo)
+        finally:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+    
+    def renomear(self, caminho, novo_nome):
+        completo = self._caminho(caminho)
+        destino = os.path.join(os.path.dirname(completo), novo_nome)
+        
+        with self._exclusivo():
+            if not os.path.exists(completo):
+                return RespostaArmazenamento(404)
+            if os.path.exists(destino):
+                return RespostaArmazenamento(409)
+            os.rename(completo, destino)
+            return self._resposta_item(200, "/".join(caminho.split("/")[:-1] + [novo_nome]), destino)
+    
+    def excluir(self, caminho, etag=None):
+        completo = self._caminho(caminho)
+        
+        with self._exclusivo():
+            if not os.path.exists(completo):
+                return RespostaArmazenamento(404)
+            if etag and self._item(caminho, completo)["eTag"] != etag:
+                return RespostaArmazenamento(412)
+            
+            if os.path.isdir(completo):
+                shutil.rmtree(completo)
+            else:
+                os.remove(completo)
+            return RespostaArmazenamento(204)
+    
+    def listar(self, caminho):
+        completo = self._caminho(caminho)
+        if not os.path.isdir(completo):
+            return None
+        
+        return {
+            nome: self._item(f"{caminho}/{nome}", os.path.join(completo, nome))["eTag"]
+            for nome in sorted(os.listdir(completo))
+            if not nome.startswith(".")
+        }
+    
+    def criar_pasta(self, caminho):
+        os.makedirs(self._caminho(caminho), exist_ok=True)
+
+@st.cache_resource
+def obter_armazenamento_local():
+    """Armazenamento em pasta local único por processo (a trava entre threads é compartilhada)"""
+    return ArmazenamentoLocal(PASTA_ARMAZENAMENTO_LOCAL)
+
+def obter_armazenamento(token):
+    """Backend de armazenamento configurado em BACKEND_ARMAZENAMENTO"""
+    if BACKEND_ARMAZENAMENTO == "local":
+        return obter_armazenamento_local()
+    return ArmazenamentoGraph(token)
+
 # ===========================
 # SISTEMA DE LOCK
 # ===========================
+# Fora de uma execução do Streamlit (ferramentas, testes de carga) cada thread é uma sessão
+_SESSAO_DA_THREAD = threading.local()
+
 def gerar_id_sessao():
     """Gera um ID único para a sessão atual"""
+    if get_script_run_ctx() is None:
+        if not hasattr(_SESSAO_DA_THREAD, "session_id"):
+            _SESSAO_DA_THREAD.session_id = str(uuid.uuid4())[:8]
+        return _SESSAO_DA_THREAD.session_id
+    
     if 'session_id' not in st.session_state:
         st.session_state.session_id = str(uuid.uuid4())[:8]
     return st.session_state.session_id
 
+def caminho_lock():
+    """Caminho do arquivo de lock no drive"""
+    return f"{PASTA_CONSOLIDADO}/{ARQUIVO_LOCK}"
+
+def lock_expirado(lock_data):
+    """Indica se o lock ultrapassou TIMEOUT_LOCK_MINUTOS"""
+    timestamp_lock = datetime.fromisoformat(lock_data['timestamp'])
+    return datetime.now() - timestamp_lock > timedelta(minutes=TIMEOUT_LOCK_MINUTOS)
+
+def ler_lock_com_etag(token):
+    """Lê o lock e o eTag correspondente (eTag antes do conteúdo, para o CAS ser seguro)"""
+    etag, _ = obter_tags_item(token, caminho_lock())
+    if not etag:
+        return None, None
+    
+    response = obter_armazenamento(token).ler(caminho_lock())
+    if response.status_code != 200:
+        return None, None
+    
+    return response.json(), etag
+
 def verificar_lock_existente(token):
     """Verifica se existe um lock ativo no sistema"""
     try:
-        url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{PASTA_CONSOLIDADO}/{ARQUIVO_LOCK}:/content"
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.get(url, headers=headers)
+        response = obter_armazenamento(token).ler(caminho_lock())
         
         if response.status_code == 200:
             lock_data = response.json()
-            timestamp_lock = datetime.fromisoformat(lock_data['timestamp'])
-            agora = datetime.now()
             
-            if agora - timestamp_lock > timedelta(minutes=TIMEOUT_LOCK_MINUTOS):
-                logger.info(f"Lock expirado removido automaticamente. Era de {timestamp_lock}")
-                remover_lock(token, force=True)
+            # Lock expirado é tratado como livre; criar_lock o substitui de forma atômica
+            if lock_expirado(lock_data):
+                logger.info(f"Lock expirado ignorado (de {lock_data['timestamp']}); será substituído na próxima aquisição")
                 return False, None
             
             return True, lock_data
@@ -368,7 +986,7 @@ def verificar_lock_existente(token):
         return False, None
 
 def criar_lock(token, operacao="Consolidação de dados"):
-    """Cria um lock para bloquear outras operações"""
+    """Cria o lock de forma atômica (falha se já existir) e guarda o eTag em memória"""
     try:
         session_id = gerar_id_sessao()
         
@@ -380,15 +998,32 @@ def criar_lock(token, operacao="Consolidação de dados"):
             "app_version": APP_VERSION
         }
         
-        url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{PASTA_CONSOLIDADO}/{ARQUIVO_LOCK}:/content"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+        armazenamento = obter_armazenamento(token)
+        response = armazenamento.gravar(
+            caminho_lock(), json.dumps(lock_data), exclusivo=True, tipo_conteudo="application/json"
+        )
         
-        response = requests.put(url, headers=headers, data=json.dumps(lock_data))
+        if response.status_code == 409:
+            lock_atual, etag_atual = ler_lock_com_etag(token)
+            
+            if lock_atual and lock_atual.get('session_id') == session_id:
+                # Nossa própria criação (resposta perdida e requisição repetida)
+                LOCKS_DA_SESSAO[session_id] = {"etag": etag_atual, "dados": lock_atual}
+                logger.info(f"Lock já pertencia a esta sessão. Session ID: {session_id}")
+                return True, session_id
+            
+            if not lock_atual or not lock_expirado(lock_atual):
+                logger.warning("Lock em uso por outra sessão")
+                return False, None
+            
+            # Substitui o lock expirado somente se ninguém o alterou desde a leitura
+            logger.info(f"Assumindo lock expirado de {lock_atual['timestamp']}")
+            response = armazenamento.gravar(
+                caminho_lock(), json.dumps(lock_data), etag=etag_atual, tipo_conteudo="application/json"
+            )
         
         if response.status_code in [200, 201]:
+            LOCKS_DA_SESSAO[session_id] = {"etag": response.json().get("eTag"), "dados": lock_data}
             logger.info(f"Lock criado com sucesso. Session ID: {session_id}")
             return True, session_id
         else:
@@ -402,21 +1037,28 @@ def criar_lock(token, operacao="Consolidação de dados"):
 def remover_lock(token, session_id=None, force=False):
     """Remove o lock do sistema"""
     try:
-        if not force and session_id:
+        etag = None
+        lock_mantido = LOCKS_DA_SESSAO.pop(session_id, None) if session_id else None
+        
+        if not force and lock_mantido and lock_mantido.get("etag"):
+            # Exclusão condicional: só remove se o lock ainda for o nosso
+            etag = lock_mantido["etag"]
+        elif not force and session_id:
             lock_existe, lock_data = verificar_lock_existente(token)
             if lock_existe and lock_data.get('session_id') != session_id:
                 logger.warning("Tentativa de remover lock de outra sessão!")
                 return False
         
-        url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{PASTA_CONSOLIDADO}/{ARQUIVO_LOCK}"
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.delete(url, headers=headers)
+        response = obter_armazenamento(token).excluir(caminho_lock(), etag=etag)
         
         if response.status_code in [200, 204]:
             logger.info("Lock removido com sucesso")
             return True
         elif response.status_code == 404:
             return True
+        elif response.status_code == 412:
+            logger.warning("Lock foi assumido por outra sessão; não removido")
+            return False
         else:
             logger.error(f"Erro ao remover lock: {response.status_code}")
             return False
@@ -426,28 +1068,39 @@ def remover_lock(token, session_id=None, force=False):
         return False
 
 def atualizar_status_lock(token, session_id, novo_status, detalhes=None):
-    """Atualiza o status do lock durante o processo"""
+    """Atualiza o status do lock com um único PUT condicional (If-Match no eTag conhecido)"""
     try:
-        lock_existe, lock_data = verificar_lock_existente(token)
+        lock_mantido = LOCKS_DA_SESSAO.get(session_id)
         
-        if not lock_existe or lock_data.get('session_id') != session_id:
+        if not lock_mantido:
             logger.warning("Lock não existe ou não pertence a esta sessão")
             return False
         
+        lock_data = dict(lock_mantido["dados"])
         lock_data['status'] = novo_status
         lock_data['ultima_atualizacao'] = datetime.now().isoformat()
         
+        # Tempo por etapa até aqui: quem consulta o lock vê em que etapa ele está sendo retido
+        metricas = metricas_ativas()
+        if metricas is not None:
+            detalhes = f"{detalhes} | {metricas.resumo_texto()}" if detalhes else metricas.resumo_texto()
+        
         if detalhes:
             lock_data['detalhes'] = detalhes
         
-        url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{PASTA_CONSOLIDADO}/{ARQUIVO_LOCK}:/content"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+        response = obter_armazenamento(token).gravar(
+            caminho_lock(), json.dumps(lock_data), etag=lock_mantido.get("etag"), tipo_conteudo="application/json"
+        )
+        
+        if response.status_code in [200, 201]:
+            lock_mantido["etag"] = response.json().get("eTag")
+            lock_mantido["dados"] = lock_data
+            return True
         
-        response = requests.put(url, headers=headers, data=json.dumps(lock_data))
-        return response.status_code in [200, 201]
+        if response.status_code == 412:
+            logger.warning("Lock alterado por outra sessão - esta sessão não detém mais o lock")
+            LOCKS_DA_SESSAO.pop(session_id, None)
+        return False
         
     except Exception as e:
         logger.error(f"Erro ao atualizar status do lock: {e}")
@@ -537,49 +1190,274 @@ def exibir_status_sistema(token):
 # ===========================
 # FUNÇÕES AUXILIARES
 # ===========================
+@st.cache_resource
+def obter_cache_pastas():
+    """Caminhos de pastas já confirmados no drive (compartilhado pelo processo)"""
+    return set()
+
+def registrar_pastas_existentes(partes, ate):
+    """Marca como existentes todos os prefixos partes[:1] .. partes[:ate]"""
+    cache = obter_cache_pastas()
+    for i in range(1, ate + 1):
+        cache.add("/".join(partes[:i]))
+
+def url_relativa_item(caminho):
+    """URL relativa (para $batch) de um item do drive pelo caminho"""
+    return f"/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{quote(caminho)}"
+
+def executar_batch_graph(requisicoes, token):
+    """Executa até 20 requisições num único POST $batch; retorna {id: status}"""
+    url = f"{GRAPH_BASE_URL}/$batch"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    response = obter_cliente_graph().post(url, headers=headers, json={"requests": requisicoes})
+    
+    if response.status_code != 200:
+        raise RuntimeError(f"$batch respondeu {response.status_code}")
+    
+    return {r["id"]: r["status"] for r in response.json().get("responses", [])}
+
+def criar_pastas_em_lote(partes, indice_inicial, token):
+    """Cria partes[indice_inicial:] em um único $batch encadeado por dependsOn"""
+    requisicoes = []
+    for i in range(indice_inicial, len(partes)):
+        caminho_pai = "/".join(partes[:i])
+        url_pai = url_relativa_item(caminho_pai) + ":/children" if caminho_pai else f"/sites/{SITE_ID}/drives/{DRIVE_ID}/root/children"
+        requisicao = {
+            "id": str(i),
+            "method": "POST",
+            "url": url_pai,
+            "headers": {"Content-Type": "application/json"},
+            "body": {"name": partes[i], "folder": {}, "@microsoft.graph.conflictBehavior": "fail"}
+        }
+        if requisicoes:
+            requisicao["dependsOn"] = [requisicoes[-1]["id"]]
+        requisicoes.append(requisicao)
+    
+    status = executar_batch_graph(requisicoes, token)
+    
+    # 409 = a pasta foi criada por outra sessão nesse meio tempo
+    return all(status.get(r["id"]) in [200, 201, 409] for r in requisicoes)
+
+def criar_pastas_sequencial(partes, indice_inicial, token):
+    """Cria partes[indice_inicial:] uma a uma (sem $batch)"""
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    
+    for i in range(indice_inicial, len(partes)):
+        caminho_pai = "/".join(partes[:i])
+        parent_url = f"{GRAPH_BASE_URL}/sites/{SITE_ID}/drives/{DRIVE_ID}/root"
+        parent_url += f":/{caminho_pai}:/children" if caminho_pai else "/children"
+        
+        create_body = {
+            "name": partes[i],
+            "folder": {},
+            "@microsoft.graph.conflictBehavior": "fail"
+        }
+        create_response = obter_cliente_graph().post(parent_url, headers=headers, json=create_body)
+        
+        if create_response.status_code not in [200, 201, 409]:
+            logger.warning(f"Não foi possível criar pasta {partes[i]}")
+            return False
+    
+    return True
+
 def criar_pasta_se_nao_existir(caminho_pasta, token):
-    """Cria pasta no OneDrive se não existir"""
+    """Cria pasta no OneDrive se não existir (cache de pastas + uma consulta do caminho completo)"""
     try:
-        partes = caminho_pasta.split('/')
-        caminho_atual = ""
+        partes = [parte for parte in caminho_pasta.split('/') if parte]
+        caminho_completo = "/".join(partes)
         
-        for parte in partes:
-            if not parte:
-                continue
-                
-            caminho_anterior = caminho_atual
-            caminho_atual = f"{caminho_atual}/{parte}" if caminho_atual else parte
-            
-            url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{caminho_atual}"
-            headers = {"Authorization": f"Bearer {token}"}
-            response = requests.get(url, headers=headers)
-            
-            if response.status_code == 404:
-                parent_url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root"
-                if caminho_anterior:
-                    parent_url += f":/{caminho_anterior}"
-                parent_url += ":/children"
-                
-                create_body = {
-                    "name": parte,
-                    "folder": {},
-                    "@microsoft.graph.conflictBehavior": "rename"
-                }
+        if not partes or caminho_completo in obter_cache_pastas():
+            return
+        
+        url = f"{GRAPH_BASE_URL}/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{caminho_completo}"
+        headers = {"Authorization": f"Bearer {token}"}
+        response = obter_cliente_graph().get(url, headers=headers)
+        
+        if response.status_code == 200:
+            registrar_pastas_existentes(partes, len(partes))
+            return
+        if response.status_code != 404:
+            logger.warning(f"Erro ao verificar pasta {caminho_completo}: {response.status_code}")
+            return
+        
+        # Descobre o ancestral existente mais profundo: cache local e, se preciso, um $batch de consultas
+        existentes = 0
+        while existentes < len(partes) - 1 and "/".join(partes[:existentes + 1]) in obter_cache_pastas():
+            existentes += 1
+        
+        if USAR_BATCH_GRAPH:
+            try:
+                pendentes = list(range(existentes + 1, len(partes)))[-20:]
+                status = executar_batch_graph(
+                    [{"id": str(i), "method": "GET", "url": url_relativa_item("/".join(partes[:i]))} for i in pendentes],
+                    token
+                ) if pendentes else {}
+                for i in pendentes:
+                    if status.get(str(i)) != 200:
+                        break
+                    existentes = i
                 
-                create_response = requests.post(
-                    parent_url, 
-                    headers={**headers, "Content-Type": "application/json"}, 
-                    json=create_body
-                )
+                registrar_pastas_existentes(partes, existentes)
+                if criar_pastas_em_lote(partes, existentes, token):
+                    registrar_pastas_existentes(partes, len(partes))
+                    return
                 
-                if create_response.status_code not in [200, 201]:
-                    logger.warning(f"Não foi possível criar pasta {parte}")
+            except Exception as e:
+                logger.warning(f"$batch indisponível, criando pastas uma a uma: {e}")
+        
+        if criar_pastas_sequencial(partes, existentes, token):
+            registrar_pastas_existentes(partes, len(partes))
                     
     except Exception as e:
         logger.warning(f"Erro ao criar estrutura de pastas: {e}")
 
-def upload_onedrive(nome_arquivo, conteudo_arquivo, token, tipo_arquivo="consolidado"):
-    """Faz upload de arquivo para OneDrive"""
+def gerar_xlsx_streaming(dados, nome_aba="Vendas CTs", colunas=None):
+    """
+    Gera o XLSX em modo write-only (memória constante) num arquivo temporário.
+    `dados` é um DataFrame ou um iterável de DataFrames (blocos gravados em sequência,
+    alinhados a `colunas`).
+    """
+    arquivo = tempfile.SpooledTemporaryFile(max_size=LIMITE_XLSX_EM_MEMORIA)
+    
+    if isinstance(dados, pd.DataFrame):
+        colunas = colunas_persistidas(dados)
+        blocos = [dados]
+    else:
+        blocos = dados
+    
+    try:
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(title=nome_aba)
+        
+        cabecalho = []
+        for coluna in colunas:
+            celula = WriteOnlyCell(ws, value=str(coluna))
+            celula.font = Font(bold=True)
+            cabecalho.append(celula)
+        ws.append(cabecalho)
+        
+        # Conversão em blocos: nunca existe uma cópia "object" do frame inteiro
+        for df in blocos:
+            for inicio in range(0, len(df), LINHAS_POR_BLOCO_XLSX):
+                bloco = df.iloc[inicio:inicio + LINHAS_POR_BLOCO_XLSX].reindex(columns=colunas)
+                bloco = bloco.astype(object).where(bloco.notna(), None)
+                for linha in bloco.itertuples(index=False, name=None):
+                    ws.append(linha)
+        
+        wb.save(arquivo)
+        arquivo.seek(0)
+        return arquivo
+        
+    except Exception:
+        arquivo.close()
+        raise
+
+def tamanho_conteudo(conteudo_arquivo):
+    """Tamanho em bytes de um conteúdo em memória (bytes) ou de um arquivo aberto"""
+    if isinstance(conteudo_arquivo, (bytes, bytearray)):
+        return len(conteudo_arquivo)
+    
+    posicao = conteudo_arquivo.tell()
+    conteudo_arquivo.seek(0, os.SEEK_END)
+    tamanho = conteudo_arquivo.tell()
+    conteudo_arquivo.seek(posicao)
+    return tamanho
+
+def ler_intervalo(conteudo_arquivo, inicio, fim):
+    """Lê os bytes [inicio, fim] de bytes ou de um arquivo aberto"""
+    if isinstance(conteudo_arquivo, (bytes, bytearray)):
+        return bytes(conteudo_arquivo[inicio:fim + 1])
+    
+    conteudo_arquivo.seek(inicio)
+    return conteudo_arquivo.read(fim - inicio + 1)
+
+def proximo_intervalo_esperado(resposta_sessao, padrao):
+    """Extrai o início do próximo intervalo esperado de uma sessão de upload"""
+    try:
+        intervalos = resposta_sessao.json().get("nextExpectedRanges") or []
+        if intervalos:
+            inicio, _, fim = intervalos[0].partition("-")
+            return int(inicio), int(fim) if fim else None
+    except ValueError:
+        pass
+    return padrao, None
+
+def upload_em_sessao(caminho_arquivo, conteudo_arquivo, token):
+    """Upload em blocos via sessão de upload, retomando os intervalos pendentes após falhas"""
+    tamanho = tamanho_conteudo(conteudo_arquivo)
+    
+    url = f"{GRAPH_BASE_URL}/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{caminho_arquivo}:/createUploadSession"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    body = {"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+    response = obter_cliente_graph().post(url, headers=headers, json=body)
+    
+    if response.status_code != 200:
+        return False, response.status_code, response.text
+    
+    # A URL da sessão é pré-autenticada: não leva o token
+    upload_url = response.json()["uploadUrl"]
+    inicio, fim_intervalo = 0, None
+    falhas = 0
+    
+    logger.info(f"📤 Sessão de upload criada para {caminho_arquivo} ({tamanho} bytes)")
+    
+    while True:
+        fim = min(inicio + TAMANHO_BLOCO_UPLOAD, tamanho) - 1
+        if fim_intervalo is not None:
+            fim = min(fim, fim_intervalo)
+        bloco = ler_intervalo(conteudo_arquivo, inicio, fim)
+        
+        try:
+            response = obter_cliente_graph().put(upload_url, headers={
+                "Content-Length": str(len(bloco)),
+                "Content-Range": f"bytes {inicio}-{fim}/{tamanho}"
+            }, data=bloco)
+        except requests.RequestException as e:
+            logger.warning(f"Falha de rede no bloco {inicio}-{fim}: {e}")
+            response = None
+        
+        if response is not None and response.status_code in [200, 201]:
+            logger.info(f"✅ Upload em sessão concluído: {caminho_arquivo}")
+            return True, response.status_code, response.text
+        
+        if response is not None and response.status_code == 202:
+            inicio, fim_intervalo = proximo_intervalo_esperado(response, fim + 1)
+            falhas = 0
+            continue
+        
+        if response is not None and response.status_code in [404, 409]:
+            # Sessão expirada ou conflito na finalização: não há o que retomar
+            return False, response.status_code, response.text
+        
+        falhas += 1
+        if falhas > TENTATIVAS_UPLOAD_SESSAO:
+            obter_cliente_graph().delete(upload_url)
+            if response is None:
+                return False, 500, "Erro interno: falhas de rede repetidas no upload em sessão"
+            return False, response.status_code, response.text
+        
+        time.sleep(2 ** (falhas - 1))
+        
+        # Pergunta ao servidor o que já foi recebido e retoma a partir dali
+        try:
+            status_sessao = obter_cliente_graph().get(upload_url)
+        except requests.RequestException:
+            continue
+        
+        if status_sessao.status_code == 404:
+            return False, 404, status_sessao.text
+        if status_sessao.status_code == 200:
+            inicio, fim_intervalo = proximo_intervalo_esperado(status_sessao, inicio)
+            logger.info(f"🔁 Retomando upload a partir do byte {inicio}")
+
+def upload_onedrive(nome_arquivo, conteudo_arquivo, token, tipo_arquivo="consolidado", mover_existente=True):
+    """Faz upload de arquivo para OneDrive (bytes ou arquivo aberto; em blocos se for grande)"""
     try:
         if tipo_arquivo == "consolidado":
             pasta_base = PASTA_CONSOLIDADO
@@ -588,124 +1466,152 @@ def upload_onedrive(nome_arquivo, conteudo_arquivo, token, tipo_arquivo="consoli
         else:
             pasta_base = PASTA_CONSOLIDADO
         
+        armazenamento = obter_armazenamento(token)
         pasta_arquivo = "/".join(nome_arquivo.split("/")[:-1]) if "/" in nome_arquivo else ""
         if pasta_arquivo:
-            criar_pasta_se_nao_existir(f"{pasta_base}/{pasta_arquivo}", token)
+            armazenamento.criar_pasta(f"{pasta_base}/{pasta_arquivo}")
         
-        if tipo_arquivo == "consolidado" and "/" not in nome_arquivo:
-            mover_arquivo_existente(nome_arquivo, token, pasta_base)
+        nome_backup = None
+        if mover_existente and tipo_arquivo == "consolidado" and "/" not in nome_arquivo:
+            nome_backup = mover_arquivo_existente(nome_arquivo, token, pasta_base)
         
-        url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{pasta_base}/{nome_arquivo}:/content"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/octet-stream"
-        }
-        response = requests.put(url, headers=headers, data=conteudo_arquivo)
+        try:
+            response = armazenamento.gravar(f"{pasta_base}/{nome_arquivo}", conteudo_arquivo)
+        except Exception:
+            if nome_backup:
+                restaurar_arquivo_movido(nome_backup, nome_arquivo, token, pasta_base)
+            raise
         
-        return response.status_code in [200, 201], response.status_code, response.text
+        sucesso = response.status_code in [200, 201]
+        if not sucesso and nome_backup:
+            restaurar_arquivo_movido(nome_backup, nome_arquivo, token, pasta_base)
+        
+        return sucesso, response.status_code, response.text
         
     except Exception as e:
         logger.error(f"Erro no upload: {e}")
         return False, 500, f"Erro interno: {str(e)}"
 
 def mover_arquivo_existente(nome_arquivo, token, pasta_base=None):
-    """Move arquivo existente para backup antes de substituir"""
+    """Move arquivo existente para backup antes de substituir. Retorna o nome do backup (None se não houve)"""
     try:
         if pasta_base is None:
             pasta_base = PASTA_CONSOLIDADO
             
-        url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{pasta_base}/{nome_arquivo}"
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.get(url, headers=headers)
+        timestamp = datetime.now().strftime("%Y-%m-%d_%Hh%M")
+        nome_base = nome_arquivo.replace(".xlsx", "")
+        novo_nome = f"{nome_base}_backup_{timestamp}.xlsx"
         
-        if response.status_code == 200:
-            file_id = response.json().get("id")
-            timestamp = datetime.now().strftime("%Y-%m-%d_%Hh%M")
-            nome_base = nome_arquivo.replace(".xlsx", "")
-            novo_nome = f"{nome_base}_backup_{timestamp}.xlsx"
-            
-            patch_url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/items/{file_id}"
-            patch_body = {"name": novo_nome}
-            patch_headers = {
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            }
-            patch_response = requests.patch(patch_url, headers=patch_headers, json=patch_body)
-            
-            if patch_response.status_code in [200, 201]:
-                st.info(f"💾 Backup criado: {novo_nome}")
-            else:
-                st.warning(f"⚠️ Não foi possível criar backup do arquivo existente")
+        response = obter_armazenamento(token).renomear(f"{pasta_base}/{nome_arquivo}", novo_nome)
+        
+        if response.status_code in [200, 201]:
+            st.info(f"💾 Backup criado: {novo_nome}")
+            return novo_nome
+        elif response.status_code != 404:
+            st.warning(f"⚠️ Não foi possível criar backup do arquivo existente")
                 
     except Exception as e:
         st.warning(f"⚠️ Erro ao processar backup: {str(e)}")
         logger.error(f"Erro no backup: {e}")
+    
+    return None
+
+def restaurar_arquivo_movido(nome_backup, nome_arquivo, token, pasta_base=None):
+    """Devolve ao nome original um arquivo movido para backup cuja substituição falhou"""
+    if pasta_base is None:
+        pasta_base = PASTA_CONSOLIDADO
+    
+    try:
+        response = obter_armazenamento(token).renomear(f"{pasta_base}/{nome_backup}", nome_arquivo)
+        if response.status_code in [200, 201]:
+            logger.info(f"↩️ {nome_backup} restaurado como {nome_arquivo}")
+            return True
+        logger.error(f"❌ Não foi possível restaurar {nome_backup}: {response.status_code}")
+    except Exception as e:
+        logger.error(f"❌ Erro ao restaurar {nome_backup}: {e}")
+    
+    st.error(f"❌ O consolidado anterior ficou salvo como `{nome_backup}` e precisa ser restaurado manualmente")
+    return False
 
 # ===========================
 # VALIDAÇÃO DE DATAS
 # ===========================
 def validar_datas_detalhadamente(df):
-    """Validação detalhada de datas"""
-    problemas = []
-    
+    """Validação detalhada de datas (vetorizada sobre a coluna DATA)"""
     logger.info(f"🔍 Iniciando validação detalhada de {len(df)} registros...")
     
-    for idx, row in df.iterrows():
-        linha_excel = idx + 2
-        valor_original = row["DATA"]
-        responsavel = row.get("RESPONSÁVEL", "N/A")
-        
-        problema_encontrado = None
-        tipo_problema = None
-        
-        if pd.isna(valor_original) or str(valor_original).strip() == "":
-            problema_encontrado = "Data vazia ou nula"
-            tipo_problema = "VAZIO"
-        else:
+    valores = df["DATA"]
+    responsaveis = df["RESPONSÁVEL"] if "RESPONSÁVEL" in df.columns else pd.Series("N/A", index=df.index)
+    hoje = pd.Timestamp(datetime.now())
+    
+    # Uma única conversão da coluna inteira; cada célula é interpretada individualmente
+    if pd.api.types.is_datetime64_any_dtype(valores):
+        mask_vazio = valores.isna()
+        datas = valores
+    else:
+        mask_vazio = valores.isna() | (valores.astype(str).str.strip() == "")
+        datas = pd.to_datetime(valores.where(~mask_vazio), errors="coerce", format="mixed")
+    
+    mask_falha = datas.isna() & ~mask_vazio
+    mask_impossivel = pd.Series(False, index=df.index)
+    if mask_falha.any():
+        # Apenas os valores que falharam são reinterpretados, uma vez por valor distinto,
+        # para separar datas impossíveis (31/02) de formatos inválidos
+        mensagens = {}
+        for valor in pd.unique(valores[mask_falha]):
             try:
-                data_convertida = pd.to_datetime(valor_original, errors='raise')
-                hoje = datetime.now()
-                
-                if data_convertida > hoje + pd.Timedelta(days=730):
-                    problema_encontrado = f"Data muito distante no futuro: {data_convertida.strftime('%d/%m/%Y')}"
-                    tipo_problema = "FUTURO"
-                elif data_convertida < pd.Timestamp('2020-01-01'):
-                    problema_encontrado = f"Data muito antiga: {data_convertida.strftime('%d/%m/%Y')}"
-                    tipo_problema = "ANTIGA"
-                elif data_convertida > hoje:
-                    problema_encontrado = f"Data no futuro: {data_convertida.strftime('%d/%m/%Y')}"
-                    tipo_problema = "FUTURO"
-                    
+                pd.to_datetime(valor, errors="raise")
+                mensagens[valor] = False
             except (ValueError, TypeError, pd.errors.OutOfBoundsDatetime) as e:
-                if "day is out of range for month" in str(e) or "month must be in 1..12" in str(e):
-                    problema_encontrado = f"Data impossível: {valor_original}"
-                    tipo_problema = "IMPOSSÍVEL"
-                else:
-                    problema_encontrado = f"Formato inválido: {valor_original}"
-                    tipo_problema = "FORMATO"
-        
-        if problema_encontrado:
-            problemas.append({
-                "Linha Excel": linha_excel,
-                "Responsável": responsavel,
-                "Valor Original": valor_original,
-                "Problema": problema_encontrado,
-                "Tipo Problema": tipo_problema
-            })
-            
-            logger.warning(f"❌ Linha {linha_excel}: {problema_encontrado} (Responsável: {responsavel})")
+                mensagens[valor] = "day is out of range for month" in str(e) or "month must be in 1..12" in str(e)
+        mask_impossivel = mask_falha & valores.map(mensagens).fillna(False).astype(bool)
+    mask_formato = mask_falha & ~mask_impossivel
     
-    if problemas:
-        logger.error(f"❌ TOTAL DE PROBLEMAS ENCONTRADOS: {len(problemas)}")
-        
-        tipos_problema = {}
-        for problema in problemas:
-            tipo = problema["Tipo Problema"]
-            tipos_problema[tipo] = tipos_problema.get(tipo, 0) + 1
-        
-        logger.error(f"📊 Problemas por tipo: {tipos_problema}")
-    else:
+    mask_futuro_distante = datas > hoje + pd.Timedelta(days=730)
+    mask_antiga = datas < pd.Timestamp('2020-01-01')
+    mask_futuro = (datas > hoje) & ~mask_futuro_distante
+    
+    mask_problema = mask_vazio | mask_falha | mask_futuro_distante | mask_antiga | mask_futuro
+    if not mask_problema.any():
         logger.info("✅ Todas as datas estão válidas!")
+        return []
+    
+    texto_original = valores[mask_problema].astype(str)
+    texto_data = datas[mask_problema].dt.strftime('%d/%m/%Y')
+    
+    problema = pd.Series("", index=texto_original.index, dtype=object)
+    tipo = pd.Series("", index=texto_original.index, dtype=object)
+    
+    # Classificação na mesma precedência da validação linha a linha
+    for mascara, tipo_problema, mensagem in (
+        (mask_futuro, "FUTURO", "Data no futuro: " + texto_data),
+        (mask_antiga, "ANTIGA", "Data muito antiga: " + texto_data),
+        (mask_futuro_distante, "FUTURO", "Data muito distante no futuro: " + texto_data),
+        (mask_formato, "FORMATO", "Formato inválido: " + texto_original),
+        (mask_impossivel, "IMPOSSÍVEL", "Data impossível: " + texto_original),
+        (mask_vazio, "VAZIO", pd.Series("Data vazia ou nula", index=texto_original.index)),
+    ):
+        selecao = mascara[mask_problema]
+        problema[selecao] = mensagem[selecao]
+        tipo[selecao] = tipo_problema
+    
+    problemas = pd.DataFrame({
+        "Linha Excel": df.index[mask_problema] + 2,
+        "Responsável": responsaveis[mask_problema].to_numpy(),
+        "Valor Original": valores[mask_problema].to_numpy(dtype=object),
+        "Problema": problema.to_numpy(),
+        "Tipo Problema": tipo.to_numpy()
+    }).to_dict("records")
+    
+    tipos_problema = tipo.value_counts().to_dict()
+    
+    for registro in problemas[:20]:
+        logger.warning(f"❌ Linha {registro['Linha Excel']}: {registro['Problema']} (Responsável: {registro['Responsável']})")
+    if len(problemas) > 20:
+        logger.warning(f"❌ ... e mais {len(problemas) - 20} linhas com problemas de data")
+    
+    logger.error(f"❌ TOTAL DE PROBLEMAS ENCONTRADOS: {len(problemas)}")
+    logger.error(f"📊 Problemas por tipo: {tipos_problema}")
     
     return problemas
 
@@ -805,41 +1711,681 @@ def validar_dados_enviados(df):
             avisos.append("✅ Todas as datas estão válidas e consistentes!")
     
     if not df.empty and "DATA" in df.columns:
-        df_temp = df.copy()
-        df_temp["DATA"] = pd.to_datetime(df_temp["DATA"], errors="coerce")
-        df_temp = df_temp.dropna(subset=["DATA"])
+        datas = pd.to_datetime(df["DATA"], errors="coerce").dropna()
         
-        if not df_temp.empty:
-            duplicatas = df_temp.duplicated(subset=["DATA"], keep=False).sum()
+        if not datas.empty:
+            duplicatas = datas.duplicated(keep=False).sum()
             if duplicatas > 0:
                 avisos.append(f"⚠️ {duplicatas} linhas com datas duplicadas na planilha")
     
     return erros, avisos, linhas_invalidas_detalhes
 
+def pre_validar_planilha(conteudo, sheet, limite=LIMITE_PROBLEMAS_PRE_VALIDACAO, linhas_amostra=LINHAS_AMOSTRA_PRE_VALIDACAO):
+    """
+    Pré-validação em streaming (openpyxl read-only): confere o cabeçalho e as colunas
+    DATA/RESPONSÁVEL de uma amostra das primeiras `linhas_amostra` linhas. Rejeita se faltar
+    coluna ou se a amostra tiver `limite` problemas de data; o custo não cresce com o arquivo,
+    e a validação completa continua sendo feita sobre a leitura completa.
+    Retorna (erros, problemas_datas); sem erros, a leitura completa pode prosseguir.
+    """
+    wb = load_workbook(BytesIO(conteudo), read_only=True, data_only=True)
+    
+    try:
+        linhas = wb[sheet].iter_rows(values_only=True)
+        cabecalho = next(linhas, None)
+        
+        if cabecalho is None:
+            return ["❌ A planilha está vazia"], []
+        
+        colunas = [str(c).strip().upper() if c is not None else "" for c in cabecalho]
+        erros = []
+        if "RESPONSÁVEL" not in colunas:
+            erros.append("⚠️ A planilha deve conter uma coluna 'RESPONSÁVEL'")
+        if "DATA" not in colunas:
+            erros.append("⚠️ A planilha deve conter uma coluna 'DATA'")
+        if erros:
+            return erros, []
+        
+        idx_data = colunas.index("DATA")
+        idx_responsavel = colunas.index("RESPONSÁVEL")
+        
+        indices, datas, responsaveis = [], [], []
+        vazias_pendentes = []
+        
+        for idx, linha in enumerate(linhas):
+            if idx >= linhas_amostra:
+                break
+            
+            # Linhas totalmente vazias só contam se houver dados depois (como no read_excel)
+            if all(valor is None or (isinstance(valor, str) and valor == "") for valor in linha):
+                vazias_pendentes.append(idx)
+                continue
+            
+            for idx_vazia in vazias_pendentes:
+                indices.append(idx_vazia)
+                datas.append(None)
+                responsaveis.append(None)
+            vazias_pendentes.clear()
+            
+            indices.append(idx)
+            datas.append(linha[idx_data] if idx_data < len(linha) else None)
+            responsaveis.append(linha[idx_responsavel] if idx_responsavel < len(linha) else None)
+        
+        if not indices:
+            return [], []
+        
+        amostra = pd.DataFrame({"DATA": datas, "RESPONSÁVEL": responsaveis}, index=pd.Index(indices), dtype=object)
+        problemas = validar_datas_detalhadamente(amostra)
+        
+        if len(problemas) >= limite:
+            return [
+                f"❌ Pelo menos {limite} problemas de data nas primeiras {len(indices)} linhas - CONSOLIDAÇÃO BLOQUEADA",
+                "⏱️ A verificação foi interrompida nas primeiras ocorrências; corrija-as e envie novamente",
+                "🔧 É OBRIGATÓRIO corrigir TODOS os problemas antes de enviar"
+            ], problemas[:limite]
+        
+        return [], []
+        
+    finally:
+        wb.close()
+
+# ===========================
+# SCHEMA E TIPOS COMPACTOS
+# ===========================
+def compactar_numerico(serie):
+    """Menor tipo numérico que representa a série sem perda de valor"""
+    if pd.api.types.is_bool_dtype(serie) or not pd.api.types.is_numeric_dtype(serie):
+        return serie
+    
+    if pd.api.types.is_integer_dtype(serie):
+        return pd.to_numeric(serie, downcast="integer")
+    
+    valores = serie.to_numpy(dtype="float64", na_value=np.nan)
+    finitos = np.isfinite(valores)
+    
+    # Floats inteiros e completos (ex.: contagens lidas como 1.0) viram inteiros
+    if finitos.all() and len(valores) and np.array_equal(valores, np.round(valores)) \
+            and np.abs(valores).max() < 2 ** 53:
+        return pd.to_numeric(serie.astype("int64"), downcast="integer")
+    
+    # float32 somente se a ida e volta preservar todos os valores
+    reduzida = valores.astype("float32")
+    if np.array_equal(reduzida.astype("float64"), valores, equal_nan=True):
+        return pd.Series(reduzida, index=serie.index, name=serie.name)
+    
+    return serie
+
+def aplicar_schema(df, converter_datas=True):
+    """
+    Aplica SCHEMA_VENDAS_CTS: DATA em datetime64, RESPONSÁVEL em category e KPIs
+    no menor tipo numérico. Colunas que não se encaixam no tipo declarado ficam como
+    estão e são reportadas. Retorna (df, divergencias).
+    """
+    df = df.copy(deep=False)
+    divergencias = []
+    
+    for coluna, definicao in SCHEMA_VENDAS_CTS.items():
+        if coluna not in df.columns:
+            if definicao["obrigatoria"] and not df.empty:
+                divergencias.append(f"Coluna esperada ausente: '{coluna}'")
+            continue
+        
+        serie = df[coluna]
+        tipo = definicao["tipo"]
+        
+        if tipo == "data":
+            if not converter_datas or pd.api.types.is_datetime64_any_dtype(serie):
+                continue
+            convertida = pd.to_datetime(serie, format="mixed", errors="coerce")
+            invalidos = int((convertida.isna() & serie.notna()).sum())
+            if invalidos:
+                divergencias.append(f"'{coluna}': {invalidos} valor(es) que não são datas - coluna mantida sem conversão")
+                continue
+            df[coluna] = convertida
+        
+        elif tipo == "categoria":
+            if isinstance(serie.dtype, pd.CategoricalDtype):
+                continue
+            tipo_inferido = pd.api.types.infer_dtype(serie, skipna=True)
+            if tipo_inferido not in ("string", "empty"):
+                divergencias.append(f"'{coluna}': esperado texto, encontrado '{tipo_inferido}' - coluna mantida sem conversão")
+                continue
+            df[coluna] = serie.astype("category")
+        
+        elif tipo == "numero":
+            if not pd.api.types.is_numeric_dtype(serie) or pd.api.types.is_bool_dtype(serie):
+                convertida = pd.to_numeric(serie, errors="coerce")
+                invalidos = int((convertida.isna() & serie.notna()).sum())
+                if invalidos:
+                    divergencias.append(f"'{coluna}': {invalidos} valor(es) não numérico(s) - coluna mantida sem conversão")
+                    continue
+                serie = convertida
+            df[coluna] = compactar_numerico(serie)
+    
+    if "RESPONSÁVEL" in df.columns:
+        df[COLUNA_CHAVE_RESPONSAVEL] = chave_responsavel(df["RESPONSÁVEL"])
+    
+    for coluna in df.columns:
+        if coluna in SCHEMA_VENDAS_CTS or coluna == COLUNA_CHAVE_RESPONSAVEL:
+            continue
+        divergencias.append(f"Coluna fora do schema: '{coluna}'")
+        if USAR_STRINGS_ARROW and df[coluna].dtype == object and pd.api.types.infer_dtype(df[coluna], skipna=True) == "string":
+            df[coluna] = df[coluna].astype("string[pyarrow]")
+    
+    return df, divergencias
+
+def chave_responsavel(serie):
+    """Chave normalizada (strip + upper) do RESPONSÁVEL como category; vazios ficam NaN"""
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        # Normaliza só as categorias distintas e remapeia os códigos (grafias iguais se fundem)
+        normalizadas = pd.Index(serie.cat.categories.astype(str).str.strip().str.upper())
+        categorias = normalizadas.unique()
+        codigos = np.append(categorias.get_indexer(normalizadas), -1)
+        return pd.Series(
+            pd.Categorical.from_codes(codigos[serie.cat.codes.to_numpy()], categories=categorias),
+            index=serie.index, name=COLUNA_CHAVE_RESPONSAVEL
+        )
+    
+    chave = serie.astype(str).str.strip().str.upper().where(serie.notna())
+    return chave.astype("category").rename(COLUNA_CHAVE_RESPONSAVEL)
+
+def obter_chave_responsavel(df):
+    """Chave normalizada já calculada no frame (ou calculada agora, se ausente)"""
+    if COLUNA_CHAVE_RESPONSAVEL in df.columns:
+        return df[COLUNA_CHAVE_RESPONSAVEL]
+    return chave_responsavel(df["RESPONSÁVEL"])
+
+def responsaveis_normalizados(df):
+    """Conjunto de responsáveis (normalizados) presentes no frame"""
+    if df.empty or "RESPONSÁVEL" not in df.columns:
+        return set()
+    return set(obter_chave_responsavel(df).dropna().unique())
+
+def colunas_persistidas(df):
+    """Colunas gravadas em disco/drive (exclui as colunas internas)"""
+    return [coluna for coluna in df.columns if coluna != COLUNA_CHAVE_RESPONSAVEL]
+
+def registrar_divergencias_schema(divergencias, origem):
+    """Registra no log as divergências de schema encontradas em uma leitura"""
+    for divergencia in divergencias:
+        logger.warning(f"📐 Schema ({origem}): {divergencia}")
+
+# ===========================
+# MONITORAMENTO E ORÇAMENTO DE MEMÓRIA
+# ===========================
+def rss_atual_mb():
+    """RSS atual do processo em MB (lido de /proc; 0 onde não houver /proc)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+class MonitorMemoria:
+    """Pico de RSS por etapa da consolidação, amostrado por uma thread em segundo plano"""
+    
+    def __init__(self, intervalo=INTERVALO_AMOSTRAGEM_MEMORIA_SEGUNDOS):
+        self.intervalo = intervalo
+        self.picos = {}
+        self.etapa_atual = None
+        self._trava = threading.Lock()
+        self._parar = threading.Event()
+        self._thread = None
+    
+    def iniciar(self):
+        """Começa a amostragem (uma thread daemon por consolidação)"""
+        self._thread = threading.Thread(target=self._executar, name="monitor-memoria", daemon=True)
+        self._thread.start()
+        return self
+    
+    def etapa(self, nome):
+        """Encerra a etapa atual e passa a atribuir as amostras à etapa `nome`"""
+        self._amostrar()
+        with self._trava:
+            self.etapa_atual = nome
+        self._amostrar()
+    
+    def _amostrar(self):
+        rss = rss_atual_mb()
+        with self._trava:
+            if self.etapa_atual is not None:
+                self.picos[self.etapa_atual] = max(self.picos.get(self.etapa_atual, 0.0), rss)
+    
+    def _executar(self):
+        while not self._parar.wait(self.intervalo):
+            self._amostrar()
+    
+    def finalizar(self):
+        """Para a amostragem e retorna {etapa: pico de RSS em MB}"""
+        self._amostrar()
+        self._parar.set()
+        if self._thread is not None:
+            self._thread.join()
+        
+        with self._trava:
+            picos = dict(self.picos)
+        
+        if picos:
+            resumo = ", ".join(f"{etapa}: {pico:.0f} MB" for etapa, pico in picos.items())
+            logger.info(f"🧠 Pico de memória por etapa: {resumo}")
+        return picos
+
+# Métricas da consolidação em andamento, visíveis ao cliente Graph da mesma thread
+_METRICAS_DA_THREAD = threading.local()
+
+def metricas_ativas():
+    """Métricas da consolidação em andamento nesta thread (None fora de uma consolidação)"""
+    return getattr(_METRICAS_DA_THREAD, "metricas", None)
+
+def ativar_metricas(metricas):
+    """Associa (ou, com None, desassocia) as métricas à thread atual"""
+    _METRICAS_DA_THREAD.metricas = metricas
+
+class MetricasConsolidacao:
+    """
+    Spans por etapa da consolidação: tempo de parede, chamadas e bytes trafegados na API Graph,
+    linhas de entrada/saída e pico de memória (via MonitorMemoria).
+    Cada chamada Graph é atribuída à etapa aberta quando ela termina.
+    """
+    
+    def __init__(self, session_id, nome_arquivo):
+        self.session_id = session_id
+        self.nome_arquivo = nome_arquivo
+        self.inicio = datetime.now()
+        self.etapas = {}
+        self.chamadas_graph = []
+        self.chamadas_omitidas = 0
+        self.etapa_atual = None
+        self._t0 = None
+        self._inicio_etapa = None
+        self._trava = threading.Lock()
+        self.monitor = MonitorMemoria()
+    
+    def iniciar(self):
+        """Começa a contagem e associa as métricas à thread atual"""
+        self._t0 = time.perf_counter()
+        self.monitor.iniciar()
+        ativar_metricas(self)
+        return self
+    
+    def _span(self, nome):
+        return self.etapas.setdefault(nome, {
+            "segundos": 0.0, "linhas_entrada": None, "linhas_saida": None,
+            "chamadas_graph": 0, "segundos_graph": 0.0, "bytes_enviados": 0, "bytes_recebidos": 0,
+            "pico_memoria_mb": None,
+        })
+    
+    def _fechar_etapa(self, agora):
+        if self.etapa_atual is not None:
+            self.etapas[self.etapa_atual]["segundos"] += agora - self._inicio_etapa
+    
+    def etapa(self, nome, linhas_entrada=None):
+        """Encerra a etapa atual e abre a etapa `nome`"""
+        agora = time.perf_counter()
+        with self._trava:
+            self._fechar_etapa(agora)
+            self.etapa_atual = nome
+            self._inicio_etapa = agora
+            if linhas_entrada is not None:
+                self._span(nome)["linhas_entrada"] = int(linhas_entrada)
+            else:
+                self._span(nome)
+        self.monitor.etapa(nome)
+    
+    def linhas(self, entrada=None, saida=None):
+        """Registra as linhas de entrada/saída da etapa atual"""
+        with self._trava:
+            if self.etapa_atual is None:
+                return
+            span = self._span(self.etapa_atual)
+            if entrada is not None:
+                span["linhas_entrada"] = int(entrada)
+            if saida is not None:
+                span["linhas_saida"] = int(saida)
+    
+    def registrar_chamada_graph(self, metodo, url, status_code, segundos, bytes_enviados, bytes_recebidos):
+        """Soma uma chamada à API Graph (com as novas tentativas) na etapa atual"""
+        caminho = url.split("?", 1)[0]
+        if caminho.startswith(GRAPH_BASE_URL):
+            caminho = caminho[len(GRAPH_BASE_URL):]
+        
+        with self._trava:
+            span = self._span(self.etapa_atual or "FORA_DE_ETAPA")
+            span["chamadas_graph"] += 1
+            span["segundos_graph"] += segundos
+            span["bytes_enviados"] += bytes_enviados
+            span["bytes_recebidos"] += bytes_recebidos
+            
+            if len(self.chamadas_graph) < LIMITE_CHAMADAS_GRAPH_METRICAS:
+                self.chamadas_graph.append({
+                    "etapa": self.etapa_atual, "metodo": metodo, "caminho": caminho, "status": status_code,
+                    "segundos": round(segundos, 3), "bytes_enviados": bytes_enviados, "bytes_recebidos": bytes_recebidos,
+                })
+            else:
+                self.chamadas_omitidas += 1
+    
+    def resumo_texto(self):
+        """Resumo compacto (tempo por etapa até agora) para o `detalhes` do lock"""
+        agora = time.perf_counter()
+        with self._trava:
+            partes = []
+            for nome, span in self.etapas.items():
+                segundos = span["segundos"] + (agora - self._inicio_etapa if nome == self.etapa_atual else 0)
+                partes.append(f"{nome} {segundos:.1f}s")
+        return ", ".join(partes)
+    
+    def finalizar(self, sucesso):
+        """Encerra a contagem, desassocia da thread e retorna o registro de métricas (dict serializável em JSON)"""
+        agora = time.perf_counter()
+        with self._trava:
+            self._fechar_etapa(agora)
+            self.etapa_atual = None
+        picos = self.monitor.finalizar()
+        ativar_metricas(None)
+        
+        etapas = []
+        for nome, span in self.etapas.items():
+            span = dict(span, segundos=round(span["segundos"], 3), segundos_graph=round(span["segundos_graph"], 3))
+            if nome in picos:
+                span["pico_memoria_mb"] = round(picos[nome], 1)
+            etapas.append({"etapa": nome, **span})
+        
+        registro = {
+            "sessao": self.session_id,
+            "arquivo": self.nome_arquivo,
+            "modo_armazenamento": MODO_ARMAZENAMENTO,
+            "inicio": self.inicio.isoformat(),
+            "fim": datetime.now().isoformat(),
+            "sucesso": bool(sucesso),
+            "segundos_totais": round(agora - self._t0, 3),
+            "etapas": etapas,
+            "chamadas_graph": self.chamadas_graph,
+            "chamadas_graph_omitidas": self.chamadas_omitidas,
+        }
+        
+        if etapas:
+            dominante = max(etapas, key=lambda e: e["segundos"])
+            logger.info(
+                f"⏱️ Consolidação em {registro['segundos_totais']:.1f}s; etapa dominante: "
+                f"{dominante['etapa']} ({dominante['segundos']:.1f}s, {dominante['chamadas_graph']} chamada(s) Graph)"
+            )
+        return registro
+
+def salvar_metricas_consolidacao(registro, token):
+    """Grava o registro de métricas em JSON na pasta de métricas dos backups"""
+    try:
+        nome_base = registro["arquivo"].replace(".xlsx", "").replace(".xls", "")
+        nome_metricas = f"{PASTA_METRICAS}/{nome_base}_metricas_{datetime.now().strftime('%Y-%m-%d_%Hh%M%S')}.json"
+        conteudo = json.dumps(registro, ensure_ascii=False, indent=2).encode("utf-8")
+        
+        sucesso, status_code, _ = upload_onedrive(nome_metricas, conteudo, token, "backup")
+        if sucesso:
+            logger.info(f"⏱️ Métricas da consolidação salvas: {nome_metricas}")
+        else:
+            logger.warning(f"⚠️ Não foi possível salvar as métricas da consolidação: {status_code}")
+        return sucesso
+        
+    except Exception as e:
+        logger.error(f"Erro ao salvar métricas da consolidação: {e}")
+        return False
+
+def memoria_frames_mb(*frames):
+    """Memória ocupada pelos frames (MB)"""
+    return sum(df.memory_usage(deep=True).sum() for df in frames if df is not None) / (1024 * 1024)
+
+def excede_orcamento_memoria(tamanho_mb):
+    """
+    True se o pico estimado para ordenar e serializar `tamanho_mb` de dados passar de ORCAMENTO_MEMORIA_MB
+    (as etapas anteriores já foram feitas com o frame inteiro; só a gravação passa a ser em blocos)
+    """
+    if ORCAMENTO_MEMORIA_MB <= 0:
+        return False
+    
+    estimativa = rss_atual_mb() + FATOR_PICO_MEMORIA * tamanho_mb
+    if estimativa > ORCAMENTO_MEMORIA_MB:
+        logger.warning(f"🧠 Pico estimado de {estimativa:.0f} MB excede o orçamento de {ORCAMENTO_MEMORIA_MB} MB - processando em blocos mensais")
+        return True
+    return False
+
+def blocos_mensais_ordenados(df):
+    """
+    Gera o frame em blocos mensais, cada um ordenado por DATA + RESPONSÁVEL.
+    A concatenação dos blocos tem a mesma ordem de um sort_values do frame inteiro,
+    mas só um mês é copiado por vez.
+    """
+    periodos = df["DATA"].dt.to_period("M")
+    for _, bloco in df.groupby(periodos, sort=True, dropna=False):
+        yield bloco.sort_values(["DATA", "RESPONSÁVEL"], na_position='last')
+
+# ===========================
+# PERFILAMENTO OPCIONAL (cProfile + tracemalloc)
+# ===========================
+# cProfile (3.12+) e tracemalloc são globais ao processo: um perfilamento por vez
+_TRAVA_PERFILAMENTO = threading.Lock()
+
+def perfilamento_ativo():
+    """Perfilamento ligado por variável de ambiente ou por ?perfilar=<CHAVE_PERFILAMENTO> na URL"""
+    if PERFILAMENTO_HABILITADO:
+        return True
+    if not CHAVE_PERFILAMENTO:
+        return False
+    try:
+        valor = st.query_params.get(PARAMETRO_PERFILAMENTO)
+        return isinstance(valor, str) and hmac.compare_digest(valor.encode("utf-8"), CHAVE_PERFILAMENTO.encode("utf-8"))
+    except Exception:
+        return False
+
+def funcoes_mais_custosas(profiler, top=TOP_PERFILAMENTO):
+    """Top-N funções por tempo acumulado"""
+    estatisticas = pstats.Stats(profiler).stats
+    linhas = [
+        {
+            "Função": f"{os.path.basename(arquivo)}:{linha}({funcao})",
+            "Chamadas": chamadas,
+            "Tempo Próprio (s)": round(tempo_proprio, 4),
+            "Tempo Acumulado (s)": round(tempo_acumulado, 4),
+        }
+        for (arquivo, linha, funcao), (_, chamadas, tempo_proprio, tempo_acumulado, _) in estatisticas.items()
+    ]
+    linhas.sort(key=lambda l: l["Tempo Acumulado (s)"], reverse=True)
+    return pd.DataFrame(linhas[:top])
+
+def alocacoes_mais_custosas(snapshot, top=TOP_PERFILAMENTO):
+    """Top-N linhas de código por memória alocada e ainda viva ao fim da execução"""
+    return pd.DataFrame([
+        {
+            "Local": f"{os.path.basename(estatistica.traceback[0].filename)}:{estatistica.traceback[0].lineno}",
+            "Tamanho (KB)": round(estatistica.size / 1024, 1),
+            "Blocos": estatistica.count,
+        }
+        for estatistica in snapshot.statistics("lineno")[:top]
+    ])
+
+def executar_com_perfil(nome, funcao, *args, **kwargs):
+    """
+    Executa `funcao` sob cProfile + tracemalloc quando o perfilamento está ativo; senão, chama direto.
+    Grava o .pstats e as principais alocações em PASTA_PERFIS (sessão + timestamp no nome) e guarda
+    o relatório em st.session_state para o painel de administração. O cProfile mede só a thread que chama.
+    """
+    if not perfilamento_ativo():
+        return funcao(*args, **kwargs)
+    
+    if not _TRAVA_PERFILAMENTO.acquire(blocking=False):
+        logger.warning(f"🧪 Outro perfilamento em andamento; '{nome}' executado sem perfil")
+        return funcao(*args, **kwargs)
+    
+    try:
+        profiler = cProfile.Profile()
+        ja_rastreando = tracemalloc.is_tracing()
+        if not ja_rastreando:
+            tracemalloc.start()
+        inicio = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                profiler.disable()
+        finally:
+            segundos = time.perf_counter() - inicio
+            snapshot = tracemalloc.take_snapshot()
+            _, pico = tracemalloc.get_traced_memory()
+            if not ja_rastreando:
+                tracemalloc.stop()
+            registrar_perfil(nome, profiler, snapshot, segundos, pico)
+    finally:
+        _TRAVA_PERFILAMENTO.release()
+
+def registrar_perfil(nome, profiler, snapshot, segundos, pico_bytes):
+    """Grava os arquivos do perfil e guarda o relatório compacto na sessão"""
+    try:
+        prefixo = os.path.join(PASTA_PERFIS, f"{nome}_{gerar_id_sessao()}_{datetime.now().strftime('%Y-%m-%d_%Hh%M%S')}")
+        os.makedirs(PASTA_PERFIS, exist_ok=True)
+        
+        profiler.dump_stats(f"{prefixo}.pstats")
+        alocacoes = alocacoes_mais_custosas(snapshot)
+        with open(f"{prefixo}_alocacoes.txt", "w", encoding="utf-8") as f:
+            f.write(f"Pico rastreado: {pico_bytes / (1024 * 1024):.1f} MB\n")
+            for estatistica in snapshot.statistics("lineno")[:TOP_PERFILAMENTO]:
+                f.write(f"{estatistica}\n")
+        
+        perfis = st.session_state.setdefault("perfis", [])
+        perfis.append({
+            "nome": nome,
+            "executado_em": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            "segundos": segundos,
+            "pico_mb": pico_bytes / (1024 * 1024),
+            "arquivo": f"{prefixo}.pstats",
+            "funcoes": funcoes_mais_custosas(profiler),
+            "alocacoes": alocacoes,
+        })
+        del perfis[:-LIMITE_PERFIS_SESSAO]
+        logger.info(f"🧪 Perfil de '{nome}' salvo em {prefixo}.pstats ({segundos:.1f}s, pico {pico_bytes / (1024 * 1024):.0f} MB)")
+        
+    except Exception as e:
+        logger.error(f"Erro ao gravar perfil de '{nome}': {e}")
+
+# ===========================
+# CACHE LOCAL DO CONSOLIDADO (PARQUET + eTag)
+# ===========================
+def carregar_cache_consolidado():
+    """Carrega o último consolidado salvo localmente e seus metadados (eTag/cTag)"""
+    caminho_dados = os.path.join(PASTA_CACHE_LOCAL, ARQUIVO_CACHE_CONSOLIDADO)
+    caminho_meta = os.path.join(PASTA_CACHE_LOCAL, ARQUIVO_CACHE_META)
+    
+    try:
+        if not (os.path.exists(caminho_dados) and os.path.exists(caminho_meta)):
+            return None, None
+        
+        with open(caminho_meta, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        
+        df_cache = pd.read_parquet(caminho_dados)
+        return df_cache, meta
+        
+    except Exception as e:
+        logger.warning(f"Cache local do consolidado ilegível, será ignorado: {e}")
+        invalidar_cache_consolidado()
+        return None, None
+
+def salvar_cache_consolidado(df_consolidado, etag, ctag=None):
+    """Salva o consolidado em Parquet, associado ao eTag/cTag do arquivo remoto"""
+    if not etag:
+        invalidar_cache_consolidado()
+        return False
+    
+    try:
+        os.makedirs(PASTA_CACHE_LOCAL, exist_ok=True)
+        caminho_dados = os.path.join(PASTA_CACHE_LOCAL, ARQUIVO_CACHE_CONSOLIDADO)
+        caminho_meta = os.path.join(PASTA_CACHE_LOCAL, ARQUIVO_CACHE_META)
+        
+        # Escrita atômica: outros processos nunca leem um arquivo pela metade
+        sufixo_tmp = f".{os.getpid()}.tmp"
+        df_consolidado[colunas_persistidas(df_consolidado)].to_parquet(caminho_dados + sufixo_tmp, index=False)
+        with open(caminho_meta + sufixo_tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "etag": etag,
+                "ctag": ctag,
+                "registros": len(df_consolidado),
+                "salvo_em": datetime.now().isoformat()
+            }, f)
+        
+        # Metadados por último: um eTag só aponta para dados já gravados
+        invalidar_cache_consolidado()
+        os.replace(caminho_dados + sufixo_tmp, caminho_dados)
+        os.replace(caminho_meta + sufixo_tmp, caminho_meta)
+        
+        logger.info(f"💾 Cache local do consolidado atualizado ({len(df_consolidado)} registros, eTag {etag})")
+        return True
+        
+    except Exception as e:
+        logger.warning(f"Não foi possível salvar o cache local do consolidado: {e}")
+        invalidar_cache_consolidado()
+        return False
+
+def invalidar_cache_consolidado():
+    """Remove os metadados do cache local, forçando novo download"""
+    try:
+        os.remove(os.path.join(PASTA_CACHE_LOCAL, ARQUIVO_CACHE_META))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Erro ao invalidar cache local: {e}")
+
+def etag_da_resposta(response):
+    """eTag da versão entregue num download (cabeçalho ETag), sem consultar os metadados em separado"""
+    return response.headers.get("ETag")
+
+def obter_tags_item(token, caminho_item):
+    """Retorna (eTag, cTag) de um item do drive"""
+    try:
+        response = obter_armazenamento(token).metadados(caminho_item)
+        if response.status_code == 200:
+            item = response.json()
+            return item.get("eTag"), item.get("cTag")
+    except Exception as e:
+        logger.warning(f"Erro ao obter eTag de {caminho_item}: {e}")
+    
+    return None, None
+
 # ===========================
 # FUNÇÕES DE CONSOLIDAÇÃO MELHORADAS v2.4.0
 # ===========================
 def baixar_arquivo_consolidado(token):
-    """Baixa o arquivo consolidado existente"""
+    """Baixa o arquivo consolidado existente (usa o cache local se o eTag não mudou)"""
     consolidado_nome = "Reports_Geral_Consolidado.xlsx"
-    url = f"https://graph.microsoft.com/v1.0/sites/{SITE_ID}/drives/{DRIVE_ID}/root:/{PASTA_CONSOLIDADO}/{consolidado_nome}:/content"
-    headers = {"Authorization": f"Bearer {token}"}
+    df_cache, meta_cache = carregar_cache_consolidado()
     
     try:
-        response = requests.get(url, headers=headers)
+        response = obter_armazenamento(token).ler(
+            f"{PASTA_CONSOLIDADO}/{consolidado_nome}", etag=meta_cache["etag"] if meta_cache else None
+        )
+        
+        if response.status_code == 304 and df_cache is not None:
+            logger.info(f"⚡ Consolidado inalterado (eTag {meta_cache['etag']}) - usando cache local: {len(df_cache)} registros")
+            df_cache, _ = aplicar_schema(df_cache)
+            return df_cache, True
         
         if response.status_code == 200:
             df_consolidado = pd.read_excel(BytesIO(response.content))
             df_consolidado.columns = df_consolidado.columns.str.strip().str.upper()
+            df_consolidado, divergencias = aplicar_schema(df_consolidado)
+            registrar_divergencias_schema(divergencias, "consolidado")
             
             logger.info(f"✅ Arquivo consolidado baixado: {len(df_consolidado)} registros")
             if not df_consolidado.empty:
                 responsaveis_existentes = df_consolidado['RESPONSÁVEL'].dropna().unique()
                 logger.info(f"📊 Responsáveis no consolidado: {responsaveis_existentes}")
             
+            # eTag da própria resposta: uma consulta de metadados depois do download poderia já
+            # ver a versão de outro gravador e associá-la ao conteúdo antigo
+            salvar_cache_consolidado(df_consolidado, etag_da_resposta(response))
+            
             return df_consolidado, True
         else:
             logger.info("📄 Arquivo consolidado não existe - será criado novo")
+            if response.status_code == 404:
+                invalidar_cache_consolidado()
             return pd.DataFrame(), False
             
     except Exception as e:
@@ -854,15 +2400,16 @@ def adicionar_data_ultimo_envio(df_final, responsaveis_atualizados):
             df_final['DATA_ULTIMO_ENVIO'] = pd.NaT
             logger.info("➕ Coluna 'DATA_ULTIMO_ENVIO' criada")
         
-        # Atualizar apenas os responsáveis que foram modificados neste envio
+        # Atualizar apenas os responsáveis que foram modificados neste envio (uma única máscara)
         data_atual = datetime.now()
         
+        chave = obter_chave_responsavel(df_final)
+        mask = chave.isin(list(responsaveis_atualizados)).to_numpy()
+        df_final.loc[mask, 'DATA_ULTIMO_ENVIO'] = data_atual
+        
+        registros_por_responsavel = chave[mask].value_counts()
         for responsavel in responsaveis_atualizados:
-            mask = df_final['RESPONSÁVEL'].astype(str).str.strip().str.upper() == str(responsavel).strip().upper()
-            df_final.loc[mask, 'DATA_ULTIMO_ENVIO'] = data_atual
-            
-            registros_atualizados = mask.sum()
-            logger.info(f"📅 Data do último envio atualizada para '{responsavel}': {registros_atualizados} registros")
+            logger.info(f"📅 Data do último envio atualizada para '{responsavel}': {registros_por_responsavel.get(responsavel, 0)} registros")
         
         return df_final
         
@@ -873,9 +2420,9 @@ def adicionar_data_ultimo_envio(df_final, responsaveis_atualizados):
 def verificar_seguranca_consolidacao_v2(df_consolidado, df_novo, df_final):
     """Verificação de segurança crítica - versão corrigida para mês/ano"""
     try:
-        responsaveis_antes = set(df_consolidado['RESPONSÁVEL'].dropna().astype(str).str.strip().str.upper().unique()) if not df_consolidado.empty else set()
-        responsaveis_novos = set(df_novo['RESPONSÁVEL'].dropna().astype(str).str.strip().str.upper().unique())
-        responsaveis_depois = set(df_final['RESPONSÁVEL'].dropna().astype(str).str.strip().str.upper().unique())
+        responsaveis_antes = responsaveis_normalizados(df_consolidado)
+        responsaveis_novos = responsaveis_normalizados(df_novo)
+        responsaveis_depois = responsaveis_normalizados(df_final)
         
         logger.info(f"🛡️ VERIFICAÇÃO DE SEGURANÇA v2.4.0:")
         logger.info(f"   Responsáveis ANTES: {responsaveis_antes}")
@@ -911,181 +2458,347 @@ def verificar_seguranca_consolidacao_v2(df_consolidado, df_novo, df_final):
         logger.error(f"❌ {error_msg}")
         return False, error_msg
 
-def comparar_e_atualizar_registros_v2(df_consolidado, df_novo):
+COLUNAS_ORDENACAO = ["DATA", "RESPONSÁVEL"]
+
+def ordenavel_por_chave(*frames):
+    """True se DATA é datetime e RESPONSÁVEL é category em todos os frames (chaves numéricas possíveis)"""
+    return all(
+        pd.api.types.is_datetime64_any_dtype(df["DATA"]) and isinstance(df["RESPONSÁVEL"].dtype, pd.CategoricalDtype)
+        for df in frames
+    )
+
+def chaves_ordenacao(df, categorias):
     """
-    Lógica de consolidação corrigida - v2.4.0
-    Consolida por RESPONSÁVEL + MÊS/ANO para evitar problemas com alterações de data
+    Chave (DATA, RESPONSÁVEL) de cada linha como array estruturado de inteiros, na mesma
+    ordem do sort_values: responsáveis em ordem lexical e vazios (NaT/NaN) por último.
     """
-    registros_inseridos = 0
-    registros_substituidos = 0
-    registros_removidos = 0
-    detalhes_operacao = []
-    combinacoes_novas = 0
-    combinacoes_existentes = 0
-    responsaveis_atualizados = set()
+    datas = df["DATA"].to_numpy(dtype="datetime64[ns]").view("i8").copy()
+    datas[datas == np.iinfo("i8").min] = np.iinfo("i8").max
     
-    logger.info(f"🔧 INICIANDO CONSOLIDAÇÃO v2.4.0:")
-    logger.info(f"   Consolidado atual: {len(df_consolidado)} registros")
-    logger.info(f"   Novo arquivo: {len(df_novo)} registros")
+    codigos = pd.Categorical(df["RESPONSÁVEL"], categories=categorias).codes.astype("i8")
+    codigos[codigos < 0] = len(categorias)
     
-    if df_consolidado.empty:
-        df_final = df_novo.copy()
-        registros_inseridos = len(df_novo)
-        
-        # Adicionar todos os responsáveis como atualizados
-        responsaveis_atualizados = set(df_novo['RESPONSÁVEL'].dropna().astype(str).str.strip().str.upper().unique())
-        
-        # Criar combinações únicas por mês/ano
-        df_temp = df_novo.copy()
-        df_temp['mes_ano'] = df_temp['DATA'].dt.to_period('M')
-        combinacoes_unicas = df_temp.groupby(['RESPONSÁVEL', 'mes_ano']).size()
-        combinacoes_novas = len(combinacoes_unicas)
-        
-        logger.info(f"✅ PRIMEIRA CONSOLIDAÇÃO: {registros_inseridos} registros inseridos")
-        
-        for _, row in df_novo.iterrows():
-            detalhes_operacao.append({
-                "Operação": "INSERIDO",
-                "Responsável": row["RESPONSÁVEL"],
-                "Mês/Ano": row["DATA"].strftime("%m/%Y"),
-                "Data": row["DATA"].strftime("%d/%m/%Y"),
-                "Motivo": "Primeira consolidação - arquivo vazio"
-            })
-        
-        # Adicionar data do último envio
-        df_final = adicionar_data_ultimo_envio(df_final, responsaveis_atualizados)
-        
-        return df_final, registros_inseridos, registros_substituidos, registros_removidos, detalhes_operacao, combinacoes_novas, combinacoes_existentes
+    chaves = np.empty(len(df), dtype=[("data", "i8"), ("responsavel", "i8")])
+    chaves["data"] = datas
+    chaves["responsavel"] = codigos
+    return chaves
+
+def chaves_ordenadas(chaves):
+    """Verificação O(n) de que as chaves estão em ordem não decrescente"""
+    datas, responsaveis = chaves["data"], chaves["responsavel"]
+    return bool(np.all(
+        (datas[1:] > datas[:-1]) | ((datas[1:] == datas[:-1]) & (responsaveis[1:] >= responsaveis[:-1]))
+    ))
+
+def ordenar_consolidado(df):
+    """Ordena por DATA + RESPONSÁVEL apenas se o frame ainda não estiver ordenado"""
+    if df.empty:
+        return df.reset_index(drop=True)
+    
+    if ordenavel_por_chave(df):
+        categorias = sorted(df["RESPONSÁVEL"].cat.categories)
+        if chaves_ordenadas(chaves_ordenacao(df, categorias)):
+            return df.reset_index(drop=True)
+    
+    return df.sort_values(COLUNAS_ORDENACAO, na_position='last', kind='stable').reset_index(drop=True)
+
+def alinhar_categorias(*frames):
+    """
+    Mesmas categorias (união em ordem lexical) nas colunas category comuns aos frames,
+    para que o concat preserve o tipo em vez de materializar strings
+    """
+    comuns = set.intersection(*(set(df.columns) for df in frames))
+    colunas = [
+        coluna for coluna in frames[0].columns
+        if coluna in comuns and all(isinstance(df[coluna].dtype, pd.CategoricalDtype) for df in frames)
+    ]
+    if not colunas:
+        return frames
+    
+    tipos = {
+        coluna: pd.CategoricalDtype(sorted(set().union(*(df[coluna].cat.categories for df in frames))))
+        for coluna in colunas
+    }
+    return tuple(df.astype(tipos) for df in frames)
+
+def mesclar_ordenado(df_mantido, df_inserir):
+    """
+    Insere os novos registros no consolidado mantendo a ordem DATA + RESPONSÁVEL.
+    Com o consolidado já ordenado (verificação O(n)), só os k novos registros são
+    ordenados e cada um é encaixado por busca binária: O(n + k log k) em vez de
+    reordenar todo o histórico. Empates ficam depois dos registros existentes,
+    como na ordenação estável do concat.
+    """
+    df_mantido, df_inserir = alinhar_categorias(df_mantido, df_inserir)
+    
+    if df_mantido.empty or df_inserir.empty or not ordenavel_por_chave(df_mantido, df_inserir):
+        return ordenar_consolidado(pd.concat([df_mantido, df_inserir], ignore_index=True))
+    
+    categorias = list(df_mantido["RESPONSÁVEL"].cat.categories)
+    chaves_mantido = chaves_ordenacao(df_mantido, categorias)
+    
+    if not chaves_ordenadas(chaves_mantido):
+        logger.info("↕️ Consolidado fora de ordem - ordenação completa")
+        return ordenar_consolidado(pd.concat([df_mantido, df_inserir], ignore_index=True))
+    
+    chaves_inserir = chaves_ordenacao(df_inserir, categorias)
+    ordem_inserir = np.argsort(chaves_inserir, kind='stable', order=["data", "responsavel"])
+    posicoes = np.searchsorted(chaves_mantido, chaves_inserir[ordem_inserir], side='right')
+    
+    # Posição final de cada linha de concat([mantido, inserir ordenado])
+    ordem = np.insert(np.arange(len(df_mantido)), posicoes, len(df_mantido) + np.arange(len(df_inserir)))
+    
+    df_final = pd.concat([df_mantido, df_inserir.iloc[ordem_inserir]], ignore_index=True)
+    return df_final.take(ordem).reset_index(drop=True)
+
+COLUNAS_LOG_OPERACOES = ["Operação", "Responsável", "Mês/Ano", "Data", "Motivo", "Registros"]
+
+class PlanoConsolidacao:
+    """
+    Plano de consolidação por RESPONSÁVEL + MÊS/ANO, calculado uma única vez.
+    Guarda as quantidades por período, as linhas do consolidado a remover e as
+    linhas do envio a inserir; é consumido pela análise prévia, pelo merge,
+    pelo relatório de detalhes e pela simulação. `detalhes` é o log de operações
+    por período, em formato colunar (DataFrame).
+    """
+    
+    def __init__(self, registros_consolidado):
+        self.registros_consolidado = registros_consolidado
+        self.primeira_consolidacao = registros_consolidado == 0
+        self.periodos = []
+        self.detalhes = pd.DataFrame(columns=COLUNAS_LOG_OPERACOES)
+        self.operacao_por_chave = {}
+        self.responsaveis_atualizados = set()
+        self.registros_inseridos = 0
+        self.registros_substituidos = 0
+        self.registros_removidos = 0
+        self.combinacoes_novas = 0
+        self.combinacoes_existentes = 0
+        self.mascara_remover = np.zeros(registros_consolidado, dtype=bool)
+        self.linhas_inserir = np.arange(0)
+    
+    @property
+    def total_final(self):
+        """Registros esperados no consolidado depois de aplicar o plano"""
+        return self.registros_consolidado - self.registros_removidos + self.registros_inseridos + self.registros_substituidos
+    
+    def periodos_por_operacao(self, operacao):
+        """Combinações (responsável, período) do plano com a operação indicada"""
+        return [periodo for periodo in self.periodos if periodo["Operação"] == operacao]
+
+def calcular_plano_consolidacao(df_consolidado, df_novo):
+    """
+    Calcula o PlanoConsolidacao sem alterar nenhum dos frames.
+    A chave normalizada é usada uma única vez por frame, os registros existentes
+    saem de um único groupby e o laço percorre apenas os metadados dos grupos.
+    """
+    plano = PlanoConsolidacao(len(df_consolidado))
     
-    # Garantir que as colunas existem no consolidado
-    colunas = df_novo.columns.tolist()
-    for col in colunas:
-        if col not in df_consolidado.columns:
-            df_consolidado[col] = None
-            logger.info(f"➕ Coluna '{col}' adicionada ao consolidado")
+    periodo_novo = df_novo['DATA'].dt.to_period('M').rename('mes_ano')
     
-    # Começar com uma CÓPIA COMPLETA do consolidado
-    df_final = df_consolidado.copy()
-    registros_inicial = len(df_final)
+    # Agrupar registros novos por RESPONSÁVEL e MÊS/ANO (mesma ordem do groupby original)
+    agrupador = df_novo.groupby([df_novo['RESPONSÁVEL'], periodo_novo], observed=True)
+    tamanhos_grupos = agrupador.size()
     
-    # Adicionar colunas auxiliares para agrupamento por mês/ano
-    df_novo_temp = df_novo.copy()
-    df_novo_temp['mes_ano'] = df_novo_temp['DATA'].dt.to_period('M')
+    if plano.primeira_consolidacao:
+        plano.registros_inseridos = len(df_novo)
+        plano.combinacoes_novas = len(tamanhos_grupos)
+        plano.responsaveis_atualizados = responsaveis_normalizados(df_novo)
+        plano.linhas_inserir = np.arange(len(df_novo))
+        plano.periodos = [
+            {"Responsável": responsavel, "Período": periodo_grupo, "Novos": int(tamanho_grupo), "Existentes": 0, "Operação": "INSERIDO"}
+            for (responsavel, periodo_grupo), tamanho_grupo in tamanhos_grupos.items()
+        ]
+        
+        # Log agregado por período (inclui registros sem responsável, que também são inseridos)
+        por_periodo = df_novo.groupby([df_novo['RESPONSÁVEL'], periodo_novo], observed=True, dropna=False).size()
+        periodos_log = pd.PeriodIndex(por_periodo.index.get_level_values(1), freq='M')
+        plano.detalhes = pd.DataFrame({
+            "Operação": "INSERIDO",
+            "Responsável": por_periodo.index.get_level_values(0).astype(object),
+            "Mês/Ano": periodos_log.strftime("%m/%Y"),
+            "Data": "Período " + periodos_log.astype(str),
+            "Motivo": "Primeira consolidação - arquivo vazio",
+            "Registros": por_periodo.to_numpy()
+        }, columns=COLUNAS_LOG_OPERACOES)
+        return plano
     
-    df_final_temp = df_final.copy()
-    df_final_temp['mes_ano'] = df_final_temp['DATA'].dt.to_period('M')
+    # Chaves (RESPONSÁVEL normalizado, MÊS/ANO) do consolidado
+    chave_consolidado = pd.MultiIndex.from_arrays(
+        [obter_chave_responsavel(df_consolidado), df_consolidado['DATA'].dt.to_period('M')],
+        names=['chave', 'mes_ano']
+    )
     
-    logger.info(f"📋 Estado inicial do consolidado:")
-    if not df_final.empty:
-        responsaveis_iniciais = df_final['RESPONSÁVEL'].dropna().unique()
-        logger.info(f"   Responsáveis: {responsaveis_iniciais}")
-        logger.info(f"   Total de registros: {len(df_final)}")
+    # Registros existentes por combinação (uma única passada no consolidado)
+    existentes_por_chave = pd.Series(1, index=chave_consolidado).groupby(level=[0, 1], observed=True).size().to_dict()
     
-    # Agrupar registros novos por RESPONSÁVEL e MÊS/ANO
-    grupos_novos = df_novo_temp.groupby(['RESPONSÁVEL', 'mes_ano'])
+    id_grupo_linha = agrupador.ngroup().to_numpy()
     
-    logger.info(f"📊 Processando {len(grupos_novos)} combinações únicas de Responsável+Mês/Ano")
+    logger.info(f"📊 Processando {len(tamanhos_grupos)} combinações únicas de Responsável+Mês/Ano")
     
-    for (responsavel, periodo_grupo), grupo_df in grupos_novos:
+    # Grafias diferentes do mesmo responsável no mesmo período se substituem em sequência,
+    # exatamente como na versão iterativa: prevalece o último grupo.
+    ultimo_grupo_por_chave = {}
+    tamanho_atual_por_chave = {}
+    log = {coluna: [] for coluna in COLUNAS_LOG_OPERACOES}
+    
+    def registrar_operacao(operacao, responsavel, periodo_grupo, data, motivo, registros):
+        for coluna, valor in zip(COLUNAS_LOG_OPERACOES, (operacao, responsavel, periodo_grupo.strftime("%m/%Y"), data, motivo, registros)):
+            log[coluna].append(valor)
+    
+    for id_grupo, ((responsavel, periodo_grupo), tamanho_grupo) in enumerate(tamanhos_grupos.items()):
         if pd.isna(responsavel) or str(responsavel).strip() == '':
             logger.warning(f"⚠️ Pulando responsável inválido: {responsavel}")
             continue
         
-        # Adicionar responsável à lista de atualizados
-        responsaveis_atualizados.add(str(responsavel).strip().upper())
+        tamanho_grupo = int(tamanho_grupo)
+        responsavel_upper = str(responsavel).strip().upper()
+        plano.responsaveis_atualizados.add(responsavel_upper)
+        chave = (responsavel_upper, periodo_grupo)
         
-        logger.info(f"🔍 Processando: '{responsavel}' em {periodo_grupo} ({len(grupo_df)} registros)")
-        
-        # Buscar registros existentes APENAS para este responsável e período ESPECÍFICOS
-        mask_existente = (
-            (df_final_temp["mes_ano"] == periodo_grupo) &
-            (df_final_temp["RESPONSÁVEL"].astype(str).str.strip().str.upper() == str(responsavel).strip().upper())
-        )
-        
-        registros_existentes = df_final[mask_existente]
-        total_antes_operacao = len(df_final)
+        if chave in tamanho_atual_por_chave:
+            num_existentes = tamanho_atual_por_chave[chave]
+        else:
+            num_existentes = existentes_por_chave.get(chave, 0)
         
-        logger.info(f"   📋 Encontrados {len(registros_existentes)} registros existentes para esta combinação")
+        logger.info(f"🔍 '{responsavel}' em {periodo_grupo}: {tamanho_grupo} novo(s), {num_existentes} existente(s)")
         
-        if not registros_existentes.empty:
+        if num_existentes > 0:
             # SUBSTITUIÇÃO APENAS DA COMBINAÇÃO ESPECÍFICA (RESPONSÁVEL + MÊS/ANO)
-            num_removidos = len(registros_existentes)
-            
-            logger.info(f"   🔄 SUBSTITUIÇÃO: Removendo {num_removidos} registros antigos do período {periodo_grupo}")
-            
-            # Remove APENAS os registros dessa combinação específica
-            df_final = df_final[~mask_existente]
-            
-            # Atualizar df_final_temp também
-            df_final_temp = df_final_temp[~mask_existente]
-            
-            total_depois_remocao = len(df_final)
-            registros_removidos += num_removidos
-            combinacoes_existentes += 1
-            
-            logger.info(f"   ✅ Removidos {num_removidos} registros. Total: {total_antes_operacao} -> {total_depois_remocao}")
-            
-            # Verificação de segurança na remoção
-            if total_depois_remocao != (total_antes_operacao - num_removidos):
-                logger.error(f"❌ ERRO NA REMOÇÃO! Esperado: {total_antes_operacao - num_removidos}, Atual: {total_depois_remocao}")
+            plano.registros_removidos += num_existentes
+            plano.combinacoes_existentes += 1
             
-            # Adicionar detalhes da remoção
-            detalhes_operacao.append({
-                "Operação": "REMOVIDO",
-                "Responsável": responsavel,
-                "Mês/Ano": periodo_grupo.strftime("%m/%Y"),
-                "Data": f"Todo o período {periodo_grupo}",
-                "Motivo": f"Substituição: {num_removidos} registro(s) antigo(s) removido(s)"
-            })
+            registrar_operacao(
+                "REMOVIDO", responsavel, periodo_grupo, f"Todo o período {periodo_grupo}",
+                f"Substituição: {num_existentes} registro(s) antigo(s) removido(s)", num_existentes
+            )
             
-            registros_substituidos += len(grupo_df)
+            plano.registros_substituidos += tamanho_grupo
             operacao_tipo = "SUBSTITUÍDO"
-            motivo = f"Substituição completa do período: {len(grupo_df)} novo(s) registro(s)"
-            
+            motivo = f"Substituição completa do período: {tamanho_grupo} novo(s) registro(s)"
         else:
             # INSERÇÃO DE NOVOS DADOS
-            logger.info(f"   ➕ NOVA COMBINAÇÃO: Adicionando {len(grupo_df)} registros para {periodo_grupo}")
-            registros_inseridos += len(grupo_df)
-            combinacoes_novas += 1
+            plano.registros_inseridos += tamanho_grupo
+            plano.combinacoes_novas += 1
             operacao_tipo = "INSERIDO"
-            motivo = f"Nova combinação: {len(grupo_df)} registro(s) inserido(s)"
-        
-        # Inserir novos registros (tanto para inserção quanto substituição)
-        total_antes_insercao = len(df_final)
+            motivo = f"Nova combinação: {tamanho_grupo} registro(s) inserido(s)"
         
-        # Remover coluna auxiliar antes de concatenar
-        grupo_para_inserir = grupo_df.drop(columns=['mes_ano'], errors='ignore')
-        df_final = pd.concat([df_final, grupo_para_inserir], ignore_index=True)
+        ultimo_grupo_por_chave[chave] = id_grupo
+        tamanho_atual_por_chave[chave] = tamanho_grupo
+        plano.operacao_por_chave[chave] = operacao_tipo
         
-        # Atualizar df_final_temp também
-        df_final_temp = pd.concat([df_final_temp, grupo_df], ignore_index=True)
-        
-        total_depois_insercao = len(df_final)
+        plano.periodos.append({
+            "Responsável": responsavel,
+            "Período": periodo_grupo,
+            "Novos": tamanho_grupo,
+            "Existentes": num_existentes,
+            "Operação": operacao_tipo
+        })
+        registrar_operacao(operacao_tipo, responsavel, periodo_grupo, f"Período {periodo_grupo}", motivo, tamanho_grupo)
+    
+    plano.detalhes = pd.DataFrame(log, columns=COLUNAS_LOG_OPERACOES)
+    
+    # Anti-join: todos os períodos substituídos de uma só vez
+    if ultimo_grupo_por_chave:
+        plano.mascara_remover = chave_consolidado.isin(list(ultimo_grupo_por_chave.keys()))
+    
+    # Novos registros na ordem dos grupos, mantendo apenas o grupo vigente de cada combinação
+    grupos_vigentes = np.fromiter(ultimo_grupo_por_chave.values(), dtype=np.int64)
+    linhas = np.flatnonzero(np.isin(id_grupo_linha, grupos_vigentes))
+    plano.linhas_inserir = linhas[np.argsort(id_grupo_linha[linhas], kind='stable')]
+    
+    return plano
+
+def detalhes_por_registro(plano, df_consolidado, df_novo):
+    """
+    Log de operações registro a registro (sob demanda): as linhas removidas do
+    consolidado e as linhas inseridas do envio, com a operação do seu período.
+    """
+    inseridas = df_novo.iloc[plano.linhas_inserir]
+    
+    if plano.primeira_consolidacao:
+        removidas = None
+        operacoes = np.full(len(inseridas), "INSERIDO", dtype=object)
+    else:
+        removidas = df_consolidado[plano.mascara_remover]
+        chaves_plano = pd.MultiIndex.from_tuples(list(plano.operacao_por_chave.keys())) if plano.operacao_por_chave else None
+        chaves_linhas = pd.MultiIndex.from_arrays([obter_chave_responsavel(inseridas).astype(object), inseridas["DATA"].dt.to_period("M")])
+        posicoes = chaves_plano.get_indexer(chaves_linhas) if chaves_plano is not None else np.full(len(inseridas), -1)
+        operacoes = np.append(np.array(list(plano.operacao_por_chave.values()), dtype=object), "INSERIDO")[posicoes]
+    
+    def log(df, operacao, motivo):
+        datas = pd.to_datetime(df["DATA"], errors="coerce")
+        return pd.DataFrame({
+            "Operação": operacao,
+            "Responsável": df["RESPONSÁVEL"].astype(object),
+            "Mês/Ano": datas.dt.strftime("%m/%Y"),
+            "Data": datas.dt.strftime("%d/%m/%Y"),
+            "Motivo": motivo,
+            "Registros": 1
+        }, columns=COLUNAS_LOG_OPERACOES)
+    
+    logs = [log(inseridas, operacoes, "Registro do envio")]
+    if removidas is not None:
+        logs.insert(0, log(removidas, "REMOVIDO", "Registro antigo do período substituído"))
+    return pd.concat(logs, ignore_index=True)
+
+def aplicar_plano_consolidacao(plano, df_consolidado, df_novo):
+    """Executa o plano: um anti-join no consolidado e a inserção ordenada dos novos registros"""
+    if plano.primeira_consolidacao:
+        df_final = ordenar_consolidado(df_novo)
+    else:
+        # Garantir que as colunas existem no consolidado
+        for col in df_novo.columns:
+            if col not in df_consolidado.columns and col != COLUNA_CHAVE_RESPONSAVEL:
+                df_consolidado[col] = None
+                logger.info(f"➕ Coluna '{col}' adicionada ao consolidado")
         
-        logger.info(f"   ✅ Inseridos {len(grupo_df)} registros. Total: {total_antes_insercao} -> {total_depois_insercao}")
+        df_final = mesclar_ordenado(df_consolidado[~plano.mascara_remover], df_novo.iloc[plano.linhas_inserir])
         
-        # Adicionar detalhes da operação
-        detalhes_operacao.append({
-            "Operação": operacao_tipo,
-            "Responsável": responsavel,
-            "Mês/Ano": periodo_grupo.strftime("%m/%Y"),
-            "Data": f"Período {periodo_grupo}",
-            "Motivo": motivo
-        })
+        # Categorias diferentes nos dois lados viram "object" no concat: recompacta
+        df_final, _ = aplicar_schema(df_final)
+    
+    if len(df_final) != plano.total_final:
+        logger.error(f"❌ ERRO NA CONSOLIDAÇÃO! Esperado: {plano.total_final}, Atual: {len(df_final)}")
     
     # Adicionar data do último envio para os responsáveis atualizados
-    df_final = adicionar_data_ultimo_envio(df_final, responsaveis_atualizados)
+    return adicionar_data_ultimo_envio(df_final, plano.responsaveis_atualizados)
+
+def comparar_e_atualizar_registros_v2(df_consolidado, df_novo, plano=None):
+    """
+    Lógica de consolidação corrigida - v2.4.0
+    Consolida por RESPONSÁVEL + MÊS/ANO para evitar problemas com alterações de data
+
+    Reaproveita o PlanoConsolidacao já calculado para a análise prévia, quando informado.
+    """
+    logger.info(f"🔧 INICIANDO CONSOLIDAÇÃO v2.4.0:")
+    logger.info(f"   Consolidado atual: {len(df_consolidado)} registros")
+    logger.info(f"   Novo arquivo: {len(df_novo)} registros")
+    
+    if plano is None:
+        plano = calcular_plano_consolidacao(df_consolidado, df_novo)
+    
+    if not plano.primeira_consolidacao:
+        logger.info(f"📋 Estado inicial do consolidado:")
+        logger.info(f"   Responsáveis: {df_consolidado['RESPONSÁVEL'].dropna().unique()}")
+        logger.info(f"   Total de registros: {len(df_consolidado)}")
     
-    logger.info(f"🎯 CONSOLIDAÇÃO FINALIZADA:")
-    logger.info(f"   Registros inseridos: {registros_inseridos}")
-    logger.info(f"   Registros substituídos: {registros_substituidos}")
-    logger.info(f"   Registros removidos: {registros_removidos}")
-    logger.info(f"   Novas combinações: {combinacoes_novas}")
-    logger.info(f"   Combinações existentes: {combinacoes_existentes}")
-    logger.info(f"   Responsáveis atualizados: {responsaveis_atualizados}")
-    logger.info(f"   Total final: {len(df_final)} registros")
+    df_final = aplicar_plano_consolidacao(plano, df_consolidado, df_novo)
     
-    return df_final, registros_inseridos, registros_substituidos, registros_removidos, detalhes_operacao, combinacoes_novas, combinacoes_existentes
+    if plano.primeira_consolidacao:
+        logger.info(f"✅ PRIMEIRA CONSOLIDAÇÃO: {plano.registros_inseridos} registros inseridos")
+    else:
+        logger.info(f"🎯 CONSOLIDAÇÃO FINALIZADA:")
+        logger.info(f"   Registros inseridos: {plano.registros_inseridos}")
+        logger.info(f"   Registros substituídos: {plano.registros_substituidos}")
+        logger.info(f"   Registros removidos: {plano.registros_removidos}")
+        logger.info(f"   Novas combinações: {plano.combinacoes_novas}")
+        logger.info(f"   Combinações existentes: {plano.combinacoes_existentes}")
+        logger.info(f"   Responsáveis atualizados: {plano.responsaveis_atualizados}")
+        logger.info(f"   Total final: {len(df_final)} registros")
+    
+    return (df_final, plano.registros_inseridos, plano.registros_substituidos, plano.registros_removidos,
+            plano.detalhes, plano.combinacoes_novas, plano.combinacoes_existentes)
 
 def salvar_arquivo_enviado(df_novo, nome_arquivo_original, token):
     """Salva uma cópia do arquivo enviado na pasta de backups"""
@@ -1094,76 +2807,383 @@ def salvar_arquivo_enviado(df_novo, nome_arquivo_original, token):
         nome_base = nome_arquivo_original.replace(".xlsx", "").replace(".xls", "")
         nome_arquivo_backup = f"{nome_base}_enviado_{timestamp}.xlsx"
         
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            df_novo.to_excel(writer, index=False, sheet_name="Vendas CTs")
-        buffer.seek(0)
-        
-        sucesso, status_code, resposta = upload_onedrive(nome_arquivo_backup, buffer.read(), token, "backup")
+        with gerar_xlsx_streaming(df_novo) as arquivo_xlsx:
+            sucesso, status_code, resposta = upload_onedrive(nome_arquivo_backup, arquivo_xlsx, token, "backup")
         
         if sucesso:
             logger.info(f"💾 Arquivo enviado salvo como backup: {nome_arquivo_backup}")
         else:
             logger.warning(f"⚠️ Não foi possível salvar backup do arquivo enviado: {status_code}")
+        
+        return sucesso
             
     except Exception as e:
         logger.error(f"Erro ao salvar arquivo enviado: {e}")
+        return False
 
-def analise_pre_consolidacao_v2(df_consolidado, df_novo):
-    """Análise pré-consolidação com visual melhorado"""
+def salvar_log_auditoria(log_operacoes, nome_arquivo_original, token, session_id=None):
+    """Grava o log de operações em Parquet na pasta de auditoria dos backups"""
     try:
-        st.markdown("### 📊 Análise Pré-Consolidação")
-        
-        # Preparar dados para análise
-        df_novo_temp = df_novo.copy()
-        df_novo_temp['mes_ano'] = df_novo_temp['DATA'].dt.to_period('M')
+        agora = datetime.now()
+        nome_base = nome_arquivo_original.replace(".xlsx", "").replace(".xls", "")
+        nome_log = f"{PASTA_AUDITORIA}/{nome_base}_auditoria_{agora.strftime('%Y-%m-%d_%Hh%M')}.parquet"
         
-        responsaveis_novos = set(df_novo['RESPONSÁVEL'].dropna().astype(str).str.strip().str.upper().unique())
+        # Contexto da execução em colunas: o histórico pode ser consultado lendo só os Parquets
+        log_operacoes = log_operacoes.assign(
+            **{"Executado Em": agora, "Arquivo": nome_arquivo_original, "Sessão": session_id}
+        )
+        buffer = BytesIO()
+        log_operacoes.to_parquet(buffer, index=False)
         
-        if not df_consolidado.empty:
-            df_consolidado_temp = df_consolidado.copy()
-            df_consolidado_temp['mes_ano'] = df_consolidado_temp['DATA'].dt.to_period('M')
-            responsaveis_existentes = set(df_consolidado['RESPONSÁVEL'].dropna().astype(str).str.strip().str.upper().unique())
+        sucesso, status_code, _ = upload_onedrive(nome_log, buffer.getvalue(), token, "backup")
+        if sucesso:
+            logger.info(f"🧾 Log de auditoria salvo: {nome_log} ({len(log_operacoes)} linhas)")
         else:
-            responsaveis_existentes = set()
+            logger.warning(f"⚠️ Não foi possível salvar o log de auditoria: {status_code}")
+        
+        return sucesso
+        
+    except Exception as e:
+        logger.error(f"Erro ao salvar log de auditoria: {e}")
+        return False
+
+# ===========================
+# ARMAZENAMENTO PARTICIONADO POR MÊS
+# ===========================
+def nome_particao(periodo):
+    """Nome do arquivo de partição de um período mensal (None = registros sem data)"""
+    if periodo is None or pd.isna(periodo):
+        return "Reports_sem-data.parquet"
+    return f"Reports_{periodo.strftime('%Y-%m')}.parquet"
+
+def periodos_do_envio(df_novo):
+    """Períodos mensais presentes nos dados enviados"""
+    datas = pd.to_datetime(df_novo["DATA"], errors="coerce").dropna()
+    return sorted(datas.dt.to_period("M").unique())
+
+def ler_indice_cache_particoes():
+    """Lê o índice {nome da partição: eTag} do cache local de partições"""
+    try:
+        with open(os.path.join(PASTA_CACHE_LOCAL, "particoes", "indice.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Índice do cache de partições ilegível: {e}")
+        return {}
+
+def registrar_particao_cache(nome, conteudo, etag):
+    """Guarda localmente o conteúdo de uma partição associado ao seu eTag. Retorna True se guardou"""
+    if not etag:
+        return False
+    
+    try:
+        pasta_cache = os.path.join(PASTA_CACHE_LOCAL, "particoes")
+        os.makedirs(pasta_cache, exist_ok=True)
+        sufixo_tmp = f".{os.getpid()}.tmp"
+        
+        with open(os.path.join(pasta_cache, nome) + sufixo_tmp, "wb") as f:
+            f.write(conteudo)
+        os.replace(os.path.join(pasta_cache, nome) + sufixo_tmp, os.path.join(pasta_cache, nome))
         
-        # Análise de combinações
-        combinacoes_novas = []
-        combinacoes_existentes = []
+        indice = ler_indice_cache_particoes()
+        indice[nome] = etag
+        with open(os.path.join(pasta_cache, "indice.json") + sufixo_tmp, "w", encoding="utf-8") as f:
+            json.dump(indice, f)
+        os.replace(os.path.join(pasta_cache, "indice.json") + sufixo_tmp, os.path.join(pasta_cache, "indice.json"))
+        return True
         
-        grupos_novos = df_novo_temp.groupby(['RESPONSÁVEL', 'mes_ano'])
+    except Exception as e:
+        logger.warning(f"Não foi possível guardar a partição {nome} no cache local: {e}")
+        return False
+
+def listar_particoes(token):
+    """Lista as partições remotas: {nome: eTag}. Retorna None se a pasta não existir"""
+    itens = obter_armazenamento(token).listar(f"{PASTA_CONSOLIDADO}/{PASTA_PARTICOES}")
+    if itens is None:
+        return None
+    
+    return {nome: etag for nome, etag in itens.items() if nome.endswith(".parquet")}
+
+def fonte_particao(token, nome):
+    """
+    Versão atual de uma partição para pd.read_parquet: o caminho no cache local (baixada só se o
+    eTag mudou) ou, se não puder ser guardada, o conteúdo em memória. None se a partição não existir.
+    """
+    caminho_cache = os.path.join(PASTA_CACHE_LOCAL, "particoes", nome)
+    etag_cache = ler_indice_cache_particoes().get(nome)
+    if not os.path.exists(caminho_cache):
+        etag_cache = None
+    
+    response = obter_armazenamento(token).ler(f"{PASTA_CONSOLIDADO}/{PASTA_PARTICOES}/{nome}", etag=etag_cache)
+    
+    if response.status_code == 304:
+        return caminho_cache
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(f"Erro ao baixar partição {nome}: {response.status_code}")
+    
+    if registrar_particao_cache(nome, response.content, etag_da_resposta(response)):
+        return caminho_cache
+    return BytesIO(response.content)
+
+def baixar_particao(token, nome):
+    """Baixa uma partição mensal, reaproveitando o cache local quando o eTag não mudou"""
+    fonte = fonte_particao(token, nome)
+    return pd.DataFrame() if fonte is None else pd.read_parquet(fonte)
+
+def serializar_particao(df_particao):
+    """
+    Parquet de uma partição mensal. Colunas "object" com valores misturados (texto e número,
+    comuns em planilhas editadas à mão) não são aceitas pelo Arrow e são gravadas como texto.
+    """
+    df_particao = df_particao[colunas_persistidas(df_particao)].copy(deep=False)
+    for coluna in df_particao.columns:
+        serie = df_particao[coluna]
+        if serie.dtype == object and pd.api.types.infer_dtype(serie, skipna=True) not in ("string", "empty"):
+            df_particao[coluna] = serie.astype(str).where(serie.notna())
+    
+    buffer = BytesIO()
+    df_particao.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+def enviar_particao(token, nome, conteudo):
+    """Envia uma partição mensal já serializada"""
+    sucesso, status_code, resposta = upload_onedrive(f"{PASTA_PARTICOES}/{nome}", conteudo, token, "consolidado")
+    
+    if sucesso:
+        try:
+            registrar_particao_cache(nome, conteudo, json.loads(resposta).get("eTag"))
+        except ValueError:
+            pass
+    
+    return sucesso, status_code, resposta
+
+def remover_particoes(token, nomes):
+    """Exclui partições enviadas por uma migração que não terminou"""
+    armazenamento = obter_armazenamento(token)
+    for nome in nomes:
+        try:
+            response = armazenamento.excluir(f"{PASTA_CONSOLIDADO}/{PASTA_PARTICOES}/{nome}")
+            if response.status_code not in [200, 204, 404]:
+                logger.error(f"❌ Partição {nome} não pôde ser removida: {response.status_code}")
+        except Exception as e:
+            logger.error(f"❌ Erro ao remover partição {nome}: {e}")
+
+def migrar_para_particoes(token):
+    """
+    Divide o consolidado em arquivo único em partições mensais (executado uma única vez).
+    Tudo ou nada: todas as partições são serializadas antes do primeiro envio e, se um envio
+    falhar, as já enviadas são excluídas (partições parciais seriam tomadas como o histórico completo).
+    """
+    df_consolidado, arquivo_existe = baixar_arquivo_consolidado(token)
+    particoes = {}
+    
+    if not arquivo_existe or df_consolidado.empty:
+        return particoes
+    
+    logger.info(f"📦 Migrando consolidado ({len(df_consolidado)} registros) para partições mensais")
+    
+    periodos = pd.to_datetime(df_consolidado["DATA"], errors="coerce").dt.to_period("M")
+    conteudos = {
+        nome_particao(periodo): serializar_particao(df_particao)
+        for periodo, df_particao in df_consolidado.groupby(periodos, dropna=False, sort=True)
+    }
+    del df_consolidado
+    
+    for nome, conteudo in conteudos.items():
+        sucesso, status_code, _ = enviar_particao(token, nome, conteudo)
+        if not sucesso:
+            logger.error(f"❌ Falha ao migrar partição {nome}: {status_code} - desfazendo a migração")
+            remover_particoes(token, list(particoes))
+            raise RuntimeError(f"Falha ao migrar partição {nome}: {status_code}")
+        particoes[nome] = ler_indice_cache_particoes().get(nome)
+    
+    logger.info(f"✅ Migração concluída: {len(particoes)} partições criadas")
+    return particoes
+
+def baixar_consolidado_particionado(token, periodos, migrar=True):
+    """
+    Baixa apenas as partições dos meses tocados pelo envio. Sem partições, migra o arquivo único;
+    com `migrar=False` (simulação, sem lock) nada é gravado: o arquivo único é lido e filtrado em memória.
+    """
+    particoes = listar_particoes(token)
+    if not particoes and not migrar:
+        df_consolidado, arquivo_existe = baixar_arquivo_consolidado(token)
+        if df_consolidado.empty:
+            return df_consolidado, arquivo_existe
         
-        for (responsavel, periodo), grupo in grupos_novos:
-            if pd.isna(responsavel):
+        meses = pd.to_datetime(df_consolidado["DATA"], errors="coerce").dt.to_period("M")
+        return df_consolidado[meses.isin(periodos)].reset_index(drop=True), arquivo_existe
+    
+    if not particoes:
+        particoes = migrar_para_particoes(token)
+    
+    nomes_tocados = [nome_particao(periodo) for periodo in periodos]
+    frames = [baixar_particao(token, nome) for nome in nomes_tocados if nome in particoes]
+    frames = [df for df in frames if not df.empty]
+    
+    logger.info(f"📂 Partições: {len(particoes)} existentes, {len(frames)} baixadas para {len(nomes_tocados)} meses do envio")
+    
+    if not frames:
+        return pd.DataFrame(), bool(particoes)
+    
+    df_consolidado = pd.concat(frames, ignore_index=True)
+    df_consolidado.columns = df_consolidado.columns.str.strip().str.upper()
+    df_consolidado, divergencias = aplicar_schema(df_consolidado)
+    registrar_divergencias_schema(divergencias, "partições")
+    return df_consolidado, True
+
+def materializar_consolidado_em_blocos(token, particoes, particoes_atualizadas):
+    """
+    Monta o Reports_Geral_Consolidado.xlsx partição a partição (memória limitada a um mês).
+    Primeira passada: só o schema e as colunas RESPONSÁVEL/DATA_ULTIMO_ENVIO de cada partição,
+    para as colunas e a maior DATA_ULTIMO_ENVIO por responsável. Cada partição é baixada uma
+    única vez; a segunda passada (ajuste, ordenação e gravação de cada mês) lê do cache local.
+    """
+    import pyarrow.parquet as pq
+    
+    nomes = sorted(particoes)
+    fontes = {nome: fonte_particao(token, nome) for nome in nomes if nome not in particoes_atualizadas}
+    
+    def ler(nome, colunas=None):
+        if nome in particoes_atualizadas:
+            df_particao = particoes_atualizadas[nome]
+            df_particao = df_particao[colunas] if colunas is not None else df_particao
+        elif fontes[nome] is None:
+            return pd.DataFrame()
+        else:
+            if isinstance(fontes[nome], BytesIO):
+                fontes[nome].seek(0)
+            df_particao = pd.read_parquet(fontes[nome], columns=colunas)
+        df_particao, _ = aplicar_schema(df_particao)
+        return df_particao
+    
+    def colunas_da_particao(nome):
+        if nome in particoes_atualizadas:
+            return colunas_persistidas(particoes_atualizadas[nome])
+        if fontes[nome] is None:
+            return []
+        if isinstance(fontes[nome], BytesIO):
+            fontes[nome].seek(0)
+        return [coluna for coluna in pq.read_schema(fontes[nome]).names if coluna != COLUNA_CHAVE_RESPONSAVEL]
+    
+    # Responsável vazio vira " " (nenhuma chave normalizada começa com espaço)
+    def chaves(df_particao):
+        return obter_chave_responsavel(df_particao).astype(object).fillna(" ")
+    
+    colunas = []
+    ultimo_envio = pd.Series(dtype="datetime64[ns]")
+    for nome in nomes:
+        colunas_particao = colunas_da_particao(nome)
+        colunas += [coluna for coluna in colunas_particao if coluna not in colunas]
+        if 'DATA_ULTIMO_ENVIO' in colunas_particao and 'RESPONSÁVEL' in colunas_particao:
+            df_particao = ler(nome, ['RESPONSÁVEL', 'DATA_ULTIMO_ENVIO'])
+            maximos = pd.to_datetime(df_particao['DATA_ULTIMO_ENVIO'], errors="coerce").groupby(chaves(df_particao)).max()
+            ultimo_envio = pd.concat([ultimo_envio, maximos]).groupby(level=0).max()
+            del df_particao
+    
+    def blocos():
+        for nome in nomes:
+            df_particao = ler(nome)
+            if df_particao.empty:
                 continue
-                
-            responsavel_upper = str(responsavel).strip().upper()
-            
-            if not df_consolidado.empty:
-                mask_existente = (
-                    (df_consolidado_temp["mes_ano"] == periodo) &
-                    (df_consolidado_temp["RESPONSÁVEL"].astype(str).str.strip().str.upper() == responsavel_upper)
-                )
-                
-                if mask_existente.any():
-                    combinacoes_existentes.append({
-                        "Responsável": responsavel,
-                        "Período": periodo.strftime("%m/%Y"),
-                        "Novos Registros": len(grupo),
-                        "Registros Existentes": mask_existente.sum()
-                    })
-                else:
-                    combinacoes_novas.append({
-                        "Responsável": responsavel,
-                        "Período": periodo.strftime("%m/%Y"),
-                        "Registros": len(grupo)
-                    })
-            else:
-                combinacoes_novas.append({
-                    "Responsável": responsavel,
-                    "Período": periodo.strftime("%m/%Y"),
-                    "Registros": len(grupo)
-                })
+            if 'DATA_ULTIMO_ENVIO' in colunas:
+                df_particao['DATA_ULTIMO_ENVIO'] = chaves(df_particao).map(ultimo_envio).astype("datetime64[ns]")
+            yield df_particao.sort_values(["DATA", "RESPONSÁVEL"], na_position='last')
+    
+    with gerar_xlsx_streaming(blocos(), colunas=colunas) as arquivo_xlsx:
+        sucesso, status_code, resposta = upload_onedrive("Reports_Geral_Consolidado.xlsx", arquivo_xlsx, token, "consolidado")
+    
+    # Sem o frame completo em memória não há o que guardar no cache local
+    invalidar_cache_consolidado()
+    return sucesso, status_code, resposta, None
+
+def materializar_consolidado(token, particoes_atualizadas):
+    """Monta o Reports_Geral_Consolidado.xlsx a partir de todas as partições"""
+    particoes = listar_particoes(token) or {}
+    
+    # Estimativa pelo tamanho médio das partições já em memória
+    if particoes_atualizadas:
+        tamanho_estimado = memoria_frames_mb(*particoes_atualizadas.values()) * len(particoes) / len(particoes_atualizadas)
+        if excede_orcamento_memoria(tamanho_estimado):
+            return materializar_consolidado_em_blocos(token, particoes, particoes_atualizadas)
+    
+    frames = []
+    for nome in sorted(particoes):
+        if nome in particoes_atualizadas:
+            frames.append(particoes_atualizadas[nome])
+        else:
+            frames.append(baixar_particao(token, nome))
+    
+    df_completo = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    df_completo, _ = aplicar_schema(df_completo)
+    
+    # No arquivo único a data do último envio vale para todos os registros do responsável
+    if 'DATA_ULTIMO_ENVIO' in df_completo.columns:
+        chave = obter_chave_responsavel(df_completo)
+        df_completo['DATA_ULTIMO_ENVIO'] = pd.to_datetime(df_completo['DATA_ULTIMO_ENVIO'], errors="coerce").groupby(chave, observed=True, dropna=False).transform("max")
+    
+    df_completo = ordenar_consolidado(df_completo)
+    
+    with gerar_xlsx_streaming(df_completo) as arquivo_xlsx:
+        sucesso, status_code, resposta = upload_onedrive("Reports_Geral_Consolidado.xlsx", arquivo_xlsx, token, "consolidado")
+    
+    if sucesso:
+        try:
+            item_enviado = json.loads(resposta)
+            salvar_cache_consolidado(df_completo, item_enviado.get("eTag"), item_enviado.get("cTag"))
+        except ValueError:
+            invalidar_cache_consolidado()
+    
+    return sucesso, status_code, resposta, df_completo
+
+def salvar_consolidado_particionado(df_final, token):
+    """Envia somente as partições dos meses alterados e, se configurado, materializa o arquivo único"""
+    periodos = pd.to_datetime(df_final["DATA"], errors="coerce").dt.to_period("M")
+    particoes_atualizadas = {
+        nome_particao(periodo): ordenar_consolidado(df_particao)
+        for periodo, df_particao in df_final.groupby(periodos, sort=True)
+    }
+    
+    # Serialização antes do primeiro envio: um erro de tipo não deixa meses enviados pela metade
+    conteudos = {nome: serializar_particao(df_particao) for nome, df_particao in particoes_atualizadas.items()}
+    
+    for nome, conteudo in conteudos.items():
+        sucesso, status_code, resposta = enviar_particao(token, nome, conteudo)
+        if not sucesso:
+            logger.error(f"❌ Falha no envio da partição {nome}: {status_code}")
+            return False, status_code, resposta, None
+    
+    logger.info(f"📤 {len(particoes_atualizadas)} partição(ões) mensal(is) atualizada(s)")
+    
+    if not MATERIALIZAR_CONSOLIDADO:
+        return True, 200, "", None
+    
+    return materializar_consolidado(token, particoes_atualizadas)
+
+def analise_pre_consolidacao_v2(df_consolidado, df_novo, plano):
+    """Análise pré-consolidação com visual melhorado (exibe o PlanoConsolidacao)"""
+    try:
+        st.markdown("### 📊 Análise Pré-Consolidação")
+        
+        responsaveis_novos = responsaveis_normalizados(df_novo)
+        
+        # Combinações vêm prontas do plano: nenhum agrupamento ou máscara adicional
+        combinacoes_novas = [
+            {"Responsável": periodo["Responsável"], "Período": periodo["Período"].strftime("%m/%Y"), "Registros": periodo["Novos"]}
+            for periodo in plano.periodos_por_operacao("INSERIDO")
+        ]
+        combinacoes_existentes = [
+            {
+                "Responsável": periodo["Responsável"],
+                "Período": periodo["Período"].strftime("%m/%Y"),
+                "Novos Registros": periodo["Novos"],
+                "Registros Existentes": periodo["Existentes"]
+            }
+            for periodo in plano.periodos_por_operacao("SUBSTITUÍDO")
+        ]
         
         # Exibir métricas
         col1, col2, col3, col4 = st.columns(4)
@@ -1218,9 +3238,169 @@ def analise_pre_consolidacao_v2(df_consolidado, df_novo):
         st.error(f"❌ Erro na análise: {str(e)}")
         return False
 
+def gravar_resultados_em_paralelo(df_novo, nome_arquivo, df_final, token, particionado, em_blocos=False, log_auditoria=None):
+    """
+    Executa as gravações independentes num pool de threads limitado:
+    backup do envio, log de auditoria e serialização do novo consolidado.
+    O consolidado antigo só é renomeado para backup com o novo arquivo pronto, logo antes do
+    upload, e volta ao nome original se o upload falhar. Todas as tarefas
+    terminam antes do retorno (ponto de junção antes de liberar o lock).
+    Com `em_blocos`, df_final não está ordenado e é serializado mês a mês.
+    Retorna (sucesso, status_code, resposta, df_final, erros).
+    """
+    erros = []
+    ctx = get_script_run_ctx()
+    metricas = metricas_ativas()
+    
+    def inicializar_thread():
+        add_script_run_ctx(ctx=ctx)
+        ativar_metricas(metricas)
+    
+    def resultado(futuro, etapa):
+        try:
+            return futuro.result()
+        except Exception as e:
+            logger.error(f"Erro em '{etapa}': {e}")
+            erros.append(f"{etapa}: {e}")
+            return None
+    
+    with ThreadPoolExecutor(max_workers=MAX_THREADS_GRAVACAO, initializer=inicializar_thread) as executor:
+        futuro_backup = executor.submit(salvar_arquivo_enviado, df_novo, nome_arquivo, token)
+        futuro_auditoria = executor.submit(salvar_log_auditoria, log_auditoria, nome_arquivo, token, gerar_id_sessao()) if log_auditoria is not None else None
+        
+        if particionado:
+            futuro_consolidado = executor.submit(salvar_consolidado_particionado, df_final, token)
+            retorno = resultado(futuro_consolidado, "Gravação das partições")
+            if retorno is None:
+                sucesso, status_code, resposta = False, 500, f"Erro interno: {erros[-1]}"
+            else:
+                sucesso, status_code, resposta, df_completo = retorno
+                if df_completo is not None:
+                    df_final = df_completo
+        else:
+            consolidado_nome = "Reports_Geral_Consolidado.xlsx"
+            if em_blocos:
+                futuro_xlsx = executor.submit(gerar_xlsx_streaming, blocos_mensais_ordenados(df_final), colunas=colunas_persistidas(df_final))
+            else:
+                futuro_xlsx = executor.submit(gerar_xlsx_streaming, df_final)
+            
+            arquivo_xlsx = resultado(futuro_xlsx, "Serialização do consolidado")
+            
+            if arquivo_xlsx is None:
+                # Nada foi renomeado: o consolidado anterior continua no lugar
+                sucesso, status_code, resposta = False, 500, f"Erro interno: {erros[-1]}"
+            else:
+                with arquivo_xlsx:
+                    nome_backup = mover_arquivo_existente(consolidado_nome, token, PASTA_CONSOLIDADO)
+                    sucesso, status_code, resposta = upload_onedrive(
+                        consolidado_nome, arquivo_xlsx, token, "consolidado", mover_existente=False
+                    )
+                if not sucesso and nome_backup:
+                    restaurar_arquivo_movido(nome_backup, consolidado_nome, token, PASTA_CONSOLIDADO)
+            
+            # O próximo envio neste servidor reaproveita o consolidado sem baixá-lo
+            if sucesso:
+                try:
+                    item_enviado = json.loads(resposta)
+                    salvar_cache_consolidado(df_final, item_enviado.get("eTag"), item_enviado.get("cTag"))
+                except ValueError:
+                    invalidar_cache_consolidado()
+            else:
+                invalidar_cache_consolidado()
+        
+        if not resultado(futuro_backup, "Backup do arquivo enviado"):
+            erros.append("Backup do arquivo enviado: não foi possível salvar a cópia")
+        if futuro_auditoria is not None and not resultado(futuro_auditoria, "Log de auditoria"):
+            erros.append("Log de auditoria: não foi possível salvar o registro das operações")
+    
+    return sucesso, status_code, resposta, df_final, erros
+
+def preparar_dados_envio(df_novo):
+    """Normaliza colunas, descarta datas inválidas e aplica o schema. Retorna (df_novo, linhas_invalidas)"""
+    # Cópia rasa: só colunas são substituídas, o frame em cache do upload não é alterado
+    df_novo = df_novo.copy(deep=False)
+    df_novo.columns = df_novo.columns.str.strip().str.upper()
+    
+    df_novo["DATA"] = pd.to_datetime(df_novo["DATA"], errors="coerce")
+    linhas_invalidas = df_novo["DATA"].isna().sum()
+    df_novo = df_novo.dropna(subset=["DATA"])
+    
+    df_novo, divergencias_schema = aplicar_schema(df_novo)
+    registrar_divergencias_schema(divergencias_schema, "envio")
+    if divergencias_schema:
+        st.warning("📐 **Divergências em relação ao schema esperado:**\n\n" + "\n".join(f"- {d}" for d in divergencias_schema))
+    
+    return df_novo, linhas_invalidas
+
+def exibir_detalhes_operacoes(detalhes, expandido=False):
+    """Relatório das operações (inseridas, substituídas, removidas) a partir do log colunar do plano"""
+    with st.expander("📋 Detalhes das Operações", expanded=expandido):
+        operacoes_inseridas = detalhes[detalhes['Operação'] == 'INSERIDO']
+        operacoes_substituidas = detalhes[detalhes['Operação'] == 'SUBSTITUÍDO']
+        operacoes_removidas = detalhes[detalhes['Operação'] == 'REMOVIDO']
+        
+        if not operacoes_inseridas.empty:
+            st.markdown("#### ➕ **Registros Inseridos (Novos)**")
+            st.dataframe(operacoes_inseridas, use_container_width=True, hide_index=True)
+        
+        if not operacoes_substituidas.empty:
+            st.markdown("#### 🔄 **Registros Substituídos**")
+            st.dataframe(operacoes_substituidas, use_container_width=True, hide_index=True)
+        
+        if not operacoes_removidas.empty:
+            st.markdown("#### 🗑️ **Registros Removidos**")
+            st.dataframe(operacoes_removidas, use_container_width=True, hide_index=True)
+
+def simular_consolidacao(df_novo, token):
+    """Simulação (dry-run): calcula e exibe o plano sem lock, sem gravar e sem upload"""
+    try:
+        with st.spinner("🔍 Calculando o que mudaria no consolidado..."):
+            df_novo, linhas_invalidas = preparar_dados_envio(df_novo)
+            
+            if df_novo.empty:
+                st.error("❌ Nenhum registro válido para consolidar")
+                return False
+            
+            if MODO_ARMAZENAMENTO == "particionado":
+                df_consolidado, _ = baixar_consolidado_particionado(token, periodos_do_envio(df_novo), migrar=False)
+            else:
+                df_consolidado, _ = baixar_arquivo_consolidado(token)
+            
+            plano = calcular_plano_consolidacao(df_consolidado, df_novo)
+        
+        st.markdown("""
+        <div class="custom-alert info">
+            <h4>🔍 Simulação - nada foi gravado e o sistema não foi bloqueado</h4>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        if linhas_invalidas > 0:
+            st.warning(f"🧹 {linhas_invalidas} linhas com datas inválidas seriam removidas")
+        
+        analise_pre_consolidacao_v2(df_consolidado, df_novo, plano)
+        
+        st.info(
+            f"📊 Consolidado passaria de **{plano.registros_consolidado:,}** para **{plano.total_final:,}** registros "
+            f"({plano.registros_inseridos} inserido(s), {plano.registros_substituidos} substituído(s), "
+            f"{plano.registros_removidos} removido(s))"
+        )
+        
+        if not plano.detalhes.empty:
+            exibir_detalhes_operacoes(plano.detalhes, expandido=True)
+        
+        return True
+        
+    except Exception as e:
+        logger.error(f"Erro na simulação da consolidação: {e}")
+        st.error(f"❌ Erro na simulação: {str(e)}")
+        return False
+
 def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
     """Consolidação com sistema de lock e feedback melhorado - v2.4.0"""
     session_id = gerar_id_sessao()
+    metricas = MetricasConsolidacao(session_id, nome_arquivo).iniciar()
+    metricas.etapa("BLOQUEIO")
+    lock_criado = sucesso = False
     
     status_container = st.empty()
     progress_container = st.empty()
@@ -1265,6 +3445,7 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
         """, unsafe_allow_html=True)
         progress_container.progress(15)
         
+        metricas.etapa("BAIXANDO_ARQUIVO")
         atualizar_status_lock(token, session_lock, "BAIXANDO_ARQUIVO", "Baixando arquivo consolidado")
         status_container.markdown("""
         <div class="custom-alert info">
@@ -1273,7 +3454,12 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
         """, unsafe_allow_html=True)
         progress_container.progress(25)
         
-        df_consolidado, arquivo_existe = baixar_arquivo_consolidado(token)
+        particionado = MODO_ARMAZENAMENTO == "particionado"
+        if particionado:
+            df_consolidado, arquivo_existe = baixar_consolidado_particionado(token, periodos_do_envio(df_novo))
+        else:
+            df_consolidado, arquivo_existe = baixar_arquivo_consolidado(token)
+        metricas.linhas(saida=len(df_consolidado))
         
         if arquivo_existe:
             status_container.markdown(f"""
@@ -1290,6 +3476,7 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
         
         progress_container.progress(35)
 
+        metricas.etapa("PREPARANDO_DADOS", linhas_entrada=len(df_novo))
         atualizar_status_lock(token, session_lock, "PREPARANDO_DADOS", "Validando e preparando dados")
         status_container.markdown("""
         <div class="custom-alert info">
@@ -1297,12 +3484,8 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
         </div>
         """, unsafe_allow_html=True)
         
-        df_novo = df_novo.copy()
-        df_novo.columns = df_novo.columns.str.strip().str.upper()
-        
-        df_novo["DATA"] = pd.to_datetime(df_novo["DATA"], errors="coerce")
-        linhas_invalidas = df_novo["DATA"].isna().sum()
-        df_novo = df_novo.dropna(subset=["DATA"])
+        df_novo, linhas_invalidas = preparar_dados_envio(df_novo)
+        metricas.linhas(saida=len(df_novo))
 
         if df_novo.empty:
             status_container.markdown("""
@@ -1327,7 +3510,9 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
             <h4>📊 Realizando análise pré-consolidação...</h4>
         </div>
         """, unsafe_allow_html=True)
-        analise_ok = analise_pre_consolidacao_v2(df_consolidado, df_novo)
+        metricas.etapa("ANALISE", linhas_entrada=len(df_consolidado) + len(df_novo))
+        plano = calcular_plano_consolidacao(df_consolidado, df_novo)
+        analise_ok = analise_pre_consolidacao_v2(df_consolidado, df_novo, plano)
         
         if not analise_ok:
             status_container.markdown("""
@@ -1340,6 +3525,7 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
         
         progress_container.progress(55)
 
+        metricas.etapa("CONSOLIDANDO", linhas_entrada=len(df_consolidado) + len(df_novo))
         atualizar_status_lock(token, session_lock, "CONSOLIDANDO", f"Processando {len(df_novo)} registros por mês/ano")
         status_container.markdown("""
         <div class="custom-alert info">
@@ -1349,8 +3535,9 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
         progress_container.progress(65)
         
         df_final, inseridos, substituidos, removidos, detalhes, novas_combinacoes, combinacoes_existentes = comparar_e_atualizar_registros_v2(
-            df_consolidado, df_novo
+            df_consolidado, df_novo, plano
         )
+        metricas.linhas(saida=len(df_final))
         
         progress_container.progress(75)
 
@@ -1361,6 +3548,12 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
         """, unsafe_allow_html=True)
         verificacao_ok, msg_verificacao = verificar_seguranca_consolidacao_v2(df_consolidado, df_novo, df_final)
         
+        log_auditoria = detalhes_por_registro(plano, df_consolidado, df_novo) if AUDITORIA_POR_REGISTRO else detalhes
+        
+        # O consolidado anterior não é mais usado: libera a memória antes da serialização
+        df_consolidado = None
+        plano = None
+        
         if not verificacao_ok:
             status_container.markdown(f"""
             <div class="custom-alert error">
@@ -1377,9 +3570,15 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
             </div>
             """, unsafe_allow_html=True)
 
-        df_final = df_final.sort_values(["DATA", "RESPONSÁVEL"], na_position='last').reset_index(drop=True)
+        # O merge já entrega o consolidado ordenado; a ordenação completa só é necessária se a
+        # verificação falhar. Acima do orçamento de memória a gravação ordena mês a mês.
+        metricas.etapa("ORDENACAO", linhas_entrada=len(df_final))
+        em_blocos = not particionado and excede_orcamento_memoria(memoria_frames_mb(df_final))
+        if not em_blocos:
+            df_final = ordenar_consolidado(df_final)
         progress_container.progress(80)
         
+        metricas.etapa("UPLOAD_FINAL", linhas_entrada=len(df_final))
         if removidos > 0:
             atualizar_status_lock(token, session_lock, "CRIANDO_BACKUP", f"Backup de {removidos} registros substituídos")
             status_container.markdown("""
@@ -1388,33 +3587,32 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
             </div>
             """, unsafe_allow_html=True)
         
-        atualizar_status_lock(token, session_lock, "SALVANDO_ENVIADO", "Salvando cópia do arquivo enviado")
-        status_container.markdown("""
-        <div class="custom-alert info">
-            <h4>💾 Salvando cópia do arquivo enviado...</h4>
-        </div>
-        """, unsafe_allow_html=True)
-        salvar_arquivo_enviado(df_novo, nome_arquivo, token)
-        
-        progress_container.progress(85)
+        if not atualizar_status_lock(token, session_lock, "UPLOAD_FINAL", "Salvando cópia do envio e arquivo consolidado") and session_lock not in LOCKS_DA_SESSAO:
+            status_container.markdown("""
+            <div class="custom-alert error">
+                <h4>❌ O bloqueio do sistema foi perdido para outra sessão. Consolidação cancelada.</h4>
+            </div>
+            """, unsafe_allow_html=True)
+            return False
         
-        atualizar_status_lock(token, session_lock, "UPLOAD_FINAL", "Salvando arquivo consolidado")
         status_container.markdown("""
         <div class="custom-alert info">
-            <h4>📤 Salvando arquivo consolidado final...</h4>
+            <h4>📤 Salvando cópia do arquivo enviado e arquivo consolidado final...</h4>
         </div>
         """, unsafe_allow_html=True)
+        progress_container.progress(85)
         
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            df_final.to_excel(writer, index=False, sheet_name="Vendas CTs")
-        buffer.seek(0)
+        sucesso, status_code, resposta, df_final, erros_gravacao = gravar_resultados_em_paralelo(
+            df_novo, nome_arquivo, df_final, token, particionado, em_blocos, log_auditoria
+        )
+        metricas.linhas(saida=len(df_final) if sucesso else 0)
         
-        consolidado_nome = "Reports_Geral_Consolidado.xlsx"
-        sucesso, status_code, resposta = upload_onedrive(consolidado_nome, buffer.read(), token, "consolidado")
+        for erro_gravacao in erros_gravacao:
+            st.warning(f"⚠️ {erro_gravacao}")
 
         progress_container.progress(95)
 
+        metricas.etapa("LIBERANDO_LOCK")
         remover_lock(token, session_lock)
         progress_container.progress(100)
         
@@ -1432,7 +3630,10 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
             with st.expander("📍 Localização dos Arquivos", expanded=True):
                 col1, col2 = st.columns(2)
                 with col1:
-                    st.info(f"📊 **Arquivo Consolidado:**\n`{PASTA_CONSOLIDADO}/Reports_Geral_Consolidado.xlsx`")
+                    if particionado and not MATERIALIZAR_CONSOLIDADO:
+                        st.info(f"📊 **Partições Mensais:**\n`{PASTA_CONSOLIDADO}/{PASTA_PARTICOES}/`")
+                    else:
+                        st.info(f"📊 **Arquivo Consolidado:**\n`{PASTA_CONSOLIDADO}/Reports_Geral_Consolidado.xlsx`")
                 with col2:
                     st.info(f"💾 **Backups e Envios:**\n`{PASTA_ENVIOS_BACKUPS}/`")
             
@@ -1514,28 +3715,11 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
                 </div>
                 """, unsafe_allow_html=True)
             
-            if detalhes:
-                with st.expander("📋 Detalhes das Operações", expanded=removidos > 0):
-                    df_detalhes = pd.DataFrame(detalhes)
-                    
-                    operacoes_inseridas = df_detalhes[df_detalhes['Operação'] == 'INSERIDO']
-                    operacoes_substituidas = df_detalhes[df_detalhes['Operação'] == 'SUBSTITUÍDO']
-                    operacoes_removidas = df_detalhes[df_detalhes['Operação'] == 'REMOVIDO']
-                    
-                    if not operacoes_inseridas.empty:
-                        st.markdown("#### ➕ **Registros Inseridos (Novos)**")
-                        st.dataframe(operacoes_inseridas, use_container_width=True, hide_index=True)
-                    
-                    if not operacoes_substituidas.empty:
-                        st.markdown("#### 🔄 **Registros Substituídos**")
-                        st.dataframe(operacoes_substituidas, use_container_width=True, hide_index=True)
-                    
-                    if not operacoes_removidas.empty:
-                        st.markdown("#### 🗑️ **Registros Removidos**")
-                        st.dataframe(operacoes_removidas, use_container_width=True, hide_index=True)
+            if not detalhes.empty:
+                exibir_detalhes_operacoes(detalhes, expandido=removidos > 0)
             
             if not df_final.empty:
-                resumo_responsaveis = df_final.groupby("RESPONSÁVEL").agg({
+                resumo_responsaveis = df_final.groupby("RESPONSÁVEL", observed=True).agg({
                     "DATA": ["count", "min", "max"]
                 }).round(0)
                 
@@ -1545,7 +3729,7 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
                 
                 # Adicionar informação sobre data do último envio se disponível
                 if 'DATA_ULTIMO_ENVIO' in df_final.columns:
-                    ultimo_envio = df_final.groupby("RESPONSÁVEL")["DATA_ULTIMO_ENVIO"].max()
+                    ultimo_envio = df_final.groupby("RESPONSÁVEL", observed=True)["DATA_ULTIMO_ENVIO"].max()
                     ultimo_envio = ultimo_envio.dt.strftime("%d/%m/%Y %H:%M")
                     resumo_responsaveis["Último Envio"] = ultimo_envio
                 
@@ -1565,7 +3749,7 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
             
     except Exception as e:
         logger.error(f"Erro na consolidação: {e}")
-        remover_lock(token, session_id, force=True)
+        remover_lock(token, session_id)
         
         status_container.markdown(f"""
         <div class="custom-alert error">
@@ -1575,10 +3759,175 @@ def processar_consolidacao_com_lock(df_novo, nome_arquivo, token):
         progress_container.empty()
         st.error("🔓 **Sistema liberado automaticamente após erro.**")
         return False
+    
+    finally:
+        # Gravado depois de liberar o lock, inclusive quando a consolidação falha
+        registro_metricas = metricas.finalizar(sucesso)
+        if lock_criado:
+            salvar_metricas_consolidacao(registro_metricas, token)
+
+# ===========================
+# LEITURA DE PLANILHAS
+# ===========================
+def engine_leitura(extensao):
+    """Engine do pandas para o formato: calamine se instalado, senão openpyxl/xlrd"""
+    if CALAMINE_DISPONIVEL:
+        return "calamine"
+    return "xlrd" if extensao == "xls" else "openpyxl"
+
+def listar_abas_planilha(conteudo, extensao):
+    """Nomes das abas lidos dos metadados do workbook, sem carregar células"""
+    if extensao in ["xlsx", "xlsm"]:
+        try:
+            with zipfile.ZipFile(BytesIO(conteudo)) as pacote:
+                workbook = ET.fromstring(pacote.read("xl/workbook.xml"))
+            ns = {"m": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+            abas = [aba.get("name") for aba in workbook.findall("m:sheets/m:sheet", ns)]
+            if abas:
+                return abas
+        except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
+            logger.warning(f"Metadados do workbook ilegíveis, usando leitura completa: {e}")
+    
+    with pd.ExcelFile(BytesIO(conteudo), engine=engine_leitura(extensao)) as xls:
+        return xls.sheet_names
+
+def ler_aba_planilha(conteudo, extensao, sheet):
+    """Lê somente a aba escolhida, com uma única abertura do workbook"""
+    engine = engine_leitura(extensao)
+    
+    try:
+        with pd.ExcelFile(BytesIO(conteudo), engine=engine) as xls:
+            df = xls.parse(sheet)
+    except Exception as e:
+        if engine != "calamine":
+            raise
+        logger.warning(f"Leitura com calamine falhou, usando engine padrão: {e}")
+        engine_padrao = "xlrd" if extensao == "xls" else "openpyxl"
+        with pd.ExcelFile(BytesIO(conteudo), engine=engine_padrao) as xls:
+            df = xls.parse(sheet)
+    
+    df.columns = df.columns.str.strip().str.upper()
+    return df
+
+# ===========================
+# CACHE DE LEITURA DOS ENVIOS
+# ===========================
+class CacheLRU:
+    """Cache LRU limitado pelo tamanho total estimado dos valores"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.itens = OrderedDict()
+        self.total_bytes = 0
+        self.trava = threading.Lock()
+    
+    def obter(self, chave):
+        with self.trava:
+            if chave not in self.itens:
+                return None
+            self.itens.move_to_end(chave)
+            return self.itens[chave][0]
+    
+    def guardar(self, chave, valor, tamanho):
+        with self.trava:
+            if chave in self.itens:
+                self.total_bytes -= self.itens.pop(chave)[1]
+            self.itens[chave] = (valor, tamanho)
+            self.total_bytes += tamanho
+            
+            # Sempre mantém o item recém-guardado, mesmo que sozinho exceda o limite
+            while self.total_bytes > self.max_bytes and len(self.itens) > 1:
+                _, (_, tamanho_removido) = self.itens.popitem(last=False)
+                self.total_bytes -= tamanho_removido
+
+@st.cache_resource
+def obter_cache_leituras():
+    """Cache de leituras de planilhas compartilhado pelo processo"""
+    return CacheLRU(LIMITE_CACHE_LEITURAS_BYTES)
+
+def hash_conteudo(conteudo):
+    """SHA-256 do conteúdo enviado"""
+    return hashlib.sha256(conteudo).hexdigest()
+
+def tamanho_leitura(leitura):
+    """Tamanho estimado (bytes) de uma leitura em cache"""
+    tamanho = int(leitura["df"].memory_usage(deep=True).sum())
+    if leitura.get("validacao"):
+        # Registros de problemas de data: ~200 bytes cada
+        tamanho += 200 * len(leitura["validacao"][2])
+    return tamanho
+
+def obter_abas_planilha(conteudo, extensao, chave_arquivo):
+    """Abas do arquivo, descobertas uma única vez por hash do arquivo"""
+    cache = obter_cache_leituras()
+    abas = cache.obter((chave_arquivo, "__abas__"))
+    
+    if abas is None:
+        abas = listar_abas_planilha(conteudo, extensao)
+        cache.guardar((chave_arquivo, "__abas__"), abas, 1024)
+    
+    return abas
+
+def obter_leitura_planilha(conteudo, extensao, chave_arquivo, sheet):
+    """DataFrame da aba escolhida, lido uma única vez por (hash do arquivo, aba)"""
+    cache = obter_cache_leituras()
+    leitura = cache.obter((chave_arquivo, sheet))
+    
+    if leitura is None:
+        df = ler_aba_planilha(conteudo, extensao, sheet)
+        leitura = {"df": df, "validacao": None}
+        cache.guardar((chave_arquivo, sheet), leitura, tamanho_leitura(leitura))
+    
+    return leitura
+
+def obter_pre_validacao(conteudo, extensao, chave_arquivo, sheet):
+    """(erros, problemas_datas) da pré-validação em streaming, uma vez por (hash, aba)"""
+    if extensao not in ["xlsx", "xlsm"]:
+        return [], []
+    
+    cache = obter_cache_leituras()
+    pre_validacao = cache.obter((chave_arquivo, sheet, "__pre__"))
+    
+    if pre_validacao is None:
+        pre_validacao = pre_validar_planilha(conteudo, sheet)
+        cache.guardar((chave_arquivo, sheet, "__pre__"), pre_validacao, 1024 + 200 * len(pre_validacao[1]))
+    
+    return pre_validacao
+
+def obter_validacao_planilha(leitura, chave_arquivo, sheet):
+    """(erros, avisos, problemas_datas) da leitura, validada uma única vez"""
+    if leitura["validacao"] is None:
+        leitura["validacao"] = executar_com_perfil("validacao", validar_dados_enviados, leitura["df"])
+        obter_cache_leituras().guardar((chave_arquivo, sheet), leitura, tamanho_leitura(leitura))
+    
+    return leitura["validacao"]
 
 # ===========================
 # INTERFACE STREAMLIT MELHORADA
 # ===========================
+def exibir_perfis():
+    """Painel de administração com os últimos perfis (cProfile + tracemalloc) desta sessão"""
+    with st.expander("🧪 Perfilamento (administração)", expanded=False):
+        perfis = st.session_state.get("perfis", [])
+        if not perfis:
+            st.info(f"Perfilamento ativo: a próxima validação ou consolidação será perfilada e gravada em `{PASTA_PERFIS}`")
+            return
+        
+        for perfil in reversed(perfis):
+            st.markdown(
+                f"#### {perfil['nome']} — {perfil['executado_em']} "
+                f"({perfil['segundos']:.1f}s, pico rastreado {perfil['pico_mb']:.0f} MB)"
+            )
+            st.caption(f"📄 `{perfil['arquivo']}`")
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                st.markdown("**⏱️ Funções (tempo acumulado)**")
+                st.dataframe(perfil["funcoes"], use_container_width=True, hide_index=True)
+            with col2:
+                st.markdown("**🧠 Alocações (memória viva)**")
+                st.dataframe(perfil["alocacoes"], use_container_width=True, hide_index=True)
+
 def exibir_info_versao():
     """Exibe informações de versão e changelog com visual melhorado"""
     with st.sidebar:
@@ -1605,6 +3954,9 @@ def exibir_info_versao():
             st.code(PASTA_CONSOLIDADO, language=None)
             st.markdown("**Backups e Envios:**")
             st.code(PASTA_ENVIOS_BACKUPS, language=None)
+            if MODO_ARMAZENAMENTO == "particionado":
+                st.markdown("**Partições Mensais:**")
+                st.code(f"{PASTA_CONSOLIDADO}/{PASTA_PARTICOES}", language=None)
         
         with st.expander("🆕 Novidades v2.4.0"):
             st.markdown("""
@@ -1758,13 +4110,12 @@ def main():
             
             file_extension = uploaded_file.name.split('.')[-1].lower()
             
+            # Reruns com o mesmo arquivo reaproveitam leitura e validação já feitas
+            conteudo = uploaded_file.getvalue()
+            chave_arquivo = hash_conteudo(conteudo)
+            
             with st.spinner("📖 Lendo arquivo..."):
-                if file_extension == 'xls':
-                    xls = pd.ExcelFile(uploaded_file, engine='xlrd')
-                else:
-                    xls = pd.ExcelFile(uploaded_file)
-                
-                sheets = xls.sheet_names
+                sheets = obter_abas_planilha(conteudo, file_extension, chave_arquivo)
                 
                 if len(sheets) > 1:
                     if "Vendas CTs" in sheets:
@@ -1783,8 +4134,23 @@ def main():
                     if sheet != "Vendas CTs":
                         st.warning("⚠️ Recomendamos que a aba seja chamada 'Vendas CTs'")
                 
-                df = pd.read_excel(uploaded_file, sheet_name=sheet)
-                df.columns = df.columns.str.strip().str.upper()
+                # Rejeição rápida: cabeçalho e datas conferidos antes de carregar a aba inteira
+                erros_pre, problemas_pre = obter_pre_validacao(conteudo, file_extension, chave_arquivo, sheet)
+                if erros_pre:
+                    st.markdown("""
+                    <div class="custom-alert error">
+                        <h4>❌ Problemas Encontrados</h4>
+                        <p>Corrija os problemas abaixo antes de prosseguir:</p>
+                    </div>
+                    """, unsafe_allow_html=True)
+                    for erro in erros_pre:
+                        st.error(erro)
+                    if problemas_pre:
+                        exibir_problemas_datas(problemas_pre)
+                    st.stop()
+                
+                leitura = obter_leitura_planilha(conteudo, file_extension, chave_arquivo, sheet)
+                df = leitura["df"]
                 
                 st.success(f"✅ Dados carregados: {len(df)} linhas, {len(df.columns)} colunas")
                 
@@ -1834,7 +4200,7 @@ def main():
         st.markdown("### 🔍 Validação dos Dados")
         
         with st.spinner("🔍 Validando dados..."):
-            erros, avisos, problemas_datas = validar_dados_enviados(df)
+            erros, avisos, problemas_datas = obter_validacao_planilha(leitura, chave_arquivo, sheet)
         
         # Exibir resultados da validação
         if erros:
@@ -1889,7 +4255,7 @@ def main():
                         """, unsafe_allow_html=True)
                         
                         # Iniciar consolidação diretamente
-                        sucesso = processar_consolidacao_com_lock(df, uploaded_file.name, token)
+                        sucesso = executar_com_perfil("consolidacao", processar_consolidacao_com_lock, df, uploaded_file.name, token)
                         
                         if sucesso:
                             st.balloons()
@@ -1907,8 +4273,13 @@ def main():
                             """, unsafe_allow_html=True)
             
             with col2:
+                simular = st.button("🔍 Simular Consolidação", type="secondary", disabled=botao_desabilitado,
+                                    help="Mostra o que mudaria no consolidado sem gravar nada e sem bloquear o sistema")
                 if st.button("🔄 Limpar Tela", type="secondary"):
                     st.rerun()
+            
+            if simular:
+                simular_consolidacao(df, token)
                     
         # Informações sobre o que a consolidação fará
         with st.expander("ℹ️ O que acontecerá durante a consolidação?", expanded=False):
@@ -1923,6 +4294,9 @@ def main():
             st.success("**🎯 NOVO:** Agora a consolidação é feita por **RESPONSÁVEL + MÊS/ANO** - elimina duplicatas!")
             st.success("**📅 NOVO:** Campo **DATA_ULTIMO_ENVIO** registra quando cada responsável foi atualizado!")
 
+    if perfilamento_ativo():
+        exibir_perfis()
+    
     # Footer melhorado
     st.markdown("---")
     st.markdown(f"""
@@ -0,0 +1,267 @@
+"""
+Benchmark offline do motor de dados com planilhas "Vendas CTs" sintéticas.
+
+Mede validação de datas, validação do envio, plano/análise, consolidação, verificação
+de segurança e leitura/escrita de XLSX em vários tamanhos, grava os tempos em JSON e
+compara com a baseline versionada em ferramentas/benchmark_baseline.json (10k e 100k linhas,
+medida numa máquina de referência; o ambiente fica registrado no arquivo). Em outra máquina,
+gere uma baseline local com --salvar-baseline antes de comparar.
+
+Uso:
+    python -m ferramentas.benchmark --linhas 10000,100000,1000000
+    python -m ferramentas.benchmark --linhas 10000 --salvar-baseline
+    python -m ferramentas.benchmark --baseline ferramentas/benchmark_baseline.json --falhar-em-regressao
+
+As credenciais não são usadas: valores fictícios são definidos em DSVIEW_* antes de importar o app.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CREDENCIAIS = ["CLIENT_ID", "CLIENT_SECRET", "TENANT_ID", "EMAIL_ONEDRIVE", "SITE_ID", "DRIVE_ID"]
+BASELINE_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Valores que a validação deve rejeitar, sorteados nas linhas com data inválida
+DATAS_INVALIDAS = ["", "31/02/2024", "data inválida", "99/99/9999", "FUTURA", "01/01/1900"]
+
+
+def importar_app():
+    """Importa o app sem st.secrets: as credenciais vêm de DSVIEW_* (fictícias, nenhuma chamada é feita)"""
+    for nome in CREDENCIAIS:
+        os.environ.setdefault(f"DSVIEW_{nome}", "benchmark")
+
+    import app_upload_reports_consolidado as app
+    return app
+
+
+# ---------------------------
+# Dados sintéticos
+# ---------------------------
+def gerar_vendas_cts(linhas, responsaveis=50, meses=24, proporcao_datas_invalidas=0.0, semente=0, primeiro_responsavel=0):
+    """
+    Planilha "Vendas CTs" sintética: datas nos últimos `meses` meses, `responsaveis` nomes a partir
+    de `primeiro_responsavel` e, opcionalmente, uma fração de datas inválidas (coluna DATA vira "object").
+    """
+    rng = np.random.default_rng(semente)
+    fim = pd.Timestamp.today().normalize() - pd.Timedelta(days=1)
+    inicio = fim - pd.DateOffset(months=meses)
+    dias = (fim - inicio).days
+
+    nomes = np.array([f"RESPONSÁVEL {i:04d}" for i in range(primeiro_responsavel, primeiro_responsavel + responsaveis)], dtype=object)
+    df = pd.DataFrame({
+        "DATA": inicio + pd.to_timedelta(rng.integers(0, dias + 1, linhas), unit="D"),
+        "RESPONSÁVEL": nomes[rng.integers(0, responsaveis, linhas)],
+        "TMO - DUTO": rng.integers(0, 600, linhas),
+        "TMO - FREIO": rng.integers(0, 600, linhas),
+        "TMO - SANIT": rng.integers(0, 600, linhas),
+        "TMO - VERNIZ": rng.integers(0, 600, linhas),
+        "CX EVAP": rng.integers(0, 50, linhas),
+    })
+
+    invalidas = int(round(linhas * proporcao_datas_invalidas))
+    if invalidas:
+        futura = (pd.Timestamp.today() + pd.Timedelta(days=30)).strftime("%d/%m/%Y")
+        exemplos = np.array([futura if v == "FUTURA" else v for v in DATAS_INVALIDAS], dtype=object)
+        # Como numa leitura de Excel: datas válidas como Timestamp, inválidas como texto na mesma coluna
+        datas = df["DATA"].to_numpy(dtype=object)
+        datas[rng.choice(linhas, invalidas, replace=False)] = exemplos[rng.integers(0, len(exemplos), invalidas)]
+        df["DATA"] = datas
+
+    return df
+
+
+def gerar_cenario(app, linhas, responsaveis, meses, semente):
+    """(consolidado, envio) já no formato usado pela consolidação: o envio atualiza os 2 últimos meses
+    de parte dos responsáveis existentes e traz responsáveis novos"""
+    consolidado = gerar_vendas_cts(linhas, responsaveis, meses, semente=semente)
+    consolidado["DATA_ULTIMO_ENVIO"] = pd.Timestamp.today().normalize() - pd.Timedelta(days=7)
+    consolidado, _ = app.aplicar_schema(consolidado)
+
+    responsaveis_envio = max(2, responsaveis // 5)
+    envio = gerar_vendas_cts(
+        max(1, linhas // 10), responsaveis_envio, 2, semente=semente + 1,
+        primeiro_responsavel=responsaveis - responsaveis_envio // 2,
+    )
+    envio, _ = app.preparar_dados_envio(envio)
+    return consolidado, envio
+
+
+# ---------------------------
+# Medição
+# ---------------------------
+def medir(funcao, repeticoes, preparar=None):
+    """Tempos (s) de `repeticoes` execuções; `preparar` gera os argumentos fora da medição"""
+    tempos = []
+    for _ in range(repeticoes):
+        argumentos = preparar() if preparar else ()
+        gc.collect()
+        inicio = time.perf_counter()
+        funcao(*argumentos)
+        tempos.append(time.perf_counter() - inicio)
+    return tempos
+
+
+def resumir(tempos):
+    return {
+        "mediana_s": round(statistics.median(tempos), 4),
+        "min_s": round(min(tempos), 4),
+        "max_s": round(max(tempos), 4),
+        "repeticoes": len(tempos),
+    }
+
+
+def executar_tamanho(app, linhas, args):
+    """Todos os casos para um tamanho de planilha: {caso: resumo}"""
+    resultados = {}
+
+    def registrar(caso, tempos):
+        resultados[caso] = resumir(tempos)
+        logger.info(f"  {caso:<42} {resultados[caso]['mediana_s']:>9.3f}s")
+
+    bruto = gerar_vendas_cts(linhas, args.responsaveis, args.meses, args.proporcao_datas_invalidas, args.semente)
+    registrar("validar_datas_detalhadamente", medir(app.validar_datas_detalhadamente, args.repeticoes, lambda: (bruto,)))
+    registrar("validar_dados_enviados", medir(app.validar_dados_enviados, args.repeticoes, lambda: (bruto,)))
+    del bruto
+
+    consolidado, envio = gerar_cenario(app, linhas, args.responsaveis, args.meses, args.semente)
+    plano = app.calcular_plano_consolidacao(consolidado, envio)
+    registrar("calcular_plano_consolidacao", medir(app.calcular_plano_consolidacao, args.repeticoes, lambda: (consolidado, envio)))
+    registrar("analise_pre_consolidacao_v2", medir(app.analise_pre_consolidacao_v2, args.repeticoes, lambda: (consolidado, envio, plano)))
+    registrar("comparar_e_atualizar_registros_v2", medir(
+        app.comparar_e_atualizar_registros_v2, args.repeticoes, lambda: (consolidado.copy(deep=False), envio)
+    ))
+
+    df_final = app.comparar_e_atualizar_registros_v2(consolidado.copy(deep=False), envio, plano)[0]
+    registrar("verificar_seguranca_consolidacao_v2", medir(
+        app.verificar_seguranca_consolidacao_v2, args.repeticoes, lambda: (consolidado, envio, df_final)
+    ))
+    del plano, envio
+
+    if args.sem_xlsx:
+        return resultados
+
+    conteudo = {}
+
+    def escrever(df):
+        with app.gerar_xlsx_streaming(df) as arquivo:
+            conteudo["xlsx"] = arquivo.read()
+
+    registrar("xlsx_escrita", medir(escrever, args.repeticoes_xlsx, lambda: (df_final,)))
+    del consolidado, df_final
+    registrar("xlsx_leitura", medir(app.ler_aba_planilha, args.repeticoes_xlsx, lambda: (conteudo["xlsx"], "xlsx", "Vendas CTs")))
+    return resultados
+
+
+# ---------------------------
+# Baseline
+# ---------------------------
+def comparar_com_baseline(resultados, baseline, tolerancia):
+    """{caso@linhas: {...}} com a razão atual/baseline das medianas e a classificação"""
+    comparacao = {}
+    for linhas, casos in resultados.items():
+        for caso, atual in casos.items():
+            anterior = baseline.get("resultados", {}).get(linhas, {}).get(caso)
+            if not anterior or not anterior.get("mediana_s"):
+                continue
+            razao = atual["mediana_s"] / anterior["mediana_s"]
+            if razao > 1 + tolerancia:
+                situacao = "regressao"
+            elif razao < 1 - tolerancia:
+                situacao = "melhoria"
+            else:
+                situacao = "estavel"
+            comparacao[f"{caso}@{linhas}"] = {
+                "baseline_s": anterior["mediana_s"],
+                "atual_s": atual["mediana_s"],
+                "razao": round(razao, 3),
+                "situacao": situacao,
+            }
+    return comparacao
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline do motor de dados com planilhas Vendas CTs sintéticas")
+    parser.add_argument("--linhas", default="10000,100000,1000000", help="Tamanhos separados por vírgula")
+    parser.add_argument("--responsaveis", type=int, default=200)
+    parser.add_argument("--meses", type=int, default=24)
+    parser.add_argument("--proporcao-datas-invalidas", type=float, default=0.001)
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--repeticoes-xlsx", type=int, default=1)
+    parser.add_argument("--sem-xlsx", action="store_true", help="Não mede leitura/escrita de XLSX")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--saida", default="benchmark_resultados.json")
+    parser.add_argument("--baseline", default=BASELINE_PADRAO)
+    parser.add_argument("--salvar-baseline", action="store_true", help="Grava os resultados também como nova baseline")
+    parser.add_argument("--tolerancia", type=float, default=0.10, help="Variação relativa tolerada antes de apontar regressão")
+    parser.add_argument("--falhar-em-regressao", action="store_true", help="Código de saída 1 se houver regressão")
+    parser.add_argument("--logs-do-app", action="store_true", help="Mantém os logs do app (silenciados por padrão)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    app = importar_app()
+    if not args.logs_do_app:
+        logging.getLogger(app.__name__).setLevel(logging.CRITICAL)
+        logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    tamanhos = [int(t) for t in args.linhas.split(",") if t.strip()]
+    resultados = {}
+    for linhas in tamanhos:
+        logger.info(f"📏 {linhas:,} linhas")
+        resultados[str(linhas)] = executar_tamanho(app, linhas, args)
+
+    relatorio = {
+        "gerado_em": datetime.now().isoformat(),
+        "ambiente": {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "plataforma": platform.platform(),
+            "calamine": app.CALAMINE_DISPONIVEL,
+        },
+        "parametros": {k: v for k, v in vars(args).items() if k not in ("saida", "baseline", "salvar_baseline", "falhar_em_regressao")},
+        "resultados": resultados,
+    }
+
+    regressoes = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            relatorio["comparacao"] = comparar_com_baseline(resultados, json.load(f), args.tolerancia)
+        relatorio["baseline"] = args.baseline
+
+        logger.info("📊 Comparação com a baseline (mediana atual / baseline):")
+        for chave, item in relatorio["comparacao"].items():
+            logger.info(f"  {chave:<50} {item['baseline_s']:>9.3f}s -> {item['atual_s']:>9.3f}s  x{item['razao']:<6} {item['situacao']}")
+            if item["situacao"] == "regressao":
+                regressoes.append(chave)
+    else:
+        logger.info(f"Sem baseline em {args.baseline}; use --salvar-baseline para criá-la")
+
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2)
+    logger.info(f"💾 Resultados em {args.saida}")
+
+    if args.salvar_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=2)
+        logger.info(f"💾 Baseline atualizada em {args.baseline}")
+
+    if regressoes:
+        logger.warning(f"⚠️ {len(regressoes)} regressão(ões): {', '.join(regressoes)}")
+        if args.falhar_em_regressao:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""
+Drive falso local que imita o subconjunto da API Microsoft Graph usado pelo app.
+
+Uso:
+    python -m ferramentas.drive_falso --porta 8765
+    DSVIEW_GRAPH_URL=http://127.0.0.1:8765 streamlit run app_upload_reports_consolidado.py
+
+Também pode ser iniciado dentro de um script com DriveFalso().iniciar().
+"""
+import argparse
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class DriveFalso:
+    """Armazena itens em memória e atende as rotas do Graph via HTTP"""
+
+    def __init__(self, host="127.0.0.1", porta=0, falhar_bloco_a_cada=0,
+                 latencia=0.0, variacao_latencia=0.0, taxa_throttling=0.0, espera_throttling=1):
+        self.host = host
+        self.porta = porta
+        # Simula quedas de rede: a cada N blocos de uma sessão, um responde 503 sem gravar
+        self.falhar_bloco_a_cada = falhar_bloco_a_cada
+        # Simula a rede e os limites do SharePoint: atraso por requisição (s, mais um sorteio
+        # uniforme até variacao_latencia) e uma fração de requisições recusadas com 429 + Retry-After
+        self.latencia = latencia
+        self.variacao_latencia = variacao_latencia
+        self.taxa_throttling = taxa_throttling
+        self.espera_throttling = espera_throttling
+        self.requisicoes = 0
+        self.respostas_throttling = 0
+        self.itens = {}
+        self.sessoes = {}
+        self.trava = threading.RLock()
+        self.contador_blocos = 0
+        self.servidor = None
+
+    # ---------------------------
+    # Itens
+    # ---------------------------
+    def _novo_item(self, caminho, conteudo=None, pasta=False):
+        item_id = uuid.uuid4().hex
+        return {
+            "id": item_id,
+            "name": caminho.split("/")[-1],
+            "caminho": caminho,
+            "conteudo": conteudo,
+            "pasta": pasta,
+            "versao": 1,
+        }
+
+    def _metadados(self, item):
+        dados = {
+            "id": item["id"],
+            "name": item["name"],
+            "eTag": f'"{{{item["id"]}}},{item["versao"]}"',
+            "cTag": f'"c:{{{item["id"]}}},{item["versao"]}"',
+        }
+        if item["pasta"]:
+            dados["folder"] = {"childCount": len(self._filhos(item["caminho"]))}
+        else:
+            dados["size"] = len(item["conteudo"])
+            dados["file"] = {}
+        return dados
+
+    def _tags(self, item):
+        metadados = self._metadados(item)
+        return metadados["eTag"], metadados["cTag"]
+
+    def _filhos(self, caminho):
+        prefixo = f"{caminho}/" if caminho else ""
+        return [
+            item for chave, item in self.itens.items()
+            if chave.startswith(prefixo) and "/" not in chave[len(prefixo):]
+        ]
+
+    def _garantir_pastas(self, caminho):
+        partes = caminho.split("/")[:-1]
+        for i in range(1, len(partes) + 1):
+            caminho_pasta = "/".join(partes[:i])
+            if caminho_pasta not in self.itens:
+                self.itens[caminho_pasta] = self._novo_item(caminho_pasta, pasta=True)
+
+    def gravar(self, caminho, conteudo, if_match=None, falhar_se_existir=False):
+        """Cria ou substitui um arquivo; retorna (status, metadados)"""
+        with self.trava:
+            item = self.itens.get(caminho)
+            if item is not None and falhar_se_existir:
+                return 409, {"error": {"code": "nameAlreadyExists"}}
+            if if_match and (item is None or if_match not in self._tags(item)):
+                return 412, {"error": {"code": "preconditionFailed"}}
+            self._garantir_pastas(caminho)
+            if item is None:
+                item = self._novo_item(caminho, conteudo)
+                self.itens[caminho] = item
+                return 201, self._metadados(item)
+            item["conteudo"] = conteudo
+            item["versao"] += 1
+            return 200, self._metadados(item)
+
+    def ler(self, caminho):
+        with self.trava:
+            item = self.itens.get(caminho)
+            return None if item is None or item["pasta"] else item["conteudo"]
+
+    # ---------------------------
+    # Servidor
+    # ---------------------------
+    @property
+    def url(self):
+        host, porta = self.servidor.server_address[:2]
+        return f"http://{host}:{porta}"
+
+    def iniciar(self):
+        drive = self
+
+        class Handler(RotasGraph):
+            pass
+
+        Handler.drive = drive
+        self.servidor = ThreadingHTTPServer((self.host, self.porta), Handler)
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        logger.info(f"Drive falso ouvindo em {self.url}")
+        return self
+
+    def parar(self):
+        if self.servidor:
+            self.servidor.shutdown()
+            self.servidor.server_close()
+
+
+class RotasGraph(BaseHTTPRequestHandler):
+    """Rotas: root:/{caminho}[:/content|:/children|:/createUploadSession], items/{id}, _upload/{sessão}"""
+
+    drive = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, formato, *args):
+        logger.debug(formato, *args)
+
+    # ---------------------------
+    # Utilitários
+    # ---------------------------
+    def _corpo(self):
+        tamanho = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(tamanho) if tamanho else b""
+
+    def _responder(self, status, corpo=None, headers=None):
+        if isinstance(corpo, (dict, list)):
+            dados = json.dumps(corpo).encode("utf-8")
+            tipo = "application/json"
+        else:
+            dados = corpo or b""
+            tipo = "application/octet-stream"
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(dados)))
+        for chave, valor in (headers or {}).items():
+            self.send_header(chave, valor)
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def _simular_rede(self):
+        """Aplica latência e throttling do drive; True se a requisição foi recusada com 429"""
+        drive = self.drive
+        with drive.trava:
+            drive.requisicoes += 1
+
+        if drive.latencia or drive.variacao_latencia:
+            time.sleep(drive.latencia + random.uniform(0, drive.variacao_latencia))
+
+        if drive.taxa_throttling and random.random() < drive.taxa_throttling:
+            self._corpo()
+            with drive.trava:
+                drive.respostas_throttling += 1
+            self._responder(429, {"error": {"code": "activityLimitReached"}},
+                            {"Retry-After": str(drive.espera_throttling)})
+            return True
+        return False
+
+    def _rota(self):
+        """Retorna (tipo, alvo, sufixo) a partir do caminho da requisição"""
+        caminho = unquote(urlsplit(self.path).path)
+        if caminho.startswith("/_upload/"):
+            return "upload", caminho[len("/_upload/"):], ""
+
+        _, _, resto = caminho.partition("/drives/")
+        _, _, resto = resto.partition("/")
+        if resto.startswith("items/"):
+            return "item_id", resto[len("items/"):], ""
+        if resto in ("root/children", "root:/children"):
+            return "caminho", "", "children"
+        if resto.startswith("root:/"):
+            alvo = resto[len("root:/"):]
+            sufixo = ""
+            if alvo.endswith(":"):
+                alvo = alvo[:-1]
+            elif ":/" in alvo:
+                alvo, sufixo = alvo.rsplit(":/", 1)
+            return "caminho", alvo.strip("/"), sufixo
+        return None, None, None
+
+    def _item_por_id(self, item_id):
+        for item in self.drive.itens.values():
+            if item["id"] == item_id:
+                return item
+        return None
+
+    # ---------------------------
+    # Verbos
+    # ---------------------------
+    def do_GET(self):
+        if self._simular_rede():
+            return
+        tipo, alvo, sufixo = self._rota()
+        drive = self.drive
+
+        with drive.trava:
+            if tipo == "upload":
+                sessao = drive.sessoes.get(alvo)
+                if sessao is None:
+                    return self._responder(404, {"error": {"code": "itemNotFound"}})
+                return self._responder(200, {"nextExpectedRanges": [f"{sessao['recebido']}-"]})
+
+            item = drive.itens.get(alvo) if tipo == "caminho" else None
+            if item is None:
+                return self._responder(404, {"error": {"code": "itemNotFound"}})
+
+            metadados = drive._metadados(item)
+            if sufixo == "content":
+                if self.headers.get("If-None-Match") in (metadados["eTag"], metadados["cTag"]):
+                    return self._responder(304)
+                return self._responder(200, item["conteudo"], {"ETag": metadados["eTag"]})
+            if sufixo == "children":
+                filhos = [drive._metadados(filho) for filho in drive._filhos(alvo)]
+                return self._responder(200, {"value": filhos})
+            return self._responder(200, metadados)
+
+    def do_PUT(self):
+        if self._simular_rede():
+            return
+        tipo, alvo, sufixo = self._rota()
+        corpo = self._corpo()
+        drive = self.drive
+
+        if tipo == "upload":
+            return self._receber_bloco(alvo, corpo)
+        if tipo == "caminho" and sufixo == "content":
+            consulta = parse_qs(urlsplit(self.path).query)
+            status, metadados = drive.gravar(
+                alvo, corpo,
+                if_match=self.headers.get("If-Match"),
+                falhar_se_existir=consulta.get("@microsoft.graph.conflictBehavior") == ["fail"]
+            )
+            return self._responder(status, metadados)
+        return self._responder(400, {"error": {"code": "invalidRequest"}})
+
+    def do_POST(self):
+        if self._simular_rede():
+            return
+        if urlsplit(self.path).path.endswith("/$batch"):
+            return self._batch(json.loads(self._corpo() or b"{}"))
+
+        tipo, alvo, sufixo = self._rota()
+        corpo = json.loads(self._corpo() or b"{}")
+        drive = self.drive
+
+        with drive.trava:
+            if tipo == "caminho" and sufixo == "createUploadSession":
+                sessao_id = uuid.uuid4().hex
+                drive.sessoes[sessao_id] = {"caminho": alvo, "partes": bytearray(), "recebido": 0}
+                host = self.headers.get("Host")
+                return self._responder(200, {
+                    "uploadUrl": f"http://{host}/_upload/{sessao_id}",
+                    "nextExpectedRanges": ["0-"]
+                })
+
+            if tipo == "caminho" and sufixo == "children":
+                caminho = f"{alvo}/{corpo['name']}" if alvo else corpo["name"]
+                if caminho in drive.itens:
+                    return self._responder(409, {"error": {"code": "nameAlreadyExists"}})
+                drive._garantir_pastas(caminho)
+                drive.itens[caminho] = drive._novo_item(caminho, pasta=True)
+                return self._responder(201, drive._metadados(drive.itens[caminho]))
+
+        return self._responder(400, {"error": {"code": "invalidRequest"}})
+
+    def do_PATCH(self):
+        if self._simular_rede():
+            return
+        tipo, alvo, _ = self._rota()
+        corpo = json.loads(self._corpo() or b"{}")
+        drive = self.drive
+
+        with drive.trava:
+            item = self._item_por_id(alvo) if tipo == "item_id" else drive.itens.get(alvo)
+            if item is None:
+                return self._responder(404, {"error": {"code": "itemNotFound"}})
+            if "name" in corpo:
+                pasta_pai = item["caminho"].rpartition("/")[0]
+                novo_caminho = f"{pasta_pai}/{corpo['name']}" if pasta_pai else corpo["name"]
+                del drive.itens[item["caminho"]]
+                item["caminho"] = novo_caminho
+                item["name"] = corpo["name"]
+                item["versao"] += 1
+                drive.itens[novo_caminho] = item
+            return self._responder(200, drive._metadados(item))
+
+    def do_DELETE(self):
+        if self._simular_rede():
+            return
+        tipo, alvo, _ = self._rota()
+        self._corpo()
+        drive = self.drive
+
+        with drive.trava:
+            if tipo == "upload":
+                drive.sessoes.pop(alvo, None)
+                return self._responder(204)
+            item = self._item_por_id(alvo) if tipo == "item_id" else drive.itens.get(alvo)
+            if item is None:
+                return self._responder(404, {"error": {"code": "itemNotFound"}})
+            if_match = self.headers.get("If-Match")
+            if if_match and if_match not in drive._tags(item):
+                return self._responder(412, {"error": {"code": "preconditionFailed"}})
+            del drive.itens[item["caminho"]]
+            return self._responder(204)
+
+    # ---------------------------
+    # JSON $batch
+    # ---------------------------
+    def _batch(self, corpo):
+        """Executa as sub-requisições em ordem contra o próprio servidor (dependsOn respeitado)"""
+        base = urlsplit(self.path).path[:-len("/$batch")]
+        host, porta = self.server.server_address[:2]
+        respostas = []
+        status_por_id = {}
+
+        for requisicao in corpo.get("requests", []):
+            dependencias = requisicao.get("dependsOn") or []
+            if any(status_por_id.get(d, 500) >= 400 for d in dependencias):
+                status_por_id[requisicao["id"]] = 424
+                respostas.append({"id": requisicao["id"], "status": 424, "body": {"error": {"code": "failedDependency"}}})
+                continue
+
+            conexao = http.client.HTTPConnection(host, porta)
+            dados = requisicao.get("body")
+            dados = json.dumps(dados).encode("utf-8") if dados is not None else None
+            conexao.request(requisicao["method"], base + requisicao["url"], body=dados,
+                            headers={**requisicao.get("headers", {}), "Host": self.headers.get("Host", "")})
+            resposta = conexao.getresponse()
+            conteudo = resposta.read()
+            conexao.close()
+
+            try:
+                corpo_resposta = json.loads(conteudo) if conteudo else None
+            except ValueError:
+                corpo_resposta = None
+            status_por_id[requisicao["id"]] = resposta.status
+            respostas.append({"id": requisicao["id"], "status": resposta.status, "body": corpo_resposta})
+
+        return self._responder(200, {"responses": respostas})
+
+    # ---------------------------
+    # Sessão de upload
+    # ---------------------------
+    def _receber_bloco(self, sessao_id, corpo):
+        drive = self.drive
+
+        with drive.trava:
+            sessao = drive.sessoes.get(sessao_id)
+            if sessao is None:
+                return self._responder(404, {"error": {"code": "itemNotFound"}})
+
+            drive.contador_blocos += 1
+            if drive.falhar_bloco_a_cada and drive.contador_blocos % drive.falhar_bloco_a_cada == 0:
+                return self._responder(503, {"error": {"code": "serviceNotAvailable"}})
+
+            intervalo, _, total = self.headers.get("Content-Range", "").replace("bytes ", "").partition("/")
+            inicio, _, fim = intervalo.partition("-")
+            inicio, fim, total = int(inicio), int(fim), int(total)
+
+            if inicio != sessao["recebido"] or fim - inicio + 1 != len(corpo):
+                return self._responder(416, {
+                    "error": {"code": "invalidRange"},
+                    "nextExpectedRanges": [f"{sessao['recebido']}-"]
+                })
+
+            sessao["partes"].extend(corpo)
+            sessao["recebido"] = fim + 1
+
+            if sessao["recebido"] < total:
+                return self._responder(202, {"nextExpectedRanges": [f"{sessao['recebido']}-"]})
+
+            del drive.sessoes[sessao_id]
+            status, metadados = drive.gravar(sessao["caminho"], bytes(sessao["partes"]))
+            return self._responder(status, metadados)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive falso local compatível com o subconjunto do Graph usado pelo app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--falhar-bloco-a-cada", type=int, default=0,
+                        help="responde 503 a cada N blocos de upload em sessão (0 = nunca)")
+    parser.add_argument("--latencia-ms", type=float, default=0, help="atraso fixo por requisição")
+    parser.add_argument("--variacao-latencia-ms", type=float, default=0, help="atraso adicional sorteado entre 0 e este valor")
+    parser.add_argument("--taxa-throttling", type=float, default=0,
+                        help="fração das requisições respondidas com 429 (0 a 1)")
+    parser.add_argument("--espera-throttling", type=int, default=1, help="Retry-After (s) das respostas 429")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    drive = DriveFalso(
+        args.host, args.porta, args.falhar_bloco_a_cada,
+        latencia=args.latencia_ms / 1000, variacao_latencia=args.variacao_latencia_ms / 1000,
+        taxa_throttling=args.taxa_throttling, espera_throttling=args.espera_throttling,
+    ).iniciar()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        drive.parar()
+
+
+if __name__ == "__main__":
+    main()
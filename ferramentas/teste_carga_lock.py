@@ -0,0 +1,245 @@
+"""
+Teste de carga da disputa pelo lock com envios concorrentes simulados.
+
+Sobe um DriveFalso local (latência e throttling configuráveis) e N sessões simuladas, cada uma
+repetindo o ciclo do app: verificar lock -> criar lock -> atualizar status -> baixar e mesclar
+o consolidado -> gravar -> liberar o lock. Ao final, relata latência de aquisição (percentis),
+aquisições duplas, tentativas desperdiçadas e vazão (envios/minuto).
+
+Uso:
+    python -m ferramentas.teste_carga_lock --sessoes 8 --envios-por-sessao 3
+    python -m ferramentas.teste_carga_lock --sessoes 20 --latencia-ms 80 --variacao-latencia-ms 40 --taxa-throttling 0.02
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from ferramentas.benchmark import gerar_vendas_cts, importar_app
+from ferramentas.drive_falso import DriveFalso
+
+logger = logging.getLogger(__name__)
+
+PERCENTIS = [50, 90, 95, 99]
+
+
+class ResultadosCarga:
+    """Contadores e amostras compartilhados pelas sessões simuladas"""
+
+    def __init__(self):
+        self.trava = threading.Lock()
+        self.latencias_aquisicao = []
+        self.duracoes_com_lock = []
+        self.contadores = {
+            "envios_concluidos": 0,
+            "envios_falhos": 0,
+            "desistencias": 0,
+            "esperas_lock_ocupado": 0,
+            "disputas_perdidas": 0,
+            "locks_perdidos": 0,
+            "aquisicoes_duplas": 0,
+        }
+        # Sessões que se consideram donas do lock neste instante (deve ser no máximo 1)
+        self.detentores = 0
+
+    def contar(self, nome, quantidade=1):
+        with self.trava:
+            self.contadores[nome] += quantidade
+
+    def adquirir(self, latencia):
+        with self.trava:
+            self.latencias_aquisicao.append(latencia)
+            self.detentores += 1
+            if self.detentores > 1:
+                self.contadores["aquisicoes_duplas"] += 1
+                logger.error(f"🚨 Aquisição dupla: {self.detentores} sessões detêm o lock ao mesmo tempo")
+
+    def liberar(self, duracao):
+        with self.trava:
+            self.detentores -= 1
+            self.duracoes_com_lock.append(duracao)
+
+
+def percentis(amostras):
+    if not amostras:
+        return {}
+    valores = np.percentile(amostras, PERCENTIS)
+    resumo = {f"p{p}": round(float(v), 3) for p, v in zip(PERCENTIS, valores)}
+    resumo["max"] = round(float(max(amostras)), 3)
+    return resumo
+
+
+def adquirir_lock(app, token, indice, args, resultados):
+    """Espera o lock como a interface faz (nova verificação a cada intervalo); retorna session_lock ou None"""
+    inicio = time.perf_counter()
+
+    while time.perf_counter() - inicio < args.espera_maxima:
+        ocupado, _ = app.verificar_lock_existente(token)
+        if ocupado:
+            resultados.contar("esperas_lock_ocupado")
+            time.sleep(args.intervalo_espera)
+            continue
+
+        criado, session_lock = app.criar_lock(token, f"Teste de carga - sessão {indice}")
+        if criado:
+            resultados.adquirir(time.perf_counter() - inicio)
+            return session_lock
+
+        # Outra sessão criou o lock entre a verificação e a criação
+        resultados.contar("disputas_perdidas")
+        time.sleep(args.intervalo_espera)
+
+    resultados.contar("desistencias")
+    return None
+
+
+def consolidar_com_lock(app, token, session_lock, df_envio, nome_arquivo, resultados):
+    """Etapas do app com o lock detido; retorna True se o consolidado foi gravado"""
+    for status in ["BAIXANDO_ARQUIVO", "PREPARANDO_DADOS", "CONSOLIDANDO", "UPLOAD_FINAL"]:
+        if not app.atualizar_status_lock(token, session_lock, status, "Teste de carga") and session_lock not in app.LOCKS_DA_SESSAO:
+            resultados.contar("locks_perdidos")
+            return False
+
+        if status == "BAIXANDO_ARQUIVO":
+            df_consolidado, _ = app.baixar_arquivo_consolidado(token)
+        elif status == "PREPARANDO_DADOS":
+            df_envio, _ = app.preparar_dados_envio(df_envio)
+        elif status == "CONSOLIDANDO":
+            df_final = app.comparar_e_atualizar_registros_v2(df_consolidado, df_envio)[0]
+            df_consolidado = None
+            df_final = app.ordenar_consolidado(df_final)
+
+    sucesso, _, _, _, erros = app.gravar_resultados_em_paralelo(df_envio, nome_arquivo, df_final, token, particionado=False)
+    for erro in erros:
+        logger.warning(f"⚠️ {erro}")
+    return sucesso
+
+
+def simular_sessao(app, token, indice, args, resultados, largada):
+    """Uma sessão (thread = session_id próprio no app) enviando `envios_por_sessao` planilhas"""
+    largada.wait()
+
+    for envio in range(args.envios_por_sessao):
+        df_envio = gerar_vendas_cts(
+            args.linhas_envio, responsaveis=3, meses=2,
+            semente=indice * 1000 + envio, primeiro_responsavel=indice * 3,
+        )
+        session_lock = adquirir_lock(app, token, indice, args, resultados)
+        if session_lock is None:
+            continue
+
+        inicio_lock = time.perf_counter()
+        try:
+            sucesso = consolidar_com_lock(app, token, session_lock, df_envio, f"carga_s{indice}_e{envio}.xlsx", resultados)
+        except Exception as e:
+            logger.error(f"Sessão {indice}: erro na consolidação: {e}")
+            sucesso = False
+        finally:
+            # O contador sai antes da exclusão: quem adquirir em seguida não é contado como duplo
+            resultados.liberar(time.perf_counter() - inicio_lock)
+            app.remover_lock(token, session_lock)
+
+        resultados.contar("envios_concluidos" if sucesso else "envios_falhos")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga da disputa pelo lock com sessões simuladas")
+    parser.add_argument("--sessoes", type=int, default=8)
+    parser.add_argument("--envios-por-sessao", type=int, default=2)
+    parser.add_argument("--linhas-consolidado", type=int, default=20000)
+    parser.add_argument("--linhas-envio", type=int, default=500)
+    parser.add_argument("--intervalo-espera", type=float, default=0.5,
+                        help="Segundos entre verificações com o lock ocupado (a interface usa 15)")
+    parser.add_argument("--espera-maxima", type=float, default=600, help="Segundos até a sessão desistir de um envio")
+    parser.add_argument("--latencia-ms", type=float, default=20)
+    parser.add_argument("--variacao-latencia-ms", type=float, default=20)
+    parser.add_argument("--taxa-throttling", type=float, default=0.0)
+    parser.add_argument("--espera-throttling", type=int, default=1, help="Retry-After (s) das respostas 429")
+    parser.add_argument("--saida", default=None, help="Grava o relatório em JSON")
+    parser.add_argument("--logs-do-app", action="store_true", help="Mantém os logs do app (silenciados por padrão)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    drive = DriveFalso(
+        latencia=args.latencia_ms / 1000, variacao_latencia=args.variacao_latencia_ms / 1000,
+        taxa_throttling=args.taxa_throttling, espera_throttling=args.espera_throttling,
+    ).iniciar()
+
+    # Drive, cache local e credenciais do app apontam para o ambiente do teste
+    os.environ["DSVIEW_GRAPH_URL"] = drive.url
+    os.environ["DSVIEW_CACHE_DIR"] = tempfile.mkdtemp(prefix="dsview_carga_")
+    app = importar_app()
+    if not args.logs_do_app:
+        logging.getLogger(app.__name__).setLevel(logging.CRITICAL)
+        logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    token = "teste-carga"
+    consolidado_inicial = gerar_vendas_cts(args.linhas_consolidado, responsaveis=max(3, args.sessoes * 3))
+    consolidado_inicial, _ = app.aplicar_schema(consolidado_inicial)
+    with app.gerar_xlsx_streaming(consolidado_inicial) as arquivo:
+        app.upload_onedrive("Reports_Geral_Consolidado.xlsx", arquivo, token, "consolidado", mover_existente=False)
+    requisicoes_preparo = drive.requisicoes
+    throttling_preparo = drive.respostas_throttling
+
+    logger.info(f"🚦 {args.sessoes} sessões x {args.envios_por_sessao} envios contra {drive.url}")
+    resultados = ResultadosCarga()
+    largada = threading.Event()
+    inicio = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.sessoes) as executor:
+        futuros = [
+            executor.submit(simular_sessao, app, token, indice, args, resultados, largada)
+            for indice in range(args.sessoes)
+        ]
+        largada.set()
+        for futuro in futuros:
+            futuro.result()
+
+    duracao = time.perf_counter() - inicio
+    drive.parar()
+
+    contadores = resultados.contadores
+    relatorio = {
+        "gerado_em": datetime.now().isoformat(),
+        "parametros": {k: v for k, v in vars(args).items() if k != "saida"},
+        "duracao_s": round(duracao, 2),
+        "vazao_envios_por_minuto": round(contadores["envios_concluidos"] / (duracao / 60), 2) if duracao else 0.0,
+        "latencia_aquisicao_s": percentis(resultados.latencias_aquisicao),
+        "tempo_com_lock_s": percentis(resultados.duracoes_com_lock),
+        **contadores,
+        "tentativas_desperdicadas": contadores["esperas_lock_ocupado"] + contadores["disputas_perdidas"],
+        "requisicoes_drive": drive.requisicoes - requisicoes_preparo,
+        "respostas_429": drive.respostas_throttling - throttling_preparo,
+    }
+
+    logger.info("📊 Resultado do teste de carga")
+    logger.info(f"  Envios concluídos / falhos / desistências: {contadores['envios_concluidos']} / "
+                f"{contadores['envios_falhos']} / {contadores['desistencias']}")
+    logger.info(f"  Vazão: {relatorio['vazao_envios_por_minuto']} envios/min em {relatorio['duracao_s']}s")
+    logger.info(f"  Latência de aquisição (s): {relatorio['latencia_aquisicao_s']}")
+    logger.info(f"  Tempo com o lock (s): {relatorio['tempo_com_lock_s']}")
+    logger.info(f"  Tentativas desperdiçadas: {relatorio['tentativas_desperdicadas']} "
+                f"({contadores['esperas_lock_ocupado']} com lock ocupado, {contadores['disputas_perdidas']} disputas perdidas)")
+    logger.info(f"  Requisições ao drive: {relatorio['requisicoes_drive']} ({relatorio['respostas_429']} respondidas com 429)")
+    logger.info(f"  Locks perdidos: {contadores['locks_perdidos']}")
+    if contadores["aquisicoes_duplas"]:
+        logger.error(f"  🚨 Aquisições duplas: {contadores['aquisicoes_duplas']}")
+    else:
+        logger.info("  ✅ Nenhuma aquisição dupla")
+
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=2)
+        logger.info(f"💾 Relatório em {args.saida}")
+
+
+if __name__ == "__main__":
+    main()